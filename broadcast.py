@@ -1,39 +1,387 @@
+import asyncio
+import hashlib
 import logging
 import os
-from users import get_users
+import time
+from datetime import datetime
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+from rate_limit import TokenBucket
+from metrics import counter, gauge
+from storage import read_json, remove, write_json
+from users import get_users, reload_users, remove_user
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger(__name__)
 
-async def send_broadcast(bot, message_text):
+BROADCAST_MESSAGES = counter("cnc_broadcast_messages_total", "Сообщения рассылок по результату", ["result"])
+BROADCAST_THROUGHPUT = gauge("cnc_broadcast_messages_per_second", "Скорость текущей или последней рассылки, сообщений в секунду")
+
+# Параметры рассылки
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))  # Одновременных отправок
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))  # Сообщений в секунду (лимит Telegram ~30)
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))  # Повторов при сетевых ошибках и RetryAfter
+BROADCAST_PROGRESS_FILE = os.getenv("BROADCAST_PROGRESS_FILE", "broadcast_progress.json")
+BROADCAST_PROGRESS_SAVE_EVERY = int(os.getenv("BROADCAST_PROGRESS_SAVE_EVERY", "100"))  # Сохранять прогресс каждые N отправок
+
+# Ошибки Telegram, означающие, что писать этому пользователю больше нельзя
+_GONE_CHAT_ERRORS = ("chat not found", "user is deactivated", "bot was blocked", "bot was kicked")
+
+
+def _broadcast_id(message_text):
+    return hashlib.sha256(message_text.encode("utf-8")).hexdigest()[:16]
+
+
+async def _read_progress():
+    try:
+        return await read_json(BROADCAST_PROGRESS_FILE)
+    except Exception as e:
+        logger.error(f"Ошибка при чтении прогресса рассылки: {e}")
+        return None
+
+
+async def get_pending_broadcast():
+    """
+    Возвращает текст незавершённой рассылки, если она была прервана.
+
+    Returns:
+        Optional[str]: Текст рассылки или None
+    """
+    progress = await _read_progress()
+    return progress["text"] if progress else None
+
+
+async def discard_pending_broadcast(message_text):
+    """Удаляет сохранённый прогресс рассылки с этим текстом, чтобы она не продолжилась при запуске."""
+    progress = await _read_progress()
+    if progress and progress.get("id") == _broadcast_id(message_text):
+        await remove(BROADCAST_PROGRESS_FILE)
+
+
+async def _send_one(bot, limiter, user_id, text):
+    """
+    Отправляет одно сообщение с учётом лимитов Telegram.
+
+    Returns:
+        bool: True, если сообщение доставлено
+    """
+    for attempt in range(BROADCAST_MAX_RETRIES + 1):
+        await limiter.acquire()
+        try:
+            await bot.send_message(chat_id=user_id, text=text)
+            logger.debug("Сообщение успешно отправлено пользователю %s", user_id)
+            return True
+        except RetryAfter as e:
+            # Telegram просит подождать — притормаживаем всю рассылку, а не только этот поток
+            logger.warning(f"Telegram ограничил рассылку, пауза {e.retry_after} с")
+            limiter.pause(float(e.retry_after))
+        except Forbidden as e:
+            logger.info(f"Пользователь {user_id} заблокировал бота, удаляем из списка: {e}")
+            await remove_user(user_id)
+            return False
+        except BadRequest as e:
+            if any(reason in str(e).lower() for reason in _GONE_CHAT_ERRORS):
+                logger.info(f"Чат {user_id} недоступен, удаляем пользователя из списка: {e}")
+                await remove_user(user_id)
+            else:
+                logger.error(f"Ошибка при отправке сообщения пользователю {user_id}: {e}")
+            return False
+        except (TimedOut, NetworkError) as e:
+            logger.warning(f"Сетевая ошибка при отправке пользователю {user_id} (попытка {attempt + 1}): {e}")
+            await asyncio.sleep(2 ** attempt)
+        except Exception as e:
+            logger.error(f"Ошибка при отправке сообщения пользователю {user_id}: {e}")
+            return False
+    logger.error(f"Не удалось отправить сообщение пользователю {user_id} после {BROADCAST_MAX_RETRIES + 1} попыток")
+    return False
+
+
+async def send_broadcast(bot, message_text, progress_callback=None, cancel_requested=None):
     """
     Асинхронная функция для отправки сообщения всем пользователям бота.
-    
+
+    Сообщения отправляются несколькими параллельными задачами под общим
+    ограничителем частоты. Каждому пользователю уходит одно сообщение, поэтому
+    лимит Telegram на частоту в одном чате не достигается; общий лимит держит
+    ограничитель, а RetryAfter приостанавливает всю рассылку.
+
+    Прогресс сохраняется в файл: если рассылка с тем же текстом была прервана,
+    она продолжится с уже обработанных пользователей, а не начнётся заново.
+
     Args:
         bot: Объект бота Telegram
         message_text (str): Текст сообщения для рассылки
+        progress_callback: Необязательная корутина (sent, failed, total), вызываемая по мере отправки
+        cancel_requested: Необязательная функция без аргументов; если при прерывании она
+            возвращает True, рассылку отменил администратор и прогресс не сохраняется
+
+    Returns:
+        tuple: Количество успешных и неудачных отправок
     """
+    broadcast_id = _broadcast_id(message_text)
+    progress = await _read_progress()
+    if progress and progress.get("id") == broadcast_id:
+        logger.info(f"Продолжаем прерванную рассылку {broadcast_id}: уже обработано {len(progress['done'])} пользователей")
+    else:
+        if progress:
+            logger.warning(f"Незавершённая рассылка {progress.get('id')} заменена новой")
+        progress = {
+            "id": broadcast_id,
+            "text": message_text,
+            "started_at": str(datetime.now()),
+            "done": [],
+            "success": 0,
+            "failed": 0,
+        }
+
+    done = set(progress["done"])
+    # Новых пользователей могли добавить другие процессы, поэтому берём список из базы
+    await reload_users()
     users = get_users()
-    success_count = 0
-    fail_count = 0
-    
-    logger.info(f"Начало рассылки сообщения {len(users)} пользователям")
-    
-    for user_id in users:
+    pending = [user_id for user_id in users if user_id not in done]
+    total = len(done) + len(pending)
+    text = f"📢 Сообщение от администрации:\n\n{message_text}"
+
+    logger.info(f"Начало рассылки сообщения {len(pending)} пользователям (всего {total})")
+
+    limiter = TokenBucket(BROADCAST_RATE, capacity=BROADCAST_CONCURRENCY)
+    queue = asyncio.Queue()
+    for user_id in pending:
+        queue.put_nowait(user_id)
+    since_save = 0
+    sent_now = 0
+    started = time.monotonic()
+
+    async def save_progress():
+        progress["done"] = list(done)
+        await write_json(BROADCAST_PROGRESS_FILE, dict(progress))
+
+    async def worker():
+        nonlocal since_save, sent_now
+        while True:
+            try:
+                user_id = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            if await _send_one(bot, limiter, user_id, text):
+                progress["success"] += 1
+                BROADCAST_MESSAGES.inc(result="sent")
+            else:
+                progress["failed"] += 1
+                BROADCAST_MESSAGES.inc(result="failed")
+            sent_now += 1
+            BROADCAST_THROUGHPUT.set(sent_now / max(time.monotonic() - started, 1e-3))
+            done.add(user_id)
+            since_save += 1
+            if since_save >= BROADCAST_PROGRESS_SAVE_EVERY:
+                since_save = 0
+                await save_progress()
+                if progress_callback:
+                    await progress_callback(progress["success"], progress["failed"], total)
+
+    await save_progress()
+    workers = [asyncio.create_task(worker()) for _ in range(max(1, BROADCAST_CONCURRENCY))]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        # Останавливаем остальные отправки, чтобы они не продолжались после выхода из рассылки
+        for task in workers:
+            task.cancel()
+        await asyncio.shield(asyncio.gather(*workers, return_exceptions=True))
+        if cancel_requested is not None and cancel_requested():
+            # Отменена администратором — не продолжаем её после перезапуска
+            await asyncio.shield(remove(BROADCAST_PROGRESS_FILE))
+            logger.info(f"Рассылка {broadcast_id} отменена, обработано {len(done)} из {total}")
+            raise
+        # Прервано (остановка бота или ошибка) — сохраняем прогресс, чтобы потом продолжить
+        await asyncio.shield(save_progress())
+        logger.warning(f"Рассылка {broadcast_id} прервана, обработано {len(done)} из {total}")
+        raise
+
+    await remove(BROADCAST_PROGRESS_FILE)
+    success_count, fail_count = progress["success"], progress["failed"]
+    logger.info(f"Рассылка завершена. Успешно: {success_count}, Ошибок: {fail_count}")
+    if progress_callback:
+        await progress_callback(success_count, fail_count, total)
+    return success_count, fail_count
+
+
+# Статусы фоновой рассылки
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_CANCELLED = "cancelled"
+JOB_FAILED = "failed"
+
+JOB_STATUS_NAMES = {
+    JOB_QUEUED: "в очереди",
+    JOB_RUNNING: "выполняется",
+    JOB_DONE: "завершена",
+    JOB_CANCELLED: "отменена",
+    JOB_FAILED: "ошибка",
+}
+
+
+class BroadcastJob:
+    """Одна фоновая рассылка и её текущее состояние."""
+
+    def __init__(self, job_id, text, admin_chat_id=None):
+        self.job_id = job_id
+        self.text = text
+        self.admin_chat_id = admin_chat_id
+        self.status = JOB_QUEUED
+        self.sent = 0
+        self.failed = 0
+        self.total = 0
+        self.created_at = datetime.now()
+        self.finished_at = None
+        self.error = None
+        self.cancel_requested = False
+
+    @property
+    def finished(self):
+        return self.status in (JOB_DONE, JOB_CANCELLED, JOB_FAILED)
+
+    def describe(self):
+        """Краткое описание рассылки для администратора."""
+        lines = [
+            f"📊 Рассылка #{self.job_id}: {JOB_STATUS_NAMES[self.status]}",
+            f"Создана: {self.created_at:%d.%m.%Y %H:%M:%S}",
+        ]
+        if self.status != JOB_QUEUED:
+            lines.append(f"Отправлено: {self.sent}, ошибок: {self.failed}, всего: {self.total}")
+        if self.finished_at:
+            lines.append(f"Завершена: {self.finished_at:%d.%m.%Y %H:%M:%S}")
+        if self.error:
+            lines.append(f"Ошибка: {self.error}")
+        return "\n".join(lines)
+
+
+class BroadcastJobQueue:
+    """
+    Очередь фоновых рассылок.
+
+    Обработчик только ставит рассылку в очередь и сразу отвечает администратору;
+    отправка идёт в отдельной задаче цикла событий. Рассылки выполняются по одной,
+    так как лимит Telegram на частоту общий для всего бота.
+    """
+
+    def __init__(self, keep_finished=20):
+        self.keep_finished = keep_finished
+        self._jobs = {}
+        self._next_id = 1
+        self._queue = None
+        self._worker = None
+        self._current = None
+
+    def _ensure_worker(self, bot):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run(bot))
+
+    def submit(self, bot, text, admin_chat_id=None):
+        """
+        Ставит рассылку в очередь.
+
+        Returns:
+            BroadcastJob: Созданная рассылка
+        """
+        job = BroadcastJob(str(self._next_id), text, admin_chat_id)
+        self._next_id += 1
+        self._jobs[job.job_id] = job
+        self._forget_old_jobs()
+        self._ensure_worker(bot)
+        self._queue.put_nowait(job)
+        logger.info(f"Рассылка #{job.job_id} поставлена в очередь")
+        return job
+
+    async def resume_pending(self, bot):
+        """Ставит в очередь рассылку, прерванную при прошлой остановке бота."""
+        text = await get_pending_broadcast()
+        if text:
+            logger.info("Найдена незавершённая рассылка, продолжаем её в фоне")
+            return self.submit(bot, text)
+        return None
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def jobs(self):
+        return list(self._jobs.values())
+
+    def cancel(self, job_id):
+        """
+        Отменяет рассылку в очереди или прерывает выполняющуюся.
+
+        Returns:
+            bool: True, если рассылка была отменена
+        """
+        job = self._jobs.get(job_id)
+        if job is None or job.finished:
+            return False
+        job.cancel_requested = True
+        if job.status == JOB_QUEUED:
+            job.status = JOB_CANCELLED
+            job.finished_at = datetime.now()
+        elif self._current is not None and self._current[0] is job:
+            self._current[1].cancel()
+        logger.info(f"Рассылка #{job_id} отменена")
+        return True
+
+    def _forget_old_jobs(self):
+        finished = [job for job in self._jobs.values() if job.finished]
+        for job in finished[:max(0, len(finished) - self.keep_finished)]:
+            del self._jobs[job.job_id]
+
+    async def _run(self, bot):
+        while True:
+            job = await self._queue.get()
+            if job.status != JOB_QUEUED:
+                if job.cancel_requested:
+                    # Отменённая в очереди рассылка могла быть продолжением прерванной
+                    await discard_pending_broadcast(job.text)
+                continue
+            job.status = JOB_RUNNING
+
+            async def on_progress(sent, failed, total):
+                job.sent, job.failed, job.total = sent, failed, total
+
+            task = asyncio.create_task(send_broadcast(bot, job.text, on_progress, lambda: job.cancel_requested))
+            self._current = (job, task)
+            try:
+                job.sent, job.failed = await task
+                job.status = JOB_DONE
+            except asyncio.CancelledError:
+                job.status = JOB_CANCELLED
+                if not job.cancel_requested:
+                    # Отменили саму очередь (остановка бота), а не только рассылку
+                    raise
+            except Exception as e:
+                job.status = JOB_FAILED
+                job.error = str(e)
+                logger.error(f"Ошибка при выполнении рассылки #{job.job_id}: {e}")
+            finally:
+                self._current = None
+                job.finished_at = datetime.now()
+            await self._notify_admin(bot, job)
+
+    async def _notify_admin(self, bot, job):
+        if job.admin_chat_id is None:
+            return
         try:
-            await bot.send_message(
-                chat_id=user_id,
-                text=f"📢 Сообщение от администрации:\n\n{message_text}"
-            )
-            success_count += 1
-            logger.info(f"Сообщение успешно отправлено пользователю {user_id}")
+            await bot.send_message(chat_id=job.admin_chat_id, text=job.describe())
         except Exception as e:
-            fail_count += 1
-            logger.error(f"Ошибка при отправке сообщения пользователю {user_id}: {e}")
-    
-    logger.info(f"Рассылка завершена. Успешно: {success_count}, Ошибок: {fail_count}")
-    return success_count, fail_count
\ No newline at end of file
+            logger.error(f"Не удалось отправить итог рассылки #{job.job_id} администратору: {e}")
+
+    async def stop(self):
+        """Останавливает очередь; прогресс текущей рассылки сохраняется для продолжения."""
+        if self._worker is not None and not self._worker.done():
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+        self._worker = None
+
+
+# Общая очередь рассылок бота
+broadcast_jobs = BroadcastJobQueue()
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Многопроцессный режим бота с привязкой чатов к воркерам.
+
+Процесс-диспетчер принимает webhook, определяет chat_id обновления и передаёт
+его по локальной очереди (multiprocessing) в воркер с номером chat_id % N.
+Каждый воркер — отдельный процесс со своим Application и циклом событий
+(runtime.BotRuntime в отдельном потоке). Все обновления одного чата всегда
+попадают в один воркер и обрабатываются там по порядку, поэтому состояние
+диалога не теряется, а нагрузка распределяется по всем ядрам.
+
+Запуск:
+    python cluster.py --workers 4
+"""
+
+import argparse
+import asyncio
+import hmac
+import logging
+import math
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import time
+import traceback
+from aiohttp import web
+from telegram import Bot
+import cnc_luga_bot
+from cnc_luga_bot import TELEGRAM_TOKEN, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, HOST, PORT
+from health import HEALTH_QUEUE_MAX_FILL
+from metrics import counter, gauge
+
+logger = logging.getLogger(__name__)
+
+# Параметры кластера
+CLUSTER_WORKERS = int(os.getenv("CLUSTER_WORKERS", str(os.cpu_count() or 2)))
+CLUSTER_QUEUE_SIZE = int(os.getenv("CLUSTER_QUEUE_SIZE", "1000"))  # Очередь к каждому воркеру
+CLUSTER_MONITOR_INTERVAL = float(os.getenv("CLUSTER_MONITOR_INTERVAL", "5"))  # Проверка живости воркеров, секунды
+CLUSTER_STOP_TIMEOUT = float(os.getenv("CLUSTER_STOP_TIMEOUT", "30"))  # Сколько ждать остановки воркера
+# Воркер i отдаёт свои метрики на 127.0.0.1:CLUSTER_METRICS_PORT+i (0 — не отдаёт)
+CLUSTER_METRICS_PORT = int(os.getenv("CLUSTER_METRICS_PORT", "0"))
+
+CLUSTER_ROUTED = counter("cnc_cluster_updates_total", "Обновления, переданные воркерам", ["worker"])
+CLUSTER_REJECTED = counter("cnc_cluster_updates_rejected_total", "Обновления, отклонённые из-за переполненной очереди воркера", ["worker"])
+CLUSTER_RESTARTS = counter("cnc_cluster_worker_restarts_total", "Перезапуски упавших воркеров", ["worker"])
+CLUSTER_QUEUE_DEPTH = gauge("cnc_cluster_queue_depth", "Обновлений в очереди к воркеру", ["worker"])
+
+
+def extract_chat_id(data):
+    """
+    Находит chat_id в JSON обновления Telegram без его полного разбора.
+
+    Returns:
+        Optional[int]: ID чата (или пользователя, если чата нет) либо None
+    """
+    for key, value in data.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        if isinstance(value.get("chat"), dict):
+            return value["chat"].get("id")
+        # callback_query: чат лежит во вложенном сообщении
+        message = value.get("message")
+        if isinstance(message, dict) and isinstance(message.get("chat"), dict):
+            return message["chat"].get("id")
+        if isinstance(value.get("from"), dict):
+            return value["from"].get("id")
+    return None
+
+
+def _configure_worker(index, workers):
+    """
+    Разводит файлы, которые пишет каждый воркер, чтобы процессы не затирали друг друга,
+    и делит между воркерами общие для бота ограничения.
+    """
+    import broadcast
+    import handlers
+    from gpt_cache import response_cache
+    from logging_setup import setup_logging
+    from reports import report_journal
+    from tracing import exporter
+
+    # Свой файл лога: ротация одного файла из нескольких процессов теряет записи
+    setup_logging(f".w{index}")
+
+    # Незавершённую рассылку продолжает тот воркер, который её вёл
+    root, ext = os.path.splitext(broadcast.BROADCAST_PROGRESS_FILE)
+    broadcast.BROADCAST_PROGRESS_FILE = f"{root}.w{index}{ext}"
+    if response_cache.path:
+        root, ext = os.path.splitext(response_cache.path)
+        response_cache.path = f"{root}.w{index}{ext}"
+    # Журнал сообщений у каждого воркера свой, администратор видит все файлы сразу
+    root, ext = os.path.splitext(report_journal.path)
+    report_journal.path = f"{root}.w{index}{ext}"
+    if exporter.path:
+        root, ext = os.path.splitext(exporter.path)
+        exporter.path = f"{root}.w{index}{ext}"
+
+    # Очередь к Yandex GPT у каждого процесса своя: делим общий предел, чтобы в сумме
+    # воркеры не превышали VALERA_MAX_CONCURRENT (но у каждого остаётся хотя бы одно место).
+    # Частоту запросов пользователя не делим: личный чат всегда попадает в один воркер
+    handlers.valera_queue.max_concurrent = max(1, math.ceil(handlers.VALERA_MAX_CONCURRENT / workers))
+    if handlers.VALERA_QUEUE_LIMIT:
+        handlers.valera_queue.max_waiting = max(1, math.ceil(handlers.VALERA_QUEUE_LIMIT / workers))
+
+
+async def _serve_metrics(port):
+    """Поднимает в цикле событий воркера HTTP-сервер только с /metrics; живёт, пока жив цикл."""
+    metrics_app = web.Application()
+    metrics_app.router.add_get('/metrics', cnc_luga_bot.metrics)
+    runner = web.AppRunner(metrics_app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    logger.info(f"Метрики воркера доступны на 127.0.0.1:{port}/metrics")
+
+
+def worker_main(index, updates, workers):
+    """
+    Точка входа процесса-воркера: поднимает бота и обрабатывает обновления из очереди.
+
+    Args:
+        index (int): Номер воркера
+        updates (multiprocessing.Queue): Очередь обновлений от диспетчера; None — сигнал остановки
+        workers (int): Сколько всего воркеров
+    """
+    # Ctrl+C получает вся группа процессов; воркер останавливается по сигналу диспетчера
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _configure_worker(index, workers)
+    runtime = cnc_luga_bot.runtime
+    runtime.start_in_thread()
+    if CLUSTER_METRICS_PORT:
+        runtime.run_threadsafe(_serve_metrics(CLUSTER_METRICS_PORT + index)).result()
+    logger.info(f"Воркер {index} запущен (pid {os.getpid()})")
+    try:
+        while True:
+            data = updates.get()
+            if data is None:
+                break
+            try:
+                # Если очередь бота переполнена, ждём: порядок обновлений чата важнее скорости
+                while not runtime.submit_update_threadsafe(data).result():
+                    time.sleep(0.1)
+            except ValueError as e:
+                logger.error(f"Воркер {index}: некорректное обновление: {e}")
+    except Exception as e:
+        logger.error(f"Воркер {index} завершился с ошибкой: {e}")
+        logger.error(traceback.format_exc())
+    finally:
+        runtime.stop_thread(CLUSTER_STOP_TIMEOUT)
+        logger.info(f"Воркер {index} остановлен")
+
+
+class Cluster:
+    """Диспетчер: держит процессы-воркеры и распределяет обновления между ними."""
+
+    def __init__(self, workers=CLUSTER_WORKERS, queue_size=CLUSTER_QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._context = multiprocessing.get_context("spawn")
+        self._queues = [self._context.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._processes = [None] * workers
+
+    def _start_worker(self, index):
+        process = self._context.Process(
+            target=worker_main, args=(index, self._queues[index], self.workers), name=f"bot-worker-{index}"
+        )
+        process.start()
+        self._processes[index] = process
+
+    def start(self):
+        for index in range(self.workers):
+            self._start_worker(index)
+        logger.info(f"Запущено {self.workers} воркеров")
+
+    def route(self, data):
+        """
+        Отправляет обновление в воркер, отвечающий за его чат.
+
+        Returns:
+            bool: False, если очередь воркера переполнена
+        """
+        chat_id = extract_chat_id(data)
+        key = chat_id if chat_id is not None else data.get("update_id", 0)
+        try:
+            index = int(key) % self.workers
+        except (TypeError, ValueError):
+            # Некорректный id в обновлении: отдаём воркеру 0, он сам отклонит такое обновление
+            logger.warning(f"Некорректный id чата в обновлении {data.get('update_id')}: {key!r}")
+            index = 0
+        try:
+            self._queues[index].put_nowait(data)
+        except queue.Full:
+            CLUSTER_REJECTED.inc(worker=index)
+            logger.error(f"Очередь воркера {index} переполнена, обновление {data.get('update_id')} отклонено")
+            return False
+        CLUSTER_ROUTED.inc(worker=index)
+        return True
+
+    def update_queue_depth(self):
+        for index, updates in enumerate(self._queues):
+            CLUSTER_QUEUE_DEPTH.set(updates.qsize(), worker=index)
+
+    async def monitor(self):
+        """Перезапускает упавшие воркеры; их очередь сохраняется, обновления не теряются."""
+        while True:
+            await asyncio.sleep(CLUSTER_MONITOR_INTERVAL)
+            for index, process in enumerate(self._processes):
+                if process is not None and not process.is_alive():
+                    logger.error(f"Воркер {index} завершился с кодом {process.exitcode}, перезапускаем")
+                    CLUSTER_RESTARTS.inc(worker=index)
+                    self._start_worker(index)
+
+    def stop(self):
+        for index, updates in enumerate(self._queues):
+            try:
+                updates.put(None, timeout=CLUSTER_STOP_TIMEOUT)
+            except queue.Full:
+                logger.warning(f"Очередь воркера {index} переполнена, сигнал остановки не передан")
+        for index, process in enumerate(self._processes):
+            if process is None:
+                continue
+            process.join(CLUSTER_STOP_TIMEOUT)
+            if process.is_alive():
+                logger.warning(f"Воркер {index} не остановился вовремя, завершаем принудительно")
+                process.terminate()
+        logger.info("Воркеры остановлены")
+
+
+# Эндпоинт для проверки состояния диспетчера
+async def health(request):
+    cluster = request.app["cluster"]
+    alive = sum(1 for process in cluster._processes if process is not None and process.is_alive())
+    return web.Response(text=f"Cluster is running: {alive}/{cluster.workers} workers alive")
+
+
+# Живость диспетчера: он отвечает, значит его цикл событий работает
+async def health_live(request):
+    return web.json_response({"ok": True})
+
+
+# Готовность диспетчера: все воркеры живы и их очереди не переполнены
+async def health_ready(request):
+    cluster = request.app["cluster"]
+    workers = {}
+    for index, process in enumerate(cluster._processes):
+        depth = cluster._queues[index].qsize()
+        alive = process is not None and process.is_alive()
+        workers[index] = {"alive": alive, "depth": depth, "ok": alive and depth < cluster.queue_size * HEALTH_QUEUE_MAX_FILL}
+    ok = all(worker["ok"] for worker in workers.values())
+    return web.json_response({"ok": ok, "workers": workers}, status=200 if ok else 503)
+
+
+# Метрики диспетчера; метрики обработки обновлений отдают сами воркеры (CLUSTER_METRICS_PORT)
+async def metrics(request):
+    request.app["cluster"].update_queue_depth()
+    return await cnc_luga_bot.metrics(request)
+
+
+# Webhook-эндпоинт диспетчера: проверяем секрет и передаём обновление нужному воркеру
+async def webhook(request):
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(secret, WEBHOOK_SECRET):
+        logger.warning(f"Webhook запрос с неверным секретом от {request.remote}")
+        return web.json_response({"status": "forbidden"}, status=403)
+
+    try:
+        data = await request.json()
+    except ValueError as e:
+        logger.error(f"Некорректное обновление в webhook: {e}")
+        return web.json_response({"status": "error", "message": "bad update"}, status=400)
+    if not isinstance(data, dict):
+        return web.json_response({"status": "error", "message": "bad update"}, status=400)
+
+    if not request.app["cluster"].route(data):
+        # Очередь воркера переполнена, Telegram повторит доставку позже
+        return web.json_response({"status": "busy"}, status=503)
+    return web.json_response({"status": "ok"})
+
+
+# Эндпоинт для установки webhook
+async def set_webhook(request):
+    if not WEBHOOK_URL:
+        return web.Response(text="WEBHOOK_URL не задан в переменных окружения", status=400)
+    try:
+        async with Bot(TELEGRAM_TOKEN) as bot:
+            await bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+        logger.info(f"Webhook успешно установлен на {WEBHOOK_URL}")
+        return web.Response(text="Webhook установлен")
+    except Exception as e:
+        logger.error(f"Ошибка при установке webhook: {e}")
+        return web.Response(text=str(e), status=500)
+
+
+async def on_startup(app):
+    cluster = app["cluster"]
+    cluster.start()
+    app["monitor"] = asyncio.create_task(cluster.monitor())
+
+
+async def on_cleanup(app):
+    app["monitor"].cancel()
+    await asyncio.gather(app["monitor"], return_exceptions=True)
+    await asyncio.to_thread(app["cluster"].stop)
+
+
+def create_app(workers=CLUSTER_WORKERS):
+    web_app = web.Application()
+    web_app["cluster"] = Cluster(workers)
+    web_app.router.add_get('/', health)
+    web_app.router.add_get('/health', health)
+    web_app.router.add_get('/health/live', health_live)
+    web_app.router.add_get('/health/ready', health_ready)
+    web_app.router.add_get('/metrics', metrics)
+    web_app.router.add_post(WEBHOOK_PATH, webhook)
+    web_app.router.add_get('/set_webhook', set_webhook)
+    web_app.on_startup.append(on_startup)
+    web_app.on_cleanup.append(on_cleanup)
+    return web_app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CNC Luga Telegram Bot — многопроцессный режим")
+    parser.add_argument("--workers", type=int, default=CLUSTER_WORKERS, help="число процессов-воркеров")
+    args = parser.parse_args()
+
+    logger.info(f"Запуск диспетчера с {args.workers} воркерами...")
+    try:
+        web.run_app(create_app(args.workers), host=HOST, port=PORT)
+    except Exception as e:
+        logger.error(f"Ошибка при запуске диспетчера: {e}")
+        logger.error(traceback.format_exc())
+        sys.exit(1)
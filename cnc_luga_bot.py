@@ -1,22 +1,34 @@
+import argparse
+import asyncio
+import hashlib
+import hmac
 import logging
 import os
 import sys
 import traceback
-from handlers import register_handlers
-from flask import Flask, request, jsonify
+from logging_setup import setup_logging
+# Логи всех модулей пишет фоновый поток (см. logging_setup.py); настраиваем до импорта
+# модулей бота, чтобы не потерять их первые записи
+setup_logging()
+from handlers import register_handlers, stop_background_tasks
+from gpt_api import gpt_client, gpt_breakers, gpt_operations_breaker
+from gpt_cache import response_cache
+from users import init_users, close_users
+from reports import close_reports, migrate_legacy_reports
+from storage import read_text, run_io, shutdown_storage
+from broadcast import broadcast_jobs
+from sessions import sessions
+from runtime import BotRuntime
+from health import HealthChecker, loop_monitor
+from metrics import CONTENT_TYPE, counter, histogram, render
+from tracing import close_tracing, span
+from profiling import ProfileBusyError, profile
+from aiohttp import web
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.ext import Application, ContextTypes
+from telegram.request import HTTPXRequest
 from dotenv import load_dotenv
 
-# Настраиваем логирование для отладки
-logging.basicConfig(
-    level=logging.DEBUG,  # Изменяем уровень на DEBUG для более подробных логов
-    format='%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s',
-    handlers=[
-        logging.FileHandler("bot.log", encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
 # Загрузка переменных окружения
@@ -30,11 +42,54 @@ if not TELEGRAM_TOKEN:
     logger.critical("TBOT_TOKEN не найден в переменных окружения")
     raise ValueError("TBOT_TOKEN не найден в переменных окружения")
 
-# Создаём Flask-приложение
-app = Flask(__name__)
+# Параметры webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Публичный адрес, например https://your-domain.com/webhook
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Секрет, который Telegram присылает в заголовке X-Telegram-Bot-Api-Secret-Token.
+# Если не задан, выводится из токена бота, чтобы webhook всегда был защищён
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(TELEGRAM_TOKEN.encode()).hexdigest()[:32]
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
+
+# Очередь обновлений и число задач, которые их обрабатывают
+# (в режиме long polling UPDATE_WORKERS — предел одновременно обрабатываемых обновлений)
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+UPDATE_DRAIN_TIMEOUT = float(os.getenv("UPDATE_DRAIN_TIMEOUT", "10"))  # Сколько ждать обработки очереди при остановке
+# Обрабатывать обновления одного чата строго по очереди
+UPDATE_PER_CHAT_ORDER = os.getenv("UPDATE_PER_CHAT_ORDER", "1") == "1"
+# Держать бота в отдельном потоке со своим циклом событий, независимо от цикла веб-сервера
+BOT_LOOP_THREAD = os.getenv("BOT_LOOP_THREAD", "0") == "1"
+# Токен для /debug/profile в заголовке X-Profile-Token; если не задан, эндпоинт выключен
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+
+TELEGRAM_SECONDS = histogram("cnc_telegram_request_seconds", "Длительность запроса к Bot API Telegram", ["method"])
+TELEGRAM_RESPONSES = counter("cnc_telegram_responses_total", "Ответы Bot API Telegram по коду статуса", ["method", "status"])
+
 
-# Создание приложения Telegram
-application = Application.builder().token(TELEGRAM_TOKEN).build()
+class InstrumentedRequest(HTTPXRequest):
+    """HTTP-клиент бота, который записывает длительность и статус каждого запроса к Bot API."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        with TELEGRAM_SECONDS.time(method=api_method), span(f"telegram.{api_method}") as request_span:
+            try:
+                status, payload = await super().do_request(url, method, *args, **kwargs)
+            except Exception as e:
+                TELEGRAM_RESPONSES.inc(method=api_method, status=type(e).__name__)
+                raise
+        TELEGRAM_RESPONSES.inc(method=api_method, status=status)
+        request_span.set(status=status)
+        return status, payload
+
+
+# Создание приложения Telegram. concurrent_updates действует в режиме long polling:
+# медленный ответ Валеры в одном чате не задерживает остальные.
+# Пул соединений как у клиента по умолчанию; getUpdates идёт отдельным клиентом и в метрики не попадает
+application = (
+    Application.builder().token(TELEGRAM_TOKEN).concurrent_updates(UPDATE_WORKERS)
+    .request(InstrumentedRequest(connection_pool_size=256)).build()
+)
 
 # Обработчик ошибок
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -46,75 +101,232 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         )
 
 # Подключаем все обработчики из handlers.py
-async def init_bot():
-    global application
-    
+def setup_handlers():
     # Регистрируем обработчики
     register_handlers(application)
     
     # Обработчик ошибок
     application.add_error_handler(error_handler)
+
+# Открываем ресурсы, которые нужны обработчикам
+async def open_resources():
+    # Открываем пул соединений к API Яндекс GPT
+    await gpt_client.start()
+    
+    # Открываем базу пользователей и загружаем индекс в память
+    await run_io(init_users)
+    
+    # Переносим сообщения из прежнего reports.txt в журнал (один раз)
+    await run_io(migrate_legacy_reports)
+    
+    # Загружаем сохранённый кэш ответов Валеры
+    await response_cache.load()
+    
+    # Следим за задержкой цикла событий бота (для /health и /metrics)
+    loop_monitor.start()
+
+# Закрываем ресурсы после остановки приложения
+async def close_resources():
+    await loop_monitor.stop()
+    
+    # Закрываем пул соединений к API Яндекс GPT
+    await gpt_client.close()
+    
+    # Сохраняем кэш ответов Валеры на диск
+    await response_cache.save()
+    stats = response_cache.stats()
+    logger.info(f"Кэш ответов: {stats['size']} записей, попаданий {stats['hits']}, промахов {stats['misses']}")
+    
+    # Закрываем базу пользователей и хранилище сессий
+    close_users()
+    await sessions.close()
+    
+    # Дописываем журнал анонимных сообщений и трассы
+    await close_reports()
+    await close_tracing()
+    
+    # Дожидаемся незавершённых операций с диском
+    shutdown_storage()
+
+async def init_bot():
+    setup_handlers()
+    await open_resources()
     
     # Инициализация приложения
     await application.initialize()
     await application.start()
     
+    # Продолжаем рассылку, прерванную при прошлой остановке
+    await broadcast_jobs.resume_pending(application.bot)
+    
     logger.info("Бот успешно инициализирован")
 
-# Инициализируем бота при запуске Flask-приложения
-with app.app_context():
-    import asyncio
-    asyncio.run(init_bot())
-
-# Эндпоинт для инициализации бота
-@app.route('/init', methods=['GET'])
-async def init():
-    await init_bot()
-    return "Bot initialized"
-
-# Эндпоинт для проверки состояния бота
-@app.route('/health', methods=['GET'])
-async def health():
-    return "Bot is running"
-
-# Health check для проверки работоспособности
-@app.route('/')
-async def health_check():
-    logger.info("Получен запрос на проверку работоспособности")
-    return "OK"
-
-# Webhook-эндпоинт для Telegram с токеном бота в URL
-@app.route('/8161940788:AAE2l_4-4ZEovz2ukD4NF1IeAmHe_9emUiQ', methods=['POST'])
-async def webhook():
-    logger.info("Получен webhook запрос")
-    if request.method == "POST":
-        try:
-            update = Update.de_json(request.get_json(), application.bot)
-            await application.process_update(update)
-            return jsonify({"status": "ok"})
-        except Exception as e:
-            logger.error(f"Ошибка при обработке webhook: {e}")
-            return jsonify({"status": "error", "message": str(e)}), 500
-    return "OK"
+# Останавливаем бота и освобождаем ресурсы
+async def shutdown_bot():
+    # Останавливаем фоновые рассылки (прогресс сохранится для продолжения) и ожидание долгих ответов
+    await broadcast_jobs.stop()
+    await stop_background_tasks()
+    
+    try:
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+    except Exception as e:
+        logger.error(f"Ошибка при остановке приложения: {e}")
+    
+    await close_resources()
+    
+    logger.info("Бот остановлен")
+
+# Владелец цикла событий бота: очередь обновлений, обработчики, запуск и остановка
+runtime = BotRuntime(
+    application, init_bot, shutdown_bot,
+    workers=UPDATE_WORKERS, queue_size=UPDATE_QUEUE_SIZE, drain_timeout=UPDATE_DRAIN_TIMEOUT,
+    ordered=UPDATE_PER_CHAT_ORDER
+)
+
+# Запуск бота и обработчиков очереди вместе с веб-сервером
+async def on_startup(app):
+    if BOT_LOOP_THREAD:
+        # Бот получает свой цикл событий в отдельном потоке, веб-сервер только принимает запросы
+        await asyncio.to_thread(runtime.start_in_thread)
+    else:
+        await runtime.startup()
+
+# Остановка веб-сервера: дорабатываем очередь и останавливаем бота
+async def on_cleanup(app):
+    if runtime.threaded:
+        await asyncio.to_thread(runtime.stop_thread)
+    else:
+        await runtime.shutdown()
+
+# Проверки живости и готовности; Яндекс GPT оценивается по выключателям, без запросов к нему
+health_checker = HealthChecker(
+    runtime, lambda: {**{b.name: b for b in gpt_breakers.values()}, gpt_operations_breaker.name: gpt_operations_breaker}
+)
+
+# Живость: процесс отвечает, цикл событий бота не завис; без ввода-вывода
+async def health_live(request):
+    result = health_checker.live()
+    return web.json_response(result, status=200 if result["ok"] else 503)
+
+# Готовность принимать обновления: Telegram, диск, очередь, цикл событий, Яндекс GPT
+async def health_ready(request):
+    result = await health_checker.ready()
+    return web.json_response(result, status=200 if result["ok"] else 503)
+
+# Метрики процесса в формате Prometheus
+async def metrics(request):
+    return web.Response(body=render().encode("utf-8"), headers={"Content-Type": CONTENT_TYPE})
+
+# Профилирование бота: /debug/profile?seconds=30&mode=sampler|cprofile&format=text|collapsed
+async def debug_profile(request):
+    token = request.headers.get("X-Profile-Token", "")
+    if not PROFILE_TOKEN or not hmac.compare_digest(token, PROFILE_TOKEN):
+        return web.json_response({"status": "forbidden"}, status=403)
+    try:
+        seconds = float(request.query.get("seconds", "30"))
+        # Замер запускается в цикле событий бота, чтобы cprofile видел его обработчики
+        result = await runtime.run(profile(seconds, request.query.get("mode", "sampler")))
+    except ValueError as e:
+        return web.json_response({"status": "error", "message": str(e)}, status=400)
+    except ProfileBusyError as e:
+        return web.json_response({"status": "busy", "message": str(e)}, status=409)
+    if request.query.get("format") == "collapsed" and "collapsed" in result.files:
+        text = await read_text(result.files["collapsed"], "")
+        return web.Response(text=text)
+    return web.Response(text=result.summary + "\n\nФайлы: " + ", ".join(result.files.values()) + "\n")
+
+# Webhook-эндпоинт для Telegram: проверяем секрет, ставим обновление в очередь и сразу отвечаем
+async def webhook(request):
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(secret, WEBHOOK_SECRET):
+        logger.warning(f"Webhook запрос с неверным секретом от {request.remote}")
+        return web.json_response({"status": "forbidden"}, status=403)
+    
+    try:
+        data = await request.json()
+        accepted = await runtime.accept(data)
+    except ValueError as e:
+        logger.error(f"Некорректное обновление в webhook: {e}")
+        return web.json_response({"status": "error", "message": "bad update"}, status=400)
+    
+    if not accepted:
+        # Очередь переполнена, Telegram повторит доставку позже
+        return web.json_response({"status": "busy"}, status=503)
+    
+    return web.json_response({"status": "ok"})
 
 # Эндпоинт для установки webhook
-@app.route('/set_webhook', methods=['GET'])
-async def set_webhook():
+async def set_webhook(request):
+    if not WEBHOOK_URL:
+        return web.Response(text="WEBHOOK_URL не задан в переменных окружения", status=400)
     try:
-        webhook_url = "https://755d-109-172-30-15.ngrok-free.app/8161940788:AAE2l_4-4ZEovz2ukD4NF1IeAmHe_9emUiQ"
-        await application.bot.set_webhook(url=webhook_url)
-        logger.info(f"Webhook успешно установлен на {webhook_url}")
-        return "Webhook установлен"
+        await runtime.run(application.bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET))
+        logger.info(f"Webhook успешно установлен на {WEBHOOK_URL}")
+        return web.Response(text="Webhook установлен")
     except Exception as e:
         logger.error(f"Ошибка при установке webhook: {e}")
-        return str(e), 500
+        return web.Response(text=str(e), status=500)
+
+# Создаём aiohttp-приложение
+def create_app():
+    web_app = web.Application()
+    web_app.router.add_get('/', health_live)
+    web_app.router.add_get('/health', health_ready)
+    web_app.router.add_get('/health/live', health_live)
+    web_app.router.add_get('/health/ready', health_ready)
+    web_app.router.add_get('/metrics', metrics)
+    web_app.router.add_get('/debug/profile', debug_profile)
+    web_app.router.add_post(WEBHOOK_PATH, webhook)
+    web_app.router.add_get('/set_webhook', set_webhook)
+    web_app.on_startup.append(on_startup)
+    web_app.on_cleanup.append(on_cleanup)
+    return web_app
+
+# Приложение для gunicorn: gunicorn --worker-class aiohttp.worker.GunicornWebWorker cnc_luga_bot:app
+app = create_app()
+
+# Хуки жизненного цикла для режима long polling: Application запускает и останавливает себя сам
+async def polling_post_init(app_bot):
+    await open_resources()
+    await broadcast_jobs.resume_pending(app_bot.bot)
+    logger.info("Бот успешно инициализирован (long polling)")
+
+async def polling_post_stop(app_bot):
+    await broadcast_jobs.stop()
+    await stop_background_tasks()
+
+async def polling_post_shutdown(app_bot):
+    await close_resources()
+    logger.info("Бот остановлен")
+
+# Запуск в режиме long polling без веб-сервера
+def run_polling():
+    setup_handlers()
+    application.post_init = polling_post_init
+    application.post_stop = polling_post_stop
+    application.post_shutdown = polling_post_shutdown
+    logger.info(f"Запуск в режиме long polling, одновременно обрабатывается до {UPDATE_WORKERS} обновлений")
+    # start_polling сам снимает установленный webhook
+    application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CNC Luga Telegram Bot")
+    parser.add_argument(
+        "--polling", action="store_true",
+        help="получать обновления через long polling вместо webhook (без веб-сервера)"
+    )
+    args = parser.parse_args()
+    
     logger.info("Бот запущен...")
     try:
-        # Запускаем Flask
-        app.run(host='0.0.0.0', port=8000)
+        if args.polling:
+            run_polling()
+        else:
+            # Запускаем aiohttp-сервер: бот, очередь и обработчики живут в одном цикле событий
+            web.run_app(app, host=HOST, port=PORT)
     except Exception as e:
         logger.error(f"Ошибка при запуске бота: {e}")
         logger.error(traceback.format_exc())
-        sys.exit(1)
\ No newline at end of file
+        sys.exit(1)
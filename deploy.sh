@@ -78,7 +78,7 @@ After=network.target
 User=www-data
 Group=www-data
 WorkingDirectory=/opt/cnc_luga_bot
-ExecStart=/opt/cnc_luga_bot/venv/bin/gunicorn --bind 0.0.0.0:8000 cnc_luga_bot:app
+ExecStart=/opt/cnc_luga_bot/venv/bin/gunicorn --bind 0.0.0.0:8000 --worker-class aiohttp.worker.GunicornWebWorker cnc_luga_bot:app
 Restart=always
 RestartSec=10
 StandardOutput=syslog
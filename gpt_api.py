@@ -2,18 +2,18 @@ import logging
 import os
 import aiohttp
 import asyncio
+import json
+import time
 import traceback
 from dotenv import load_dotenv
-
-# Настройка логирования
-logging.basicConfig(
-    level=logging.DEBUG,  # Изменяем уровень на DEBUG для более подробных логов
-    format='%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s',
-    handlers=[
-        logging.FileHandler("gpt_api.log", encoding='utf-8'),
-        logging.StreamHandler()
-    ]
+from metrics import counter
+from model_router import model_router
+from tracing import current_span, span, traced
+from resilience import (
+    CircuitBreaker, CircuitOpenError, LatencyTracker, RetryPolicy, TransientError,
+    call_with_resilience, parse_retry_after
 )
+
 logger = logging.getLogger(__name__)
 
 # Загрузка переменных окружения
@@ -28,75 +28,568 @@ if not YANDEX_API_KEY or not YANDEX_FOLDER_ID:
     logger.critical("❌ Ошибка: Не удалось загрузить YANDEX_API_KEY или YANDEX_FOLDER_ID из переменных окружения")
     raise ValueError("❌ Ошибка: Не удалось загрузить YANDEX_API_KEY или YANDEX_FOLDER_ID из переменных окружения")
 
+# Адреса API Яндекс GPT (переопределяются, например, для локального mock_yandex.py)
+YANDEX_GPT_BASE_URL = os.getenv("YANDEX_GPT_BASE_URL", "https://llm.api.cloud.yandex.net").rstrip("/")
+YANDEX_OPERATION_URL = os.getenv("YANDEX_OPERATION_URL", "https://operation.api.cloud.yandex.net/operations").rstrip("/")
 # URL для запросов к API Яндекс GPT
-YANDEX_GPT_URL = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+YANDEX_GPT_URL = f"{YANDEX_GPT_BASE_URL}/foundationModels/v1/completion"
+# Асинхронный режим: запрос возвращает id операции, результат забирается позже
+YANDEX_GPT_ASYNC_URL = f"{YANDEX_GPT_BASE_URL}/foundationModels/v1/completionAsync"
+
+# Параметры пула соединений к API Яндекс GPT
+GPT_POOL_LIMIT = int(os.getenv("GPT_POOL_LIMIT", "100"))  # Всего соединений в пуле
+GPT_POOL_LIMIT_PER_HOST = int(os.getenv("GPT_POOL_LIMIT_PER_HOST", "20"))  # Соединений на один хост
+GPT_DNS_CACHE_TTL = int(os.getenv("GPT_DNS_CACHE_TTL", "300"))  # Время жизни DNS-кэша, секунды
+GPT_KEEPALIVE_TIMEOUT = float(os.getenv("GPT_KEEPALIVE_TIMEOUT", "60"))  # Простой keep-alive соединения, секунды
+GPT_STREAM_TIMEOUT = float(os.getenv("GPT_STREAM_TIMEOUT", "120"))  # Общий таймаут потокового ответа, секунды
+
+# Устойчивость к сбоям API: повторы, автоматический выключатель и подстраховочные запросы
+GPT_MAX_RETRIES = int(os.getenv("GPT_MAX_RETRIES", "2"))  # Повторов после временной ошибки (429, 5xx, таймаут)
+GPT_BACKOFF_BASE = float(os.getenv("GPT_BACKOFF_BASE", "0.5"))  # Базовая задержка перед повтором, секунды
+GPT_BACKOFF_MAX = float(os.getenv("GPT_BACKOFF_MAX", "10"))  # Максимальная задержка; больший Retry-After — без повтора
+GPT_BREAKER_THRESHOLD = int(os.getenv("GPT_BREAKER_THRESHOLD", "5"))  # Ошибок подряд до размыкания
+GPT_BREAKER_RESET = float(os.getenv("GPT_BREAKER_RESET", "30"))  # Через сколько секунд пробовать снова
+GPT_HEDGE = os.getenv("GPT_HEDGE", "0") == "1"  # Подстраховочный запрос для медленных ответов (тратит квоту)
+GPT_HEDGE_PERCENTILE = float(os.getenv("GPT_HEDGE_PERCENTILE", "0.95"))  # Перцентиль длительности, после которого он отправляется
+GPT_HEDGE_MIN_DELAY = float(os.getenv("GPT_HEDGE_MIN_DELAY", "2"))  # Но не раньше, секунды
+
+# Асинхронные операции для долгих ответов: auto — для длинных вопросов и G-кода, always или off
+GPT_ASYNC_MODE = os.getenv("GPT_ASYNC_MODE", "auto")
+GPT_ASYNC_TIMEOUT = float(os.getenv("GPT_ASYNC_TIMEOUT", "300"))  # Сколько ждать готовности операции, секунды
+GPT_ASYNC_POLL_INITIAL = float(os.getenv("GPT_ASYNC_POLL_INITIAL", "1"))  # Первая пауза между опросами, секунды
+GPT_ASYNC_POLL_MAX = float(os.getenv("GPT_ASYNC_POLL_MAX", "10"))  # Максимальная пауза между опросами, секунды
+
+# Причины выбора модели, при которых ответ будет долгим
+_LONG_GENERATION_REASONS = ("long", "gcode")
+
+# Статусы, при которых запрос стоит повторить
+_RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# Каждая попытка, включая повторы: код статуса HTTP, timeout или connection_error
+GPT_HTTP_RESPONSES = counter(
+    "cnc_gpt_http_responses_total", "Ответы API Яндекс GPT по виду запроса и коду статуса", ["endpoint", "status"]
+)
+
+
+def _endpoint_label(url):
+    if url == YANDEX_GPT_URL:
+        return "completion"
+    if url == YANDEX_GPT_ASYNC_URL:
+        return "completion_async"
+    return "operation"
+
 
-async def yandex_gpt_request(prompt):
+class YandexGPTClient:
     """
-    Асинхронная функция для отправки запроса к API Яндекс GPT.
+    Долгоживущий HTTP-клиент для API Яндекс GPT.
+    
+    Держит одну сессию aiohttp с пулом keep-alive соединений и кэшем DNS,
+    поэтому запросы не тратят время на DNS, TCP и TLS при каждом вопросе.
+    Сессия создаётся при старте бота (start) и закрывается при остановке (close).
+    """
+    
+    def __init__(self, limit=GPT_POOL_LIMIT, limit_per_host=GPT_POOL_LIMIT_PER_HOST,
+                 dns_cache_ttl=GPT_DNS_CACHE_TTL, keepalive_timeout=GPT_KEEPALIVE_TIMEOUT):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self._session = None
+        self._loop = None
+    
+    def _create_session(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            ttl_dns_cache=self.dns_cache_ttl,
+            use_dns_cache=True,
+            keepalive_timeout=self.keepalive_timeout,
+        )
+        self._session = aiohttp.ClientSession(connector=connector)
+        self._loop = asyncio.get_running_loop()
+        logger.info(
+            f"Создана сессия aiohttp для API Яндекс GPT "
+            f"(limit={self.limit}, limit_per_host={self.limit_per_host}, dns_ttl={self.dns_cache_ttl})"
+        )
+    
+    async def start(self):
+        """Создаёт сессию заранее, чтобы первый вопрос не ждал её создания."""
+        await self.get_session()
+    
+    async def get_session(self):
+        """
+        Возвращает общую сессию aiohttp, при необходимости создавая её.
+        
+        Сессия привязана к циклу событий, в котором была создана. Если запрос
+        пришёл из другого цикла, создаётся новая сессия для этого цикла.
+        
+        Returns:
+            aiohttp.ClientSession: Сессия с пулом соединений
+        """
+        if self._session is None or self._session.closed:
+            self._create_session()
+        elif self._loop is not asyncio.get_running_loop():
+            logger.warning("Сессия aiohttp создана в другом цикле событий, создаём новую")
+            self._create_session()
+        return self._session
+    
+    async def close(self):
+        """Закрывает сессию и все соединения пула."""
+        if self._session is not None and not self._session.closed:
+            if self._loop is asyncio.get_running_loop():
+                await self._session.close()
+                logger.info("Сессия aiohttp для API Яндекс GPT закрыта")
+            else:
+                logger.warning("Сессия aiohttp принадлежит другому циклу событий и не может быть закрыта из текущего")
+        self._session = None
+        self._loop = None
+
+
+# Общий клиент для всех запросов к API Яндекс GPT
+gpt_client = YandexGPTClient()
+
+# Политика повторов для запросов к API; выключатель и статистика длительностей — свои у каждой модели
+gpt_retry_policy = RetryPolicy(GPT_MAX_RETRIES, GPT_BACKOFF_BASE, GPT_BACKOFF_MAX)
+# Создание асинхронной операции не идемпотентно: после таймаута операция могла быть создана,
+# и повтор запустил бы вторую (платную). Повторяем, только если сервис запрос точно не принял
+gpt_submit_retry_policy = RetryPolicy(GPT_MAX_RETRIES, GPT_BACKOFF_BASE, GPT_BACKOFF_MAX, only_rejected=True)
+gpt_breakers = {}
+gpt_latencies = {}
+
+
+# Сервис операций отдельный от моделей, поэтому у него свой выключатель
+gpt_operations_breaker = CircuitBreaker("Яндекс GPT (операции)", GPT_BREAKER_THRESHOLD, GPT_BREAKER_RESET)
+
+
+def _resilience_for(model):
+    if model not in gpt_breakers:
+        gpt_breakers[model] = CircuitBreaker(f"Яндекс GPT ({model})", GPT_BREAKER_THRESHOLD, GPT_BREAKER_RESET)
+        gpt_latencies[model] = LatencyTracker()
+    return gpt_breakers[model], gpt_latencies[model]
+
+
+def _choose_model(prompt, model):
+    if model:
+        return model_router.choice_for(model, "explicit")
+    return model_router.choose(_as_messages(prompt))
+
+class YandexGPTError(Exception):
+    """Ошибка при обращении к API Яндекс GPT. Текст исключения можно показать пользователю."""
+
+
+def _as_messages(prompt):
+    """Приводит промпт к списку сообщений API: строка становится одним сообщением пользователя."""
+    if isinstance(prompt, str):
+        return [{"role": "user", "text": prompt}]
+    return prompt
+
+
+def _prompt_length(prompt):
+    return sum(len(message["text"]) for message in _as_messages(prompt))
+
+
+def _build_request(prompt, stream=False, model="yandexgpt-lite"):
+    """
+    Формирует заголовки и тело запроса к API Яндекс GPT.
     
     Args:
-        prompt (str): Текст запроса для отправки в API
+        prompt (str | list): Текст запроса или список сообщений {"role", "text"}
+        stream (bool): Запросить ответ потоком
+        model (str): Имя модели, например yandexgpt-lite или yandexgpt
         
     Returns:
-        str: Ответ от API или сообщение об ошибке
+        tuple: Заголовки и тело запроса
     """
-    logger.debug(f"Отправка запроса к API Яндекс GPT, длина промпта: {len(prompt)} символов")
-    logger.debug(f"Промпт: {prompt[:500]}...")  # Логируем первые 500 символов промпта
-    
     headers = {
         "Authorization": f"Api-Key {YANDEX_API_KEY}",
         "Content-Type": "application/json"
     }
     
     data = {
-        "modelUri": f"gpt://{YANDEX_FOLDER_ID}/yandexgpt-lite",
+        "modelUri": f"gpt://{YANDEX_FOLDER_ID}/{model}",
         "completionOptions": {
-            "stream": False,
+            "stream": stream,
             "temperature": 0.6,
             "maxTokens": "2000"
         },
-        "messages": [
-            {
-                "role": "user",
-                "text": prompt
-            }
-        ]
+        "messages": _as_messages(prompt)
     }
+    return headers, data
+
+
+def _extract_usage(response_json):
+    """Возвращает result.usage ответа API (число токенов запроса и ответа), если оно есть."""
+    try:
+        return response_json["result"].get("usage")
+    except (KeyError, AttributeError, TypeError):
+        return None
+
+
+def _extract_alternative_text(result):
+    try:
+        alternative = result["alternatives"][0]
+    except (KeyError, IndexError, TypeError):
+        return None
+    message = alternative.get("message")
+    if isinstance(message, dict) and "text" in message:
+        return message["text"]
+    return alternative.get("text")
+
+
+def _extract_text(response_json):
+    """
+    Достаёт текст первой альтернативы из ответа API.
     
+    API возвращает текст в alternatives[0].message.text, старые версии —
+    в alternatives[0].text; поддерживаются оба варианта.
+    
+    Returns:
+        Optional[str]: Текст ответа или None, если ответ некорректный
+    """
     try:
-        async with aiohttp.ClientSession() as session:
-            logger.debug("Создана сессия aiohttp")
-            async with session.post(YANDEX_GPT_URL, json=data, headers=headers, timeout=30) as response:
-                logger.debug(f"Получен ответ от API, статус: {response.status}")
-                if response.status == 200:
-                    response_json = await response.json()
-                    logger.debug(f"Получен JSON ответ: {response_json}")
-                    if "result" in response_json and "alternatives" in response_json["result"]:
-                        answer = response_json["result"]["alternatives"][0]["text"]
-                        logger.info(f"Получен ответ от API Яндекс GPT, длина ответа: {len(answer)} символов")
-                        logger.debug(f"Ответ: {answer[:500]}...")  # Логируем первые 500 символов ответа
-                        return answer
-                    else:
-                        error_msg = f"Некорректный ответ от API: {response_json}"
-                        logger.error(error_msg)
-                        return "Ошибка обработки запроса. Проверь настройки API."
-                else:
-                    error_text = await response.text()
-                    error_msg = f"Ошибка при запросе к API Яндекс GPT: {response.status} - {error_text}"
-                    logger.error(error_msg)
-                    return f"Ошибка при запросе к API: {response.status}"
-    except asyncio.TimeoutError:
-        error_msg = "Таймаут при запросе к API Яндекс GPT"
-        logger.error(error_msg)
-        logger.error(traceback.format_exc())
-        return "Ошибка: запрос к API занял слишком много времени."
+        return _extract_alternative_text(response_json["result"])
+    except (KeyError, TypeError):
+        return None
+
+
+@traced("gpt.http")
+async def _json_attempt(method, url, timeout_seconds, **kwargs):
+    """Одна попытка запроса к API, возвращающего JSON (отправка операции или её опрос)."""
+    session = await gpt_client.get_session()
+    timeout = aiohttp.ClientTimeout(total=timeout_seconds)
+    endpoint = _endpoint_label(url)
+    try:
+        async with session.request(method, url, timeout=timeout, **kwargs) as response:
+            logger.debug("Получен ответ от API, статус: %s", response.status)
+            GPT_HTTP_RESPONSES.inc(endpoint=endpoint, status=response.status)
+            current_span().set(endpoint=endpoint, status=response.status)
+            if response.status == 200:
+                return await response.json()
+            error_text = await response.text()
+            logger.error(f"Ошибка при запросе к API Яндекс GPT ({method} {url}): {response.status} - {error_text}")
+            if response.status in _RETRYABLE_STATUSES:
+                raise TransientError(
+                    f"статус {response.status}", parse_retry_after(response.headers.get("Retry-After")), rejected=True
+                )
+            raise YandexGPTError(f"Ошибка при запросе к API: {response.status}")
+    except asyncio.TimeoutError as e:
+        GPT_HTTP_RESPONSES.inc(endpoint=endpoint, status="timeout")
+        raise TransientError("таймаут") from e
+    except aiohttp.ClientError as e:
+        GPT_HTTP_RESPONSES.inc(endpoint=endpoint, status="connection_error")
+        # Соединение не установилось — запрос точно не отправлен
+        raise TransientError(f"ошибка соединения: {e}", rejected=isinstance(e, aiohttp.ClientConnectorError)) from e
+
+
+async def _completion_attempt(data, headers, timeout_seconds):
+    """
+    Одна попытка запроса к API.
+    
+    Returns:
+        dict: JSON ответа
+        
+    Raises:
+        TransientError: Временная ошибка, запрос можно повторить
+        YandexGPTError: Ошибка, которую повтор не исправит
+    """
+    return await _json_attempt("POST", YANDEX_GPT_URL, timeout_seconds, json=data, headers=headers)
+
+
+@traced("gpt.request")
+async def yandex_gpt_request(prompt, model=None):
+    """
+    Асинхронная функция для отправки запроса к API Яндекс GPT.
+    
+    Модель выбирает model_router, если она не указана явно. Временные ошибки
+    (429, 5xx, таймауты) повторяются с задержкой, пока API недоступен,
+    запросы сразу отклоняются выключателем модели.
+    
+    Args:
+        prompt (str | list): Текст запроса или список сообщений {"role", "text"}
+        model (Optional[str]): Модель; по умолчанию выбирается по сложности вопроса
+        
+    Returns:
+        str: Ответ от API или сообщение об ошибке
+    """
+    choice = _choose_model(prompt, model)
+    current_span().set(model=choice.model, reason=choice.reason)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Отправка запроса к API Яндекс GPT (%s, %s), длина промпта: %d символов",
+                     choice.model, choice.reason, _prompt_length(prompt))
+        logger.debug("Промпт: %.500s...", _as_messages(prompt)[-1]['text'])  # Первые 500 символов последнего сообщения
+    
+    headers, data = _build_request(prompt, model=choice.model)
+    breaker, latency = _resilience_for(choice.model)
+    started = time.monotonic()
+    
+    try:
+        response_json = await call_with_resilience(
+            lambda: _completion_attempt(data, headers, choice.timeout), gpt_retry_policy, breaker, latency,
+            hedge_percentile=GPT_HEDGE_PERCENTILE if GPT_HEDGE else None, hedge_min_delay=GPT_HEDGE_MIN_DELAY
+        )
+        logger.debug("Получен JSON ответ: %.1000s", response_json)
+        answer = _extract_text(response_json)
+        if answer is not None:
+            model_router.record(choice.model, time.monotonic() - started, True, _extract_usage(response_json))
+            logger.info("Получен ответ от API Яндекс GPT (%s), длина ответа: %d символов", choice.model, len(answer))
+            logger.debug("Ответ: %.500s...", answer)  # Первые 500 символов ответа
+            return answer
+        else:
+            model_router.record(choice.model, time.monotonic() - started, False)
+            error_msg = f"Некорректный ответ от API: {response_json}"
+            logger.error(error_msg)
+            return "Ошибка обработки запроса. Проверь настройки API."
+    except CircuitOpenError as e:
+        model_router.record(choice.model, time.monotonic() - started, False)
+        logger.error(str(e))
+        return "Ошибка: сервис Яндекс GPT временно недоступен. Попробуйте через минуту."
+    except YandexGPTError as e:
+        model_router.record(choice.model, time.monotonic() - started, False)
+        return str(e)
+    except TransientError as e:
+        model_router.record(choice.model, time.monotonic() - started, False)
+        if isinstance(e.__cause__, asyncio.TimeoutError):
+            logger.error(f"Таймаут при запросе к API Яндекс GPT ({choice.model})")
+            return "Ошибка: запрос к API занял слишком много времени."
+        logger.error(f"Запрос к API Яндекс GPT не удался после повторов: {e}")
+        return f"Ошибка при запросе к API: {e}"
     except Exception as e:
+        model_router.record(choice.model, time.monotonic() - started, False)
         error_msg = f"Ошибка при запросе к API Яндекс GPT: {e}"
         logger.error(error_msg)
         logger.error(traceback.format_exc())
         return f"Ошибка при выполнении запроса к API: {str(e)}"
 
+@traced("gpt.http")
+async def _open_stream_attempt(data, headers, timeout_seconds):
+    """
+    Одна попытка открыть потоковый ответ API.
+    
+    Returns:
+        aiohttp.ClientResponse: Ответ со статусом 200; вызывающий должен его закрыть
+        
+    Raises:
+        TransientError: Временная ошибка, запрос можно повторить
+        YandexGPTError: Ошибка, которую повтор не исправит
+    """
+    session = await gpt_client.get_session()
+    # Общий таймаут больше обычного: длинный ответ идёт потоком, а зависание ловит sock_read
+    timeout = aiohttp.ClientTimeout(total=GPT_STREAM_TIMEOUT, sock_read=timeout_seconds)
+    try:
+        response = await session.post(YANDEX_GPT_URL, json=data, headers=headers, timeout=timeout)
+    except asyncio.TimeoutError as e:
+        GPT_HTTP_RESPONSES.inc(endpoint="stream", status="timeout")
+        raise TransientError("таймаут") from e
+    except aiohttp.ClientError as e:
+        GPT_HTTP_RESPONSES.inc(endpoint="stream", status="connection_error")
+        raise TransientError(f"ошибка соединения: {e}", rejected=isinstance(e, aiohttp.ClientConnectorError)) from e
+    logger.debug("Получен ответ от API, статус: %s", response.status)
+    GPT_HTTP_RESPONSES.inc(endpoint="stream", status=response.status)
+    current_span().set(endpoint="stream", status=response.status)
+    if response.status == 200:
+        return response
+    async with response:
+        error_text = await response.text()
+    logger.error(f"Ошибка при потоковом запросе к API Яндекс GPT: {response.status} - {error_text}")
+    if response.status in _RETRYABLE_STATUSES:
+        raise TransientError(
+            f"статус {response.status}", parse_retry_after(response.headers.get("Retry-After")), rejected=True
+        )
+    raise YandexGPTError(f"Ошибка при запросе к API: {response.status}")
+
+async def yandex_gpt_stream(prompt, model=None):
+    """
+    Асинхронный генератор, получающий ответ Яндекс GPT потоком.
+    
+    API присылает по одному JSON-объекту на строку, в каждом — весь текст,
+    сгенерированный к этому моменту. Генератор отдаёт накопленный текст
+    после каждого фрагмента, поэтому первые слова доступны сразу.
+    
+    Args:
+        prompt (str | list): Текст запроса или список сообщений {"role", "text"}
+        model (Optional[str]): Модель; по умолчанию выбирается по сложности вопроса
+        
+    Yields:
+        str: Текст ответа, полученный на текущий момент
+        
+    Raises:
+        YandexGPTError: Если запрос завершился ошибкой
+    """
+    choice = _choose_model(prompt, model)
+    logger.debug("Отправка потокового запроса к API Яндекс GPT (%s, %s), длина промпта: %d символов",
+                 choice.model, choice.reason, _prompt_length(prompt))
+    
+    headers, data = _build_request(prompt, stream=True, model=choice.model)
+    breaker, _ = _resilience_for(choice.model)
+    text = ""
+    usage = None
+    started = time.monotonic()
+    # Отрезок не делаем текущим: между порциями ответа управление у вызывающего кода
+    stream_span = span("gpt.stream", model=choice.model, reason=choice.reason)
+    
+    try:
+        # Повторяем только установку соединения: после первых слов ответ уже показан пользователю
+        response = await call_with_resilience(
+            lambda: _open_stream_attempt(data, headers, choice.timeout), gpt_retry_policy, breaker
+        )
+        async with response:
+            async for line in response.content:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    chunk = json.loads(line)
+                except ValueError:
+                    logger.warning(f"Не удалось разобрать фрагмент потока: {line[:200]!r}")
+                    continue
+                if "error" in chunk:
+                    logger.error(f"API Яндекс GPT вернул ошибку в потоке: {chunk['error']}")
+                    raise YandexGPTError("Ошибка обработки запроса. Проверь настройки API.")
+                usage = _extract_usage(chunk) or usage
+                chunk_text = _extract_text(chunk)
+                if chunk_text is None:
+                    continue
+                # Обычно фрагмент содержит весь текст целиком, но на всякий случай поддерживаем и приращения
+                text = chunk_text if chunk_text.startswith(text) else text + chunk_text
+                yield text
+    except YandexGPTError:
+        model_router.record(choice.model, time.monotonic() - started, False)
+        raise
+    except CircuitOpenError as e:
+        model_router.record(choice.model, time.monotonic() - started, False)
+        logger.error(str(e))
+        raise YandexGPTError("Ошибка: сервис Яндекс GPT временно недоступен. Попробуйте через минуту.")
+    except TransientError as e:
+        model_router.record(choice.model, time.monotonic() - started, False)
+        logger.error(f"Потоковый запрос к API Яндекс GPT не удался после повторов: {e}")
+        if isinstance(e.__cause__, asyncio.TimeoutError):
+            raise YandexGPTError("Ошибка: запрос к API занял слишком много времени.")
+        raise YandexGPTError(f"Ошибка при запросе к API: {e}")
+    except asyncio.TimeoutError:
+        model_router.record(choice.model, time.monotonic() - started, False)
+        logger.error("Таймаут при потоковом запросе к API Яндекс GPT")
+        raise YandexGPTError("Ошибка: запрос к API занял слишком много времени.")
+    except Exception as e:
+        model_router.record(choice.model, time.monotonic() - started, False)
+        logger.error(f"Ошибка при потоковом запросе к API Яндекс GPT: {e}")
+        logger.error(traceback.format_exc())
+        raise YandexGPTError(f"Ошибка при выполнении запроса к API: {str(e)}")
+    finally:
+        stream_span.set(chars=len(text))
+        stream_span.finish()
+    
+    if not text:
+        logger.error("Поток от API Яндекс GPT завершился без текста")
+        model_router.record(choice.model, time.monotonic() - started, False)
+        raise YandexGPTError("Ошибка обработки запроса. Проверь настройки API.")
+    model_router.record(choice.model, time.monotonic() - started, True, usage)
+    logger.info("Получен потоковый ответ от API Яндекс GPT (%s), длина ответа: %d символов", choice.model, len(text))
+
+def gpt_async_choice(prompt):
+    """
+    Решает, запрашивать ли ответ асинхронной операцией.
+    
+    Returns:
+        Optional[ModelChoice]: Выбранная модель, если ответ стоит получать асинхронно, иначе None
+    """
+    if GPT_ASYNC_MODE == "off":
+        return None
+    choice = _choose_model(prompt, None)
+    if GPT_ASYNC_MODE == "always" or choice.reason in _LONG_GENERATION_REASONS:
+        return choice
+    return None
+
+@traced("gpt.submit")
+async def yandex_gpt_submit(prompt, model=None):
+    """
+    Отправляет запрос асинхронной операцией и сразу возвращает её id.
+    
+    Returns:
+        tuple: (id операции, имя модели)
+        
+    Raises:
+        YandexGPTError: Если операцию не удалось создать
+    """
+    choice = _choose_model(prompt, model)
+    headers, data = _build_request(prompt, model=choice.model)
+    breaker, _ = _resilience_for(choice.model)
+    started = time.monotonic()
+    try:
+        operation = await call_with_resilience(
+            lambda: _json_attempt("POST", YANDEX_GPT_ASYNC_URL, model_router.timeouts.get(choice.model, 30),
+                                  json=data, headers=headers),
+            gpt_submit_retry_policy, breaker
+        )
+    except CircuitOpenError as e:
+        model_router.record(choice.model, time.monotonic() - started, False)
+        logger.error(str(e))
+        raise YandexGPTError("Ошибка: сервис Яндекс GPT временно недоступен. Попробуйте через минуту.")
+    except TransientError as e:
+        model_router.record(choice.model, time.monotonic() - started, False)
+        logger.error(f"Не удалось создать операцию Яндекс GPT: {e}")
+        raise YandexGPTError(f"Ошибка при запросе к API: {e}")
+    except YandexGPTError:
+        model_router.record(choice.model, time.monotonic() - started, False)
+        raise
+    operation_id = operation.get("id") if isinstance(operation, dict) else None
+    if not operation_id:
+        model_router.record(choice.model, time.monotonic() - started, False)
+        logger.error(f"Некорректный ответ при создании операции: {operation}")
+        raise YandexGPTError("Ошибка обработки запроса. Проверь настройки API.")
+    logger.info("Создана операция Яндекс GPT %s (%s, %s)", operation_id, choice.model, choice.reason)
+    return operation_id, choice.model
+
+@traced("gpt.poll")
+async def yandex_gpt_poll(operation_id, model, timeout=GPT_ASYNC_TIMEOUT):
+    """
+    Опрашивает асинхронную операцию с нарастающей паузой, пока не будет готов ответ.
+    
+    Returns:
+        str: Текст ответа
+        
+    Raises:
+        YandexGPTError: Если операция завершилась ошибкой или не успела за timeout секунд
+    """
+    headers = {"Authorization": f"Api-Key {YANDEX_API_KEY}"}
+    url = f"{YANDEX_OPERATION_URL}/{operation_id}"
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    delay = GPT_ASYNC_POLL_INITIAL
+    while True:
+        await asyncio.sleep(delay)
+        try:
+            operation = await call_with_resilience(
+                lambda: _json_attempt("GET", url, 30, headers=headers), gpt_retry_policy, gpt_operations_breaker
+            )
+        except (CircuitOpenError, TransientError) as e:
+            # Опрос не удался, но операция продолжает выполняться — попробуем позже
+            logger.warning(f"Опрос операции {operation_id} не удался: {e}")
+            operation = {}
+        except YandexGPTError:
+            model_router.record(model, loop.time() - started, False)
+            raise
+        
+        if operation.get("done"):
+            if "error" in operation:
+                logger.error(f"Операция {operation_id} завершилась ошибкой: {operation['error']}")
+                model_router.record(model, loop.time() - started, False)
+                raise YandexGPTError("Ошибка обработки запроса. Проверь настройки API.")
+            response = operation.get("response") or {}
+            answer = _extract_alternative_text(response)
+            if answer is None:
+                logger.error(f"Некорректный результат операции {operation_id}: {operation}")
+                model_router.record(model, loop.time() - started, False)
+                raise YandexGPTError("Ошибка обработки запроса. Проверь настройки API.")
+            model_router.record(model, loop.time() - started, True, response.get("usage"))
+            logger.info("Операция %s готова за %.1f с, длина ответа: %d символов", operation_id, loop.time() - started, len(answer))
+            return answer
+        
+        if loop.time() - started + delay > timeout:
+            model_router.record(model, loop.time() - started, False)
+            logger.error(f"Операция {operation_id} не завершилась за {timeout:.0f} с")
+            raise YandexGPTError("Ошибка: запрос к API занял слишком много времени.")
+        delay = min(GPT_ASYNC_POLL_MAX, delay * 1.5)
+
 async def yandex_gpt_request_async(prompt, callback):
     """
     Асинхронная функция для отправки запроса к API Яндекс GPT с callback.
@@ -106,9 +599,9 @@ async def yandex_gpt_request_async(prompt, callback):
         callback (function): Функция обратного вызова, которая будет вызвана с результатом
     """
     try:
-        logger.debug(f"Начало асинхронного запроса к API Яндекс GPT")
+        logger.debug("Начало асинхронного запроса к API Яндекс GPT")
         result = await yandex_gpt_request(prompt)
-        logger.debug(f"Вызов callback с результатом длиной {len(result) if result else 0} символов")
+        logger.debug("Вызов callback с результатом длиной %d символов", len(result) if result else 0)
         await callback(result)
     except Exception as e:
         error_msg = f"Ошибка в асинхронном запросе к API Яндекс GPT: {e}"
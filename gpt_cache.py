@@ -0,0 +1,156 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+import traceback
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from storage import read_json, write_json
+
+logger = logging.getLogger(__name__)
+
+# Параметры кэша ответов Яндекс GPT
+GPT_CACHE_SIZE = int(os.getenv("GPT_CACHE_SIZE", "1000"))  # Максимум записей, 0 — кэш выключен
+GPT_CACHE_TTL = float(os.getenv("GPT_CACHE_TTL", "86400"))  # Время жизни записи, секунды
+GPT_CACHE_MAX_HISTORY = int(os.getenv("GPT_CACHE_MAX_HISTORY", "0"))  # Кэшируем только при короткой истории
+GPT_CACHE_FILE = os.getenv("GPT_CACHE_FILE", "gpt_cache.json")  # Пустая строка — без хранения на диске
+GPT_CACHE_SAVE_EVERY = int(os.getenv("GPT_CACHE_SAVE_EVERY", "20"))  # Сохранять на диск каждые N новых записей
+
+_PUNCTUATION_RE = re.compile(r"[^\w\s]", re.UNICODE)
+_SPACES_RE = re.compile(r"\s+")
+
+
+def normalize_question(text: str) -> str:
+    """
+    Приводит вопрос к каноническому виду для поиска в кэше.
+
+    Регистр, "ё", знаки препинания и лишние пробелы не влияют на результат:
+    "Режимы резания  для 12Х18Н10Т?" и "режимы резания для 12х18н10т" дают одну строку.
+    """
+    text = text.lower().replace("ё", "е")
+    text = _PUNCTUATION_RE.sub(" ", text)
+    return _SPACES_RE.sub(" ", text).strip()
+
+
+class ResponseCache:
+    """
+    LRU-кэш ответов Яндекс GPT с ограничением размера и временем жизни записей.
+
+    Ключ — нормализованный вопрос вместе с (короткой) историей диалога.
+    Записи можно сохранять в JSON-файл, чтобы кэш переживал перезапуск бота.
+    """
+
+    def __init__(self, max_size: int = GPT_CACHE_SIZE, ttl: float = GPT_CACHE_TTL,
+                 max_history: int = GPT_CACHE_MAX_HISTORY, path: Optional[str] = GPT_CACHE_FILE,
+                 save_every: int = GPT_CACHE_SAVE_EVERY):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_history = max_history
+        self.path = path or None
+        self.save_every = save_every
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._unsaved = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def make_key(self, question: str, history: List) -> Optional[str]:
+        """
+        Строит ключ кэша для вопроса.
+
+        Returns:
+            Optional[str]: Ключ или None, если история слишком длинная и ответ кэшировать нельзя
+        """
+        if not self.enabled or len(history) > self.max_history:
+            return None
+        payload = json.dumps(
+            {"q": normalize_question(question), "h": [normalize_question(str(item)) for item in history]},
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: Optional[str]) -> Optional[str]:
+        """Возвращает ответ из кэша или None. Устаревшие записи удаляются."""
+        if key is None:
+            return None
+        entry = self._entries.get(key)
+        if entry is not None:
+            answer, created_at = entry
+            if time.time() - created_at <= self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                logger.debug("Попадание в кэш ответов (%d попаданий, %d промахов)", self.hits, self.misses)
+                return answer
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def set(self, key: Optional[str], answer: str) -> None:
+        """Сохраняет ответ, вытесняя самые давно использованные записи при переполнении."""
+        if key is None or not answer:
+            return
+        self._entries[key] = (answer, time.time())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        self._unsaved += 1
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def _purge_expired(self) -> None:
+        now = time.time()
+        expired = [key for key, (_, created_at) in self._entries.items() if now - created_at > self.ttl]
+        for key in expired:
+            del self._entries[key]
+
+    async def load(self) -> None:
+        """Загружает кэш с диска, если задан файл."""
+        if not self.enabled or not self.path:
+            return
+        try:
+            items = await read_json(self.path, default=[])
+            for key, answer, created_at in items:
+                self._entries[key] = (answer, created_at)
+            self._purge_expired()
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            logger.info(f"Загружено {len(self._entries)} записей кэша ответов из {self.path}")
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке кэша ответов: {e}")
+            logger.error(traceback.format_exc())
+
+    async def save(self) -> None:
+        """Сохраняет кэш на диск в пуле потоков хранилища, не блокируя цикл событий."""
+        if not self.enabled or not self.path:
+            return
+        self._purge_expired()
+        # Порядок записей сохраняется, чтобы после загрузки LRU-очередь была той же
+        items = [[key, answer, created_at] for key, (answer, created_at) in self._entries.items()]
+        self._unsaved = 0
+        try:
+            await write_json(self.path, items)
+            logger.debug("Сохранено %d записей кэша ответов в %s", len(items), self.path)
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении кэша ответов: {e}")
+            logger.error(traceback.format_exc())
+
+    async def maybe_save(self) -> None:
+        """Сохраняет кэш, если накопилось достаточно новых записей."""
+        if self._unsaved >= self.save_every:
+            await self.save()
+
+
+# Общий кэш ответов Валеры
+response_cache = ResponseCache()
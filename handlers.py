@@ -1,25 +1,44 @@
+import asyncio
+import hashlib
 import logging
 import os
+import time
+from collections import OrderedDict
+from datetime import date
+from pathlib import Path
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, CommandHandler, MessageHandler, filters, CallbackQueryHandler
+from telegram.error import BadRequest, RetryAfter
 from dotenv import load_dotenv
-from gpt_api import yandex_gpt_request, yandex_gpt_request_async
-from news import get_news, update_news
-from reports import save_report
+from gpt_api import (
+    yandex_gpt_request, yandex_gpt_request_async, yandex_gpt_stream, YandexGPTError,
+    gpt_async_choice, yandex_gpt_submit, yandex_gpt_poll
+)
+from gpt_cache import response_cache
+from news import get_news_page, update_news
+from reports import save_report, list_reports, search_reports
 from users import add_user
+from broadcast import broadcast_jobs
+from sessions import Session, sessions
+from prompt_builder import build_messages, make_turn, ROLE_USER, ROLE_ASSISTANT
+from rate_limit import FairQueue, KeyedRateLimiter, QueueFullError
+from model_router import model_router
+from metrics import counter, histogram, timed
+from tracing import TRACE_BUFFER_SIZE, current_span, exporter, format_trace, format_trace_summary, span, traced
+from profiling import PROFILE_MAX_SECONDS, ProfileBusyError, parse_profile_args, profile
 import traceback
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.DEBUG,  # Изменяем уровень на DEBUG для более подробных логов
-    format='%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s',
-    handlers=[
-        logging.FileHandler("handlers.log", encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
+HANDLER_SECONDS = histogram("cnc_handler_seconds", "Время работы обработчика", ["handler"])
+HANDLER_ERRORS = counter("cnc_handler_errors_total", "Обработчики, завершившиеся исключением", ["handler"])
+
+
+def tracked(handler):
+    """Записывает время работы и ошибки обработчика в метрики и отрезок трассы под его именем."""
+    timed_handler = timed(HANDLER_SECONDS, HANDLER_ERRORS, handler=handler.__name__)(handler)
+    return traced(handler.__name__, new_trace=True)(timed_handler)
+
 # Константы для состояний пользователя
 USER_STATE_NONE = "none"
 USER_STATE_VALERA = "valera"
@@ -28,8 +47,45 @@ USER_STATE_REPORT = "report"
 USER_STATE_UPDATE_NEWS = "update_news"
 USER_STATE_BROADCAST = "broadcast"
 
-# Словарь для хранения истории диалогов пользователей
-user_contexts = {}
+# Сессии пользователей (режим и история диалога) хранятся в sessions, см. SESSION_BACKEND
+
+# Потоковая выдача ответов Валеры: ответ появляется по мере генерации
+VALERA_STREAMING = os.getenv("VALERA_STREAMING", "1") == "1"
+# Минимальный интервал между правками сообщения, секунды (Telegram ограничивает частоту правок в чате)
+VALERA_STREAM_EDIT_INTERVAL = float(os.getenv("VALERA_STREAM_EDIT_INTERVAL", "1.5"))
+# Максимальная длина одного сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Ограничения запросов к Валере: частота для одного пользователя и число одновременных запросов к Yandex GPT
+VALERA_USER_RATE = float(os.getenv("VALERA_USER_RATE", "6"))  # Запросов в минуту на пользователя
+VALERA_USER_BURST = float(os.getenv("VALERA_USER_BURST", "3"))  # Сколько запросов можно отправить подряд
+VALERA_MAX_CONCURRENT = int(os.getenv("VALERA_MAX_CONCURRENT", "4"))  # Одновременных запросов к Yandex GPT
+VALERA_QUEUE_LIMIT = int(os.getenv("VALERA_QUEUE_LIMIT", "200"))  # Запросов в очереди, 0 — без ограничения
+
+# Частота запросов каждого пользователя
+valera_user_limiter = KeyedRateLimiter(VALERA_USER_RATE / 60, VALERA_USER_BURST)
+# Общая очередь к Yandex GPT: свободные места раздаются пользователям по кругу
+valera_queue = FairQueue(VALERA_MAX_CONCURRENT, max_waiting=VALERA_QUEUE_LIMIT)
+
+# ID администраторов через запятую; если список пуст, админские команды недоступны никому
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if user_id}
+# Просмотр анонимных сообщений: записей на странице и сколько символов каждой показывать
+REPORTS_PAGE_SIZE = int(os.getenv("REPORTS_PAGE_SIZE", "5"))
+REPORT_PREVIEW_CHARS = 600
+# Сколько трасс показывает /trace
+TRACE_LIST_SIZE = int(os.getenv("TRACE_LIST_SIZE", "10"))
+# Запросы поиска по сообщениям для кнопок листания (callback_data ограничена 64 байтами)
+_report_queries = OrderedDict()
+_REPORT_QUERIES_LIMIT = 100
+
+def is_admin(user_id):
+    return user_id in ADMIN_IDS
+
+# Сбрасываем сессию пользователя и переводим его в новый режим
+async def set_user_state(chat_id, role):
+    session = Session(role)
+    await sessions.save(chat_id, session)
+    return session
 
 # Создаём главное меню с кнопками
 def main_menu():
@@ -50,10 +106,11 @@ def commands_menu():
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
 # Обработчик команды /start
+@tracked
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await add_user(update.effective_chat.id)
     # Сбрасываем контекст пользователя при старте
-    user_contexts[update.effective_chat.id] = {"role": USER_STATE_NONE, "history": []}
+    await set_user_state(update.effective_chat.id, USER_STATE_NONE)
     logger.info(f"Пользователь {update.effective_chat.id} запустил бота")
     
     WELCOME_MESSAGE = (
@@ -72,6 +129,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(WELCOME_MESSAGE, parse_mode='Markdown', reply_markup=main_menu())
 
 # Обработчик команды /help
+@tracked
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     HELP_MESSAGE = (
         "🤖 *CNC Luga Bot - Помощник в мире ЧПУ и трудовых вопросов*\n\n"
@@ -90,88 +148,254 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(HELP_MESSAGE, parse_mode='Markdown', reply_markup=main_menu())
 
 # Обработчик кнопки "📋 Меню"
+@tracked
 async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Выберите команду:", reply_markup=commands_menu())
 
 # Обработчик кнопки "↩️ Назад"
+@tracked
 async def back_to_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Главное меню:", reply_markup=main_menu())
 
 # Обработчик кнопок меню
+@tracked
 async def handle_menu_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     text = update.message.text
-    logger.info(f"Пользователь {chat_id} нажал кнопку: {text}")
+    logger.info("Пользователь %s нажал кнопку: %s", chat_id, text)
     
     # Сбрасываем контекст пользователя при выборе нового персонажа
     if text == "📸 Валера":
-        user_contexts[chat_id] = {"role": USER_STATE_VALERA, "history": []}
+        await set_user_state(chat_id, USER_STATE_VALERA)
         await valera_start(update, context)
     elif text == "🔴 Аноним":
-        user_contexts[chat_id] = {"role": USER_STATE_REPORT, "history": []}
+        await set_user_state(chat_id, USER_STATE_REPORT)
         await report_start(update, context)
 
 # 📸 Валера — начало диалога
+@tracked
 async def valera_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     logger.info(f"Пользователь {chat_id} запустил диалог с Валерой")
     
     # Сбрасываем контекст пользователя
-    user_contexts[chat_id] = {"role": USER_STATE_VALERA, "history": []}
+    await set_user_state(chat_id, USER_STATE_VALERA)
     await update.message.reply_text(
         "Введите название инструмента, вопрос по ЧПУ или отправьте фото чертежа для помощи с программированием:",
         reply_markup=ReplyKeyboardRemove()
     )
 
+# Делим длинный ответ на части, которые помещаются в одно сообщение Telegram
+def split_message(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    parts = []
+    while len(text) > limit:
+        # Стараемся резать по переносу строки, чтобы не рвать абзацы
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    if text or not parts:
+        parts.append(text)
+    return parts
+
+# Правка сообщения, которая не падает на ограничениях Telegram
+async def safe_edit(message, text):
+    """
+    Редактирует сообщение, игнорируя "message is not modified".
+    
+    Returns:
+        float: Сколько секунд Telegram просит подождать до следующей правки (0, если ограничения нет)
+    """
+    try:
+        await message.edit_text(text)
+    except RetryAfter as e:
+        logger.warning(f"Telegram ограничил частоту правок, ждём {e.retry_after} с")
+        return float(e.retry_after)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            logger.warning(f"Не удалось отредактировать сообщение: {e}")
+    return 0.0
+
+# Потоковое получение ответа Валеры с постепенным обновлением processing_message
+async def stream_valera_answer(processing_message, messages):
+    """
+    Получает ответ от Yandex GPT потоком и показывает его по мере генерации.
+    
+    Сообщение правится не чаще, чем раз в VALERA_STREAM_EDIT_INTERVAL секунд;
+    первая порция текста показывается сразу.
+    
+    Returns:
+        str: Полный текст ответа
+    """
+    loop = asyncio.get_running_loop()
+    next_edit_at = 0.0
+    shown = ""
+    answer = ""
+    
+    async for answer in yandex_gpt_stream(messages):
+        now = loop.time()
+        if now < next_edit_at or answer == shown:
+            continue
+        # Пока ответ генерируется, показываем его начало с курсором
+        preview = answer[:TELEGRAM_MESSAGE_LIMIT - 2] + " ▌"
+        retry_after = await safe_edit(processing_message, preview)
+        shown = answer
+        next_edit_at = now + max(VALERA_STREAM_EDIT_INTERVAL, retry_after)
+    
+    return answer
+
+# Отправка готового ответа: первая часть заменяет processing_message, остальные идут отдельными сообщениями
+async def deliver_answer(update: Update, processing_message, answer):
+    parts = split_message(answer)
+    retry_after = await safe_edit(processing_message, parts[0])
+    if retry_after:
+        await asyncio.sleep(retry_after)
+        await safe_edit(processing_message, parts[0])
+    for part in parts[1:]:
+        await update.message.reply_text(part)
+
+# Фоновые задачи, которые доставляют долгие ответы Валеры после завершения обработчика
+_background_tasks = set()
+
+def spawn_background(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def stop_background_tasks():
+    """Отменяет недоставленные долгие ответы при остановке бота."""
+    tasks = list(_background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if tasks:
+        logger.warning(f"При остановке отменено {len(tasks)} недоставленных долгих ответов")
+
+# Запоминаем вопрос и ответ в истории диалога
+async def remember_exchange(chat_id, user_message, response):
+    session = await sessions.get(chat_id) or Session(USER_STATE_VALERA)
+    session.history.append(make_turn(ROLE_USER, user_message))
+    session.history.append(make_turn(ROLE_ASSISTANT, response))
+    
+    # Ограничиваем историю последними 10 сообщениями (5 пар вопрос-ответ)
+    if len(session.history) > 10:
+        session.history = session.history[-10:]
+    await sessions.save(chat_id, session)
+
+# Дожидаемся асинхронной операции Яндекс GPT и доставляем ответ, не занимая обработчик обновлений
+@tracked
+async def finish_long_answer(update: Update, processing_message, user_message, cache_key, operation_id, model):
+    chat_id = update.effective_chat.id
+    try:
+        response = await yandex_gpt_poll(operation_id, model)
+    except YandexGPTError as e:
+        await safe_edit(processing_message, f"❌ {e}")
+        return
+    except asyncio.CancelledError:
+        await safe_edit(processing_message, "❌ Бот перезапускается, ответ не успел подготовиться. Спросите ещё раз чуть позже.")
+        raise
+    
+    try:
+        await deliver_answer(update, processing_message, response)
+        response_cache.set(cache_key, response)
+        await response_cache.maybe_save()
+        await remember_exchange(chat_id, user_message, response)
+    except Exception as e:
+        logger.error(f"Ошибка при доставке долгого ответа пользователю {chat_id}: {e}")
+        logger.error(traceback.format_exc())
+
 # Логика общения с Валерой
+@tracked
 async def valera_ai(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик для взаимодействия с ИИ."""
     try:
         user_message = update.message.text
         chat_id = update.effective_chat.id
-        logger.info(f"Получено сообщение от пользователя {update.effective_user.id}: {user_message}")
+        user_id = update.effective_user.id
+        logger.info("Получено сообщение от пользователя %s: %.200s", user_id, user_message)
+        
+        # Слишком частые запросы отклоняем сразу, не расходуя квоту Yandex GPT
+        if not valera_user_limiter.try_acquire(user_id):
+            wait = max(1, round(valera_user_limiter.wait_time(user_id)))
+            logger.info("Пользователь %s превысил частоту запросов к Валере", user_id)
+            await update.message.reply_text(f"⏳ Не так быстро! Валера ещё думает над прошлым. Спросите снова через {wait} с.")
+            return
         
         # Отправляем сообщение о начале обработки
         processing_message = await update.message.reply_text("🤔 Обрабатываю ваш запрос...")
         
-        # Системный промпт для Валеры
-        system_prompt = (
-            "Ты — Валера, суровый, но добрый помощник. Ты опытный наладчик ЧПУ, программист и юрист, который прошёл через всё. "
-            "Отвечаешь строго, с юмором и сарказмом, как настоящий наставник. Если пользователь пишет ерунду — мягко подкалываешь, но всегда помогаешь. "
-            "Отвечай по темам ЧПУ, металлообработки, выбора инструмента, режимов резания (Vc, F, Ap, RPM, СОЖ), G-кода, наладки станков и программирования. "
-            "Также ты — юридический защитник. Отвечай на вопросы о правах работников в РФ, жалобах, увольнении, больничных, трудовых конфликтах. "
-            "Если вопрос юридический — защищай пользователя, поддерживай, дай понять, что он не один. "
-            "Если вопрос технический — объясни чётко, с примерами и смыслом. "
-            "Если вопрос неполный — **обязательно уточняй**. Если непонятный — **переспрашивай**. "
-            "Будь как хороший наставник в цеху: ворчливый, но надёжный. Не пиши воду, а сразу план: что делать, куда идти, как поступить. "
-            "Добавляй примеры, шаги, конкретику. В конце каждого ответа — придумай **одну уникальную мотивирующую фразу в своём стиле**:\n"
-            "Примеры: 'Давай, не подведи!', 'Ты не один, я рядом с клавиатурой!', 'Ну ты и кадр... но с тобой весело!'.\n"
-            "Фраза должна быть каждый раз новой и в твоем стиле."
-        )
-        
         # Получаем историю диалога
-        history = user_contexts[chat_id]["history"]
-        history_text = "\n".join(history) if history else ""
+        session = await sessions.get(chat_id) or Session(USER_STATE_VALERA)
+        history = session.history
         
-        # Формируем полный промпт
-        full_prompt = f"{system_prompt}\n\nИстория диалога:\n{history_text}\n\nВопрос пользователя: {user_message}"
+        # Формируем сообщения для API: системная роль, история в пределах бюджета токенов и вопрос
+        with span("prompt.build", history=len(history)):
+            messages = build_messages(user_message, history)
         
-        # Получаем ответ от Yandex GPT
-        response = await yandex_gpt_request(full_prompt)
+        # Повторяющиеся вопросы без длинной истории отдаём из кэша
+        cache_key = response_cache.make_key(user_message, history)
+        response = response_cache.get(cache_key)
+        current_span().set(cache_hit=bool(response))
         
         if response:
-            # Удаляем сообщение о обработке
-            await processing_message.delete()
-            # Отправляем ответ пользователю
-            await update.message.reply_text(response)
+            logger.info("Ответ для пользователя %s взят из кэша", chat_id)
+            await deliver_answer(update, processing_message, response)
+        else:
+            async def show_position(position):
+                try:
+                    await safe_edit(processing_message, f"⏳ Валера отвечает другим. Вы в очереди, позиция {position}")
+                except Exception as e:
+                    logger.warning(f"Не удалось показать позицию в очереди: {e}")
             
-            # Обновляем историю диалога
-            user_contexts[chat_id]["history"].append(f"Пользователь: {user_message}")
-            user_contexts[chat_id]["history"].append(f"Валера: {response}")
+            # Долгие ответы (длинные вопросы, разбор G-кода) получаем асинхронной операцией в фоне
+            long_choice = gpt_async_choice(messages)
+            queued_at = time.monotonic()
+            try:
+                async with valera_queue.slot(user_id, on_wait=show_position):
+                    current_span().set(queue_wait=round(time.monotonic() - queued_at, 3))
+                    if long_choice is not None:
+                        try:
+                            operation_id, model = await yandex_gpt_submit(messages, model=long_choice.model)
+                        except YandexGPTError as e:
+                            await safe_edit(processing_message, f"❌ {e}")
+                            return
+                        await safe_edit(processing_message, "🛠 Вопрос серьёзный, Валера готовит подробный ответ. Пришлю, как только будет готово.")
+                        spawn_background(finish_long_answer(update, processing_message, user_message, cache_key, operation_id, model))
+                        return
+                    if VALERA_STREAMING:
+                        # Получаем ответ потоком, показывая текст по мере генерации
+                        try:
+                            response = await stream_valera_answer(processing_message, messages)
+                        except YandexGPTError as e:
+                            await safe_edit(processing_message, f"❌ {e}")
+                            return
+                    else:
+                        # Получаем ответ от Yandex GPT целиком
+                        response = await yandex_gpt_request(messages)
+            except QueueFullError:
+                logger.warning(f"Очередь к Валере заполнена, запрос пользователя {user_id} отклонён")
+                await safe_edit(processing_message, "❌ Валера сейчас завален вопросами. Попробуйте через пару минут.")
+                return
             
-            # Ограничиваем историю последними 10 сообщениями (5 пар вопрос-ответ)
-            if len(user_contexts[chat_id]["history"]) > 10:
-                user_contexts[chat_id]["history"] = user_contexts[chat_id]["history"][-10:]
+            if VALERA_STREAMING:
+                await deliver_answer(update, processing_message, response)
+                response_cache.set(cache_key, response)
+            elif response:
+                # Удаляем сообщение о обработке
+                await processing_message.delete()
+                # Отправляем ответ пользователю
+                await update.message.reply_text(response)
+                # yandex_gpt_request возвращает ошибки текстом, начинающимся с "Ошибка" — их не кэшируем
+                if not response.startswith("Ошибка"):
+                    response_cache.set(cache_key, response)
+        
+        await response_cache.maybe_save()
+        
+        if response:
+            # Обновляем историю диалога
+            await remember_exchange(chat_id, user_message, response)
         else:
             await processing_message.edit_text("❌ Извините, произошла ошибка при обработке запроса. Попробуйте позже.")
             
@@ -180,23 +404,26 @@ async def valera_ai(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text("❌ Произошла ошибка при обработке запроса. Попробуйте позже.")
 
 # 🔴 Аноним — начало
+@tracked
 async def report_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     logger.info(f"Пользователь {chat_id} запустил диалог с Анонимом")
     
     # Сбрасываем контекст пользователя
-    user_contexts[chat_id] = {"role": USER_STATE_REPORT, "history": []}
+    await set_user_state(chat_id, USER_STATE_REPORT)
     await update.message.reply_text(
         "🔴 Опишите проблему анонимно:",
         reply_markup=ReplyKeyboardRemove()
     )
 
 # Сохранение анонимного сообщения
+@tracked
 async def report_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     
     # Проверяем, что пользователь находится в контексте Анонима
-    if chat_id not in user_contexts or user_contexts[chat_id]["role"] != USER_STATE_REPORT:
+    session = await sessions.get(chat_id)
+    if session is None or session.role != USER_STATE_REPORT:
         logger.warning(f"Пользователь {chat_id} пытается отправить анонимное сообщение, но находится в другом контексте")
         await update.message.reply_text(
             "Вы не находитесь в режиме анонимного сообщения. Используйте команду /report или кнопку меню.",
@@ -208,40 +435,88 @@ async def report_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
     report_text = update.message.text.strip()
     logger.info(f"Пользователь {chat_id} отправил анонимное сообщение: {report_text[:50]}...")
     
-    save_report(user_id, report_text)
+    await save_report(user_id, report_text)
     await update.message.reply_text(
         "✅ Ваше сообщение принято и передано анонимно.",
         reply_markup=main_menu()
     )
     
     # Сбрасываем контекст
-    user_contexts[chat_id] = {"role": USER_STATE_NONE, "history": []}
+    await set_user_state(chat_id, USER_STATE_NONE)
 
 # 📰 Новости
+@tracked
 async def news_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     logger.info(f"Пользователь {chat_id} запросил новости")
     
-    news_text = get_news()
-    await update.message.reply_text(news_text, reply_markup=main_menu())
+    try:
+        news_text, page, pages, version = await get_news_page(0)
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке новостей: {e}")
+        await update.message.reply_text("Ошибка при загрузке новостей.", reply_markup=main_menu())
+        return
+    if pages > 1:
+        await update.message.reply_text(news_text, reply_markup=news_keyboard(version, page, pages))
+    else:
+        await update.message.reply_text(news_text, reply_markup=main_menu())
+
+# Кнопки листания новостей; в callback_data версия новостей и номер страницы
+def news_keyboard(version, page, pages):
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀️", callback_data=f"news:{version}:{page - 1}"))
+    buttons.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=f"news:{version}:{page}"))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton("▶️", callback_data=f"news:{version}:{page + 1}"))
+    return InlineKeyboardMarkup([buttons])
+
+# Листание новостей кнопками
+@tracked
+async def news_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    try:
+        _, version, page = query.data.split(":")
+        page = int(page)
+    except ValueError:
+        await query.answer()
+        return
+    
+    news_text, page, pages, current_version = await get_news_page(page)
+    if version != current_version:
+        # Новости обновились, пока сообщение висело в чате: показываем свежие с начала
+        news_text, page, pages, current_version = await get_news_page(0)
+        await query.answer("Новости обновились")
+    else:
+        await query.answer()
+    
+    try:
+        await query.edit_message_text(news_text, reply_markup=news_keyboard(current_version, page, pages))
+    except BadRequest as e:
+        # Нажали на кнопку текущей страницы — текст не изменился
+        if "not modified" not in str(e).lower():
+            raise
 
 # ✏️ Редактирование новостей
+@tracked
 async def update_news_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     logger.info(f"Пользователь {chat_id} запустил редактирование новостей")
     
     # Сбрасываем контекст пользователя
-    user_contexts[chat_id] = {"role": USER_STATE_UPDATE_NEWS, "history": []}
+    await set_user_state(chat_id, USER_STATE_UPDATE_NEWS)
     await update.message.reply_text(
         "Введите новый текст новостей:",
         reply_markup=ReplyKeyboardRemove()
     )
 
+@tracked
 async def process_update_news(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     
     # Проверяем, что пользователь находится в контексте редактирования новостей
-    if chat_id not in user_contexts or user_contexts[chat_id]["role"] != USER_STATE_UPDATE_NEWS:
+    session = await sessions.get(chat_id)
+    if session is None or session.role != USER_STATE_UPDATE_NEWS:
         logger.warning(f"Пользователь {chat_id} пытается обновить новости, но находится в другом контексте")
         await update.message.reply_text(
             "Вы не находитесь в режиме редактирования новостей. Используйте команду /update_news.",
@@ -252,16 +527,17 @@ async def process_update_news(update: Update, context: ContextTypes.DEFAULT_TYPE
     new_news = update.message.text.strip()
     logger.info(f"Пользователь {chat_id} обновил новости: {new_news[:50]}...")
     
-    update_news(new_news)
+    await update_news(new_news)
     await update.message.reply_text(
         "✅ Новости успешно обновлены!",
         reply_markup=main_menu()
     )
     
     # Сбрасываем контекст
-    user_contexts[chat_id] = {"role": USER_STATE_NONE, "history": []}
+    await set_user_state(chat_id, USER_STATE_NONE)
 
 # 📞 Контакты
+@tracked
 async def contact_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     logger.info(f"Пользователь {chat_id} запросил контакты")
@@ -272,22 +548,25 @@ async def contact_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 # Рассылка
+@tracked
 async def broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     logger.info(f"Пользователь {chat_id} запустил рассылку")
     
     # Сбрасываем контекст пользователя
-    user_contexts[chat_id] = {"role": USER_STATE_BROADCAST, "history": []}
+    await set_user_state(chat_id, USER_STATE_BROADCAST)
     await update.message.reply_text(
         "Введите сообщение для рассылки:",
         reply_markup=ReplyKeyboardRemove()
     )
 
+@tracked
 async def process_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     
     # Проверяем, что пользователь находится в контексте рассылки
-    if chat_id not in user_contexts or user_contexts[chat_id]["role"] != USER_STATE_BROADCAST:
+    session = await sessions.get(chat_id)
+    if session is None or session.role != USER_STATE_BROADCAST:
         logger.warning(f"Пользователь {chat_id} пытается отправить рассылку, но находится в другом контексте")
         await update.message.reply_text(
             "Вы не находитесь в режиме рассылки. Используйте команду /broadcast.",
@@ -298,17 +577,250 @@ async def process_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     broadcast_text = update.message.text.strip()
     logger.info(f"Пользователь {chat_id} отправил рассылку: {broadcast_text[:50]}...")
     
-    from broadcast import send_broadcast
-    await send_broadcast(context.bot, broadcast_text)
+    # Рассылка идёт в фоне, обработчик сразу отвечает администратору
+    job = broadcast_jobs.submit(context.bot, broadcast_text, admin_chat_id=chat_id)
     await update.message.reply_text(
-        "✅ Сообщение отправлено всем пользователям.",
+        f"📨 Рассылка #{job.job_id} поставлена в очередь. По окончании придёт отчёт.\n"
+        f"Статус: /broadcast_status {job.job_id}\n"
+        f"Отмена: /broadcast_cancel {job.job_id}",
         reply_markup=main_menu()
     )
     
     # Сбрасываем контекст
-    user_contexts[chat_id] = {"role": USER_STATE_NONE, "history": []}
+    await set_user_state(chat_id, USER_STATE_NONE)
+
+# Статус фоновых рассылок (только для администраторов)
+@tracked
+async def broadcast_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("Команда доступна только администраторам.", reply_markup=main_menu())
+        return
+    
+    logger.info(f"Пользователь {chat_id} запросил статус рассылки")
+    
+    if context.args:
+        job = broadcast_jobs.get(context.args[0])
+        text = job.describe() if job else f"Рассылка #{context.args[0]} не найдена."
+    else:
+        jobs = broadcast_jobs.jobs()
+        text = "\n\n".join(job.describe() for job in jobs[-5:]) if jobs else "Рассылок пока не было."
+    await update.message.reply_text(text, reply_markup=main_menu())
+
+# Отмена фоновой рассылки (только для администраторов)
+@tracked
+async def broadcast_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("Команда доступна только администраторам.", reply_markup=main_menu())
+        return
+    
+    if not context.args:
+        await update.message.reply_text("Укажите номер рассылки: /broadcast_cancel <номер>", reply_markup=main_menu())
+        return
+    
+    job_id = context.args[0]
+    logger.info(f"Пользователь {chat_id} отменяет рассылку #{job_id}")
+    if broadcast_jobs.cancel(job_id):
+        text = f"🛑 Рассылка #{job_id} отменена."
+    else:
+        text = f"Рассылка #{job_id} не найдена или уже завершена."
+    await update.message.reply_text(text, reply_markup=main_menu())
+
+# 🗂 Просмотр анонимных сообщений (только для администраторов)
+def format_reports(title, records, offset, total):
+    if not records:
+        return f"{title}\n\nСообщений не найдено."
+    parts = [f"{title} — {offset + 1}–{offset + len(records)} из {total}"]
+    for record in records:
+        text = record.get("text", "")
+        if len(text) > REPORT_PREVIEW_CHARS:
+            text = text[:REPORT_PREVIEW_CHARS].rstrip() + "…"
+        # ID автора не показываем: сообщения анонимные
+        when = record.get('ts', '').replace('T', ' ')
+        if record.get("source"):
+            # Перенесено из прежнего журнала без времени: ts — время последней записи в тот файл
+            when = f"не позже {when} (из {record['source']})"
+        parts.append(f"🕒 {when}\n{text}")
+    return "\n\n".join(parts)
+
+# Кнопки листания списка сообщений; prefix — вид списка и его параметр
+def reports_keyboard(prefix, offset, total):
+    buttons = []
+    if offset > 0:
+        buttons.append(InlineKeyboardButton("◀️", callback_data=f"{prefix}:{max(0, offset - REPORTS_PAGE_SIZE)}"))
+    if offset + REPORTS_PAGE_SIZE < total:
+        buttons.append(InlineKeyboardButton("▶️", callback_data=f"{prefix}:{offset + REPORTS_PAGE_SIZE}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+async def render_reports_page(kind, param, offset):
+    """
+    Готовит страницу списка сообщений.
+
+    Args:
+        kind (str): "reports" — по дате, "rsearch" — результаты поиска
+        param (str): Дата (YYYY-MM-DD или all) либо ключ сохранённого запроса
+        offset (int): Сколько записей пропустить
+
+    Returns:
+        tuple: (текст, клавиатура или None)
+    """
+    if kind == "rsearch":
+        query = _report_queries.get(param)
+        if query is None:
+            return "Поиск устарел, повторите /reports_search.", None
+        records, total = await search_reports(query, offset, REPORTS_PAGE_SIZE)
+        title = f"🔎 Поиск «{query}»"
+    else:
+        day = None if param == "all" else date.fromisoformat(param)
+        records, total = await list_reports(day, offset, REPORTS_PAGE_SIZE)
+        title = f"🗂 Сообщения за {param}" if day else "🗂 Все сообщения"
+    return format_reports(title, records, offset, total), reports_keyboard(f"{kind}:{param}", offset, total)
+
+@tracked
+async def reports_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        logger.warning(f"Пользователь {user_id} без прав администратора запросил /reports")
+        await update.message.reply_text("Команда доступна только администраторам.", reply_markup=main_menu())
+        return
+    
+    param = "all"
+    if context.args:
+        try:
+            param = date.fromisoformat(context.args[0]).isoformat()
+        except ValueError:
+            await update.message.reply_text("Укажите дату в формате ГГГГ-ММ-ДД: /reports 2024-05-01")
+            return
+    
+    logger.info(f"Администратор {user_id} просматривает сообщения ({param})")
+    text, keyboard = await render_reports_page("reports", param, 0)
+    await update.message.reply_text(text, reply_markup=keyboard)
+
+@tracked
+async def reports_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        logger.warning(f"Пользователь {user_id} без прав администратора запросил /reports_search")
+        await update.message.reply_text("Команда доступна только администраторам.", reply_markup=main_menu())
+        return
+    
+    query = " ".join(context.args).strip()
+    if not query:
+        await update.message.reply_text("Укажите, что искать: /reports_search <текст>")
+        return
+    
+    logger.info(f"Администратор {user_id} ищет в сообщениях: {query[:50]}")
+    key = hashlib.sha1(query.encode("utf-8")).hexdigest()[:10]
+    _report_queries[key] = query
+    _report_queries.move_to_end(key)
+    while len(_report_queries) > _REPORT_QUERIES_LIMIT:
+        _report_queries.popitem(last=False)
+    text, keyboard = await render_reports_page("rsearch", key, 0)
+    await update.message.reply_text(text, reply_markup=keyboard)
+
+# Листание списка сообщений кнопками
+@tracked
+async def reports_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if not is_admin(query.from_user.id):
+        await query.answer("Недоступно", show_alert=True)
+        return
+    try:
+        kind, param, offset = query.data.split(":")
+        text, keyboard = await render_reports_page(kind, param, max(0, int(offset)))
+    except ValueError:
+        await query.answer()
+        return
+    await query.answer()
+    
+    try:
+        await query.edit_message_text(text, reply_markup=keyboard)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+
+# 📊 Статистика запросов к Yandex GPT по моделям (только для администраторов)
+@tracked
+async def gpt_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        await update.message.reply_text("Команда доступна только администраторам.", reply_markup=main_menu())
+        return
+    
+    lines = [f"📊 Запросы к Yandex GPT (режим выбора модели: {model_router.mode})"]
+    for model, stats in model_router.stats().items():
+        lines.append(
+            f"\n{model}: запросов {stats['requests']}, ошибок {stats['errors']}\n"
+            f"время: среднее {stats['avg_seconds']:.1f} с, p50 {stats['p50_seconds']:.1f} с, p95 {stats['p95_seconds']:.1f} с\n"
+            f"токены: {stats['input_tokens']} + {stats['output_tokens']}, ≈{stats['cost']:.2f} ₽"
+        )
+    await update.message.reply_text("\n".join(lines))
+
+# Трассы последних обновлений: где тратится время ответа (только для администраторов)
+@tracked
+async def trace_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        await update.message.reply_text("Команда доступна только администраторам.", reply_markup=main_menu())
+        return
+    
+    arg = context.args[0] if context.args else ""
+    if arg and arg != "slow":
+        spans = exporter.get(arg)
+        text = format_trace(spans) if spans else "Трасса не найдена: возможно, она уже вытеснена более новыми."
+    else:
+        traces = exporter.recent(TRACE_BUFFER_SIZE if arg == "slow" else TRACE_LIST_SIZE)
+        if arg == "slow":
+            traces = sorted(traces, key=lambda spans: max(s["duration"] or 0.0 for s in spans), reverse=True)[:TRACE_LIST_SIZE]
+        if not traces:
+            text = "Трасс пока нет."
+        else:
+            title = "🐢 Самые долгие обновления" if arg == "slow" else "🧭 Последние обновления"
+            text = (
+                f"{title}:\n" + "\n".join(format_trace_summary(spans) for spans in traces)
+                + "\n\nПодробно: /trace <id>, самые долгие: /trace slow"
+            )
+    for part in split_message(text):
+        await update.message.reply_text(part)
+
+# Профилирование бота на N секунд (только для администраторов)
+@tracked
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        await update.message.reply_text("Команда доступна только администраторам.", reply_markup=main_menu())
+        return
+    
+    try:
+        seconds, mode = parse_profile_args(context.args or [])
+    except ValueError:
+        await update.message.reply_text(f"Использование: /profile [секунды до {PROFILE_MAX_SECONDS}] [sampler|cprofile]")
+        return
+    logger.info(f"Администратор {user_id} запустил профилирование ({mode}) на {seconds:.0f} с")
+    await update.message.reply_text(f"⏱ Профилирую бота {seconds:.0f} с ({mode}), результат пришлю сюда.")
+    # Замер идёт в фоне, чтобы не держать очередь обновлений этого чата
+    spawn_background(send_profile(update, seconds, mode))
+
+async def send_profile(update, seconds, mode):
+    try:
+        result = await profile(seconds, mode)
+    except (ValueError, ProfileBusyError) as e:
+        await update.message.reply_text(f"❗{e}")
+        return
+    except Exception as e:
+        logger.error(f"Ошибка профилирования: {e}")
+        await update.message.reply_text("Не удалось выполнить профилирование, подробности в логе.")
+        return
+    for part in split_message(f"🔥 Профиль за {result.seconds:.0f} с ({result.mode}):\n{result.summary}"):
+        await update.message.reply_text(part)
+    # Файл свёрнутых стеков (sampler) или статистики cProfile — для flamegraph.pl, speedscope.app или pstats
+    path = result.files.get("collapsed") or result.files.get("pstats")
+    await update.message.reply_document(Path(path))
 
 # Обработчик всех текстовых сообщений
+@tracked
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     text = update.message.text
@@ -320,19 +832,20 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await back_to_main_menu(update, context)
     elif text in ["📸 Валера", "🔴 Аноним"]:
         await handle_menu_buttons(update, context)
-    # Обработка сообщений в зависимости от контекста
-    elif chat_id in user_contexts:
-        if user_contexts[chat_id]["role"] == USER_STATE_VALERA:
+    else:
+        session = await sessions.get(chat_id)
+        if session is None:
+            # Если пользователь не в каком-либо контексте, отправляем приветствие
+            await start(update, context)
+        # Обработка сообщений в зависимости от контекста
+        elif session.role == USER_STATE_VALERA:
             await valera_ai(update, context)
-        elif user_contexts[chat_id]["role"] == USER_STATE_REPORT:
+        elif session.role == USER_STATE_REPORT:
             await report_response(update, context)
-        elif user_contexts[chat_id]["role"] == USER_STATE_UPDATE_NEWS:
+        elif session.role == USER_STATE_UPDATE_NEWS:
             await process_update_news(update, context)
-        elif user_contexts[chat_id]["role"] == USER_STATE_BROADCAST:
+        elif session.role == USER_STATE_BROADCAST:
             await process_broadcast(update, context)
-    else:
-        # Если пользователь не в каком-либо контексте, отправляем приветствие
-        await start(update, context)
 
 # Функция для регистрации всех обработчиков
 def register_handlers(app_bot):
@@ -346,6 +859,18 @@ def register_handlers(app_bot):
     app_bot.add_handler(CommandHandler("update_news", update_news_start))
     app_bot.add_handler(CommandHandler("contact", contact_handler))
     app_bot.add_handler(CommandHandler("broadcast", broadcast_message))
+    app_bot.add_handler(CommandHandler("broadcast_status", broadcast_status))
+    app_bot.add_handler(CommandHandler("broadcast_cancel", broadcast_cancel))
+    app_bot.add_handler(CommandHandler("reports", reports_command))
+    app_bot.add_handler(CommandHandler("reports_search", reports_search))
+    app_bot.add_handler(CommandHandler("gpt_stats", gpt_stats))
+    app_bot.add_handler(CommandHandler("trace", trace_command))
+    app_bot.add_handler(CommandHandler("profile", profile_command))
+    
+    # Кнопки листания новостей
+    app_bot.add_handler(CallbackQueryHandler(news_page_callback, pattern=r"^news:"))
+    # Кнопки листания анонимных сообщений
+    app_bot.add_handler(CallbackQueryHandler(reports_page_callback, pattern=r"^(reports|rsearch):"))
     
     # Обработчик кнопки "Назад"
     app_bot.add_handler(MessageHandler(filters.Regex("^↩️ Назад$"), back_to_main_menu))
@@ -0,0 +1,216 @@
+"""
+Проверки живости и готовности бота для балансировщика и мониторинга.
+
+/health/live отвечает, жив ли процесс и не завис ли цикл событий бота;
+в этом ответе нет ввода-вывода. /health/ready повторяет проверки check_bot.py
+асинхронно и параллельно: доступность Bot API Telegram, состояние Яндекс GPT,
+диск и база пользователей. Добавлены очередь обновлений и задержка цикла событий.
+Результаты дорогих проверок кэшируются, поэтому частые пробы не нагружают
+ни Telegram, ни диск. Яндекс GPT пробами не запрашивается вовсе: его
+состояние берётся из выключателей, которые видят настоящие запросы.
+"""
+
+import asyncio
+import logging
+import os
+import shutil
+import time
+from typing import Awaitable, Callable, Dict, Optional
+from metrics import gauge
+from storage import run_io
+from users import ping_users
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд переиспользовать результат проверки диска и Telegram
+HEALTH_CACHE_SECONDS = float(os.getenv("HEALTH_CACHE_SECONDS", "5"))
+HEALTH_TELEGRAM_TTL = float(os.getenv("HEALTH_TELEGRAM_TTL", "30"))
+HEALTH_CHECK_TIMEOUT = float(os.getenv("HEALTH_CHECK_TIMEOUT", "3"))  # Предел одной проверки, секунды
+# Пороги готовности
+HEALTH_MAX_LOOP_LAG = float(os.getenv("HEALTH_MAX_LOOP_LAG", "1"))  # Задержка цикла событий, секунды
+HEALTH_STALL_SECONDS = float(os.getenv("HEALTH_STALL_SECONDS", "30"))  # Цикл не отвечает столько — процесс не жив
+HEALTH_QUEUE_MAX_FILL = float(os.getenv("HEALTH_QUEUE_MAX_FILL", "0.9"))  # Доля заполнения очереди обновлений
+HEALTH_STORAGE_MAX_SECONDS = float(os.getenv("HEALTH_STORAGE_MAX_SECONDS", "1"))
+HEALTH_MIN_FREE_MB = int(os.getenv("HEALTH_MIN_FREE_MB", "100"))
+
+LOOP_LAG = gauge("cnc_event_loop_lag_seconds", "Задержка цикла событий бота")
+
+
+class LoopLagMonitor:
+    """
+    Измеряет задержку цикла событий: задача засыпает на interval секунд и
+    смотрит, насколько позже она проснулась. Если цикл занят блокирующим
+    кодом, задержка растёт, а если он завис, перестают обновляться отметки.
+    """
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.lag = 0.0
+        self.last_tick: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        """Запускает измерения в текущем цикле событий."""
+        if self._task is None:
+            self.last_tick = time.monotonic()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, loop.time() - started - self.interval)
+            self.last_tick = time.monotonic()
+            LOOP_LAG.set(self.lag)
+
+    def stalled_for(self) -> float:
+        """Сколько секунд цикл не давал отметок сверх ожидаемого (0, если монитор не запущен)."""
+        if self._task is None or self.last_tick is None:
+            return 0.0
+        return max(0.0, time.monotonic() - self.last_tick - self.interval)
+
+
+# Общий монитор цикла событий бота
+loop_monitor = LoopLagMonitor()
+
+
+def check_result(ok: bool, detail, critical: bool = True) -> Dict:
+    return {"ok": ok, "critical": critical, "detail": detail}
+
+
+class CachedCheck:
+    """
+    Проверка с ввода-выводом, результат которой переиспользуется ttl секунд.
+
+    Одновременные пробы ждут одну общую проверку, а не запускают свою.
+    Неудачный результат хранится не дольше HEALTH_CACHE_SECONDS, чтобы
+    готовность быстро восстанавливалась.
+    """
+
+    def __init__(self, name: str, func: Callable[[], Awaitable[Dict]], ttl: float,
+                 timeout: float = HEALTH_CHECK_TIMEOUT):
+        self.name = name
+        self.func = func
+        self.ttl = ttl
+        self.timeout = timeout
+        self._result: Optional[Dict] = None
+        self._checked_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def _fresh(self) -> bool:
+        if self._result is None:
+            return False
+        ttl = self.ttl if self._result["ok"] else min(self.ttl, HEALTH_CACHE_SECONDS)
+        return time.monotonic() - self._checked_at < ttl
+
+    async def result(self) -> Dict:
+        if self._fresh():
+            return self._result
+        async with self._lock:
+            if self._fresh():
+                return self._result
+            started = time.monotonic()
+            try:
+                result = await asyncio.wait_for(self.func(), self.timeout)
+            except asyncio.TimeoutError:
+                result = check_result(False, f"нет ответа за {self.timeout:.0f} с")
+            except Exception as e:
+                result = check_result(False, f"ошибка: {e}")
+            result["seconds"] = round(time.monotonic() - started, 4)
+            if not result["ok"]:
+                logger.warning(f"Проверка {self.name} не пройдена: {result['detail']}")
+            self._result = result
+            self._checked_at = time.monotonic()
+            return result
+
+
+def _storage_probe() -> Dict:
+    ping_users()
+    return {"free_mb": shutil.disk_usage(".").free // (1024 * 1024)}
+
+
+class HealthChecker:
+    """
+    Проверки живости и готовности одного процесса бота.
+
+    Args:
+        runtime: BotRuntime процесса (очередь обновлений и цикл событий бота)
+        breakers (Callable): Возвращает выключатели Яндекс GPT {название: CircuitBreaker}
+    """
+
+    def __init__(self, runtime, breakers: Callable[[], Dict]):
+        self.runtime = runtime
+        self.breakers = breakers
+        self.started_at = time.monotonic()
+        self._telegram = CachedCheck("telegram", self._check_telegram, HEALTH_TELEGRAM_TTL)
+        self._storage = CachedCheck("storage", self._check_storage, HEALTH_CACHE_SECONDS)
+
+    async def _check_telegram(self) -> Dict:
+        if not self.runtime.running:
+            return check_result(False, "бот ещё не запущен")
+        me = await self.runtime.run(self.runtime.application.bot.get_me())
+        return check_result(True, f"@{me.username}")
+
+    async def _check_storage(self) -> Dict:
+        started = time.monotonic()
+        probe = await run_io(_storage_probe)
+        seconds = time.monotonic() - started
+        ok = seconds <= HEALTH_STORAGE_MAX_SECONDS and probe["free_mb"] >= HEALTH_MIN_FREE_MB
+        return check_result(ok, {"latency_seconds": round(seconds, 4), "free_mb": probe["free_mb"]})
+
+    def _check_queue(self) -> Dict:
+        depth = self.runtime.queue_size_now()
+        limit = self.runtime.queue_size
+        return check_result(depth < limit * HEALTH_QUEUE_MAX_FILL, {"depth": depth, "limit": limit})
+
+    def _check_loop(self) -> Dict:
+        stalled = loop_monitor.stalled_for()
+        ok = loop_monitor.lag <= HEALTH_MAX_LOOP_LAG and stalled <= HEALTH_MAX_LOOP_LAG
+        return check_result(ok, {"lag_seconds": round(loop_monitor.lag, 4), "stalled_seconds": round(stalled, 4)})
+
+    def _check_yandex(self) -> Dict:
+        states = {name: breaker.state for name, breaker in self.breakers().items()}
+        # Без Яндекс GPT бот работает (новости, сообщения, рассылки), поэтому проверка не критичная
+        ok = not states or any(state != "open" for state in states.values())
+        return check_result(ok, states, critical=False)
+
+    def live(self) -> Dict:
+        """
+        Живость: процесс отвечает и цикл событий бота не завис.
+
+        Returns:
+            dict: {"ok", "uptime_seconds", "loop_lag_seconds", "stalled_seconds"}
+        """
+        stalled = loop_monitor.stalled_for()
+        return {
+            "ok": stalled < HEALTH_STALL_SECONDS,
+            "uptime_seconds": round(time.monotonic() - self.started_at, 1),
+            "loop_lag_seconds": round(loop_monitor.lag, 4),
+            "stalled_seconds": round(stalled, 4),
+        }
+
+    async def ready(self) -> Dict:
+        """
+        Готовность принимать обновления: все критичные проверки пройдены.
+
+        Returns:
+            dict: {"ok", "status": ok/degraded/fail, "checks": {название: результат}}
+        """
+        telegram, storage = await asyncio.gather(self._telegram.result(), self._storage.result())
+        checks = {
+            "telegram": telegram,
+            "storage": storage,
+            "queue": self._check_queue(),
+            "event_loop": self._check_loop(),
+            "yandex_gpt": self._check_yandex(),
+        }
+        ok = all(check["ok"] for check in checks.values() if check["critical"])
+        degraded = any(not check["ok"] for check in checks.values())
+        return {"ok": ok, "status": "fail" if not ok else "degraded" if degraded else "ok", "checks": checks}
@@ -0,0 +1,145 @@
+"""
+Общая настройка логирования бота.
+
+Записи из всех модулей попадают в очередь в памяти (QueueHandler), а на диск
+и в консоль их выводит отдельный поток (QueueListener). Обработчик сообщения
+не ждёт записи в файл. Файл лога ротируется по размеру. Уровни можно задать
+для каждого модуля отдельно, а частые отладочные строки прореживаются.
+
+Модули настройку не трогают, они только получают логгер:
+    logger = logging.getLogger(__name__)
+и пишут в %-стиле, чтобы строка собиралась лишь для записей, которые выводятся:
+    logger.debug("Ответ: %.500s", answer)
+"""
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Общий уровень логирования
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# Уровни отдельных модулей через запятую, например "gpt_api=DEBUG,httpx=WARNING"
+LOG_LEVELS = os.getenv("LOG_LEVELS", "httpx=WARNING,httpcore=WARNING")
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")  # Пустое значение — только консоль
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))  # При переполнении новые записи отбрасываются
+# Из одинаковых отладочных строк выводится каждая N-я (1 — все)
+LOG_DEBUG_SAMPLE = int(os.getenv("LOG_DEBUG_SAMPLE", "10"))
+
+LOG_FORMAT = '%(asctime)s - %(processName)s - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s'
+
+
+def parse_levels(value):
+    """
+    Разбирает уровни модулей из строки "модуль=УРОВЕНЬ,...".
+
+    Returns:
+        dict: Имя логгера -> уровень; ошибочные пары пропускаются
+    """
+    levels = {}
+    for pair in value.split(","):
+        name, _, level = pair.partition("=")
+        name, level = name.strip(), level.strip().upper()
+        if name and isinstance(logging.getLevelName(level), int):
+            levels[name] = level
+    return levels
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Прореживает отладочные записи: из записей, сделанных одной и той же
+    строкой кода, пропускается первая и затем каждая every-я. Записи уровня
+    INFO и выше проходят всегда.
+
+    Фильтр стоит на QueueHandler, поэтому отброшенные записи не форматируются
+    и не попадают в очередь.
+    """
+
+    def __init__(self, every=LOG_DEBUG_SAMPLE):
+        super().__init__()
+        self.every = max(1, every)
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if self.every == 1 or record.levelno > logging.DEBUG:
+            return True
+        key = (record.name, record.lineno)
+        with self._lock:
+            count = self._counts.get(key, 0)
+            self._counts[key] = count + 1
+        return count % self.every == 0
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который при переполненной очереди отбрасывает запись вместо ожидания."""
+
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener = None
+_queue_handler = None
+
+
+def setup_logging(suffix=""):
+    """
+    Настраивает корневой логгер. Повторный вызов перенастраивает его
+    (воркер кластера так переключается на свой файл лога).
+
+    Args:
+        suffix (str): Добавляется к имени файла лога перед расширением, например ".w0"
+    """
+    global _listener, _queue_handler
+    stop_logging()
+
+    handlers = [logging.StreamHandler()]
+    if LOG_FILE:
+        root, ext = os.path.splitext(LOG_FILE)
+        handlers.append(logging.handlers.RotatingFileHandler(
+            f"{root}{suffix}{ext}", maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+        ))
+    formatter = logging.Formatter(LOG_FORMAT)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    _queue_handler = _DroppingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    _queue_handler.addFilter(SamplingFilter())
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(_queue_handler)
+    root_logger.setLevel(LOG_LEVEL.upper())
+    for name, level in parse_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging():
+    """Дописывает записи из очереди и закрывает файлы логов."""
+    global _listener
+    if _listener is None:
+        return
+    if _queue_handler.dropped:
+        logging.getLogger(__name__).warning("Очередь логов переполнялась, отброшено записей: %d", _queue_handler.dropped)
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
+
+
+atexit.register(stop_logging)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Локальная заглушка API Яндекс GPT для разработки и нагрузочных проверок.
+
+Поддерживает синхронный и потоковый completion, асинхронный completionAsync
+и опрос операций. Ответ — эхо последнего вопроса пользователя.
+
+Запуск:
+    python mock_yandex.py --port 8081 --delay 2 --fail-rate 0.1
+
+Бот направляется на заглушку переменными окружения:
+    YANDEX_GPT_BASE_URL=http://127.0.0.1:8081
+    YANDEX_OPERATION_URL=http://127.0.0.1:8081/operations
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+import uuid
+from aiohttp import web
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger("mock_yandex")
+
+
+def _answer_for(data):
+    messages = data.get("messages") or []
+    question = next((m.get("text", "") for m in reversed(messages) if m.get("role") == "user"), "")
+    model = data.get("modelUri", "").rsplit("/", 1)[-1]
+    return f"Ответ заглушки ({model}): {question[:200]}"
+
+
+def _result(text, done=True):
+    return {
+        "alternatives": [{"message": {"role": "assistant", "text": text}, "status": "ALTERNATIVE_STATUS_FINAL" if done else "ALTERNATIVE_STATUS_PARTIAL"}],
+        "usage": {"inputTextTokens": "10", "completionTokens": str(max(1, len(text) // 3)), "totalTokens": str(10 + len(text) // 3)},
+        "modelVersion": "mock",
+    }
+
+
+async def _maybe_fail(request):
+    config = request.app["config"]
+    if random.random() < config.fail_rate:
+        status = random.choice((429, 500, 503))
+        logger.info(f"Имитация ошибки {status}")
+        return web.json_response({"error": "mock failure"}, status=status, headers={"Retry-After": "1"})
+    return None
+
+
+async def completion(request):
+    failure = await _maybe_fail(request)
+    if failure is not None:
+        return failure
+    data = await request.json()
+    config = request.app["config"]
+    text = _answer_for(data)
+
+    if not data.get("completionOptions", {}).get("stream"):
+        await asyncio.sleep(config.delay)
+        return web.json_response({"result": _result(text)})
+
+    # Поток: JSON на строку, в каждом — весь текст на текущий момент
+    response = web.StreamResponse(headers={"Content-Type": "application/json"})
+    await response.prepare(request)
+    words = text.split(" ")
+    for i in range(1, len(words) + 1):
+        await asyncio.sleep(config.delay / max(1, len(words)))
+        chunk = {"result": _result(" ".join(words[:i]), done=i == len(words))}
+        await response.write((json.dumps(chunk, ensure_ascii=False) + "\n").encode("utf-8"))
+    await response.write_eof()
+    return response
+
+
+async def completion_async(request):
+    failure = await _maybe_fail(request)
+    if failure is not None:
+        return failure
+    data = await request.json()
+    config = request.app["config"]
+    operation_id = uuid.uuid4().hex
+    request.app["operations"][operation_id] = (time.monotonic() + config.async_delay, _answer_for(data))
+    return web.json_response({"id": operation_id, "description": "Async GPT Completion", "done": False})
+
+
+async def get_operation(request):
+    operation_id = request.match_info["operation_id"]
+    operation = request.app["operations"].get(operation_id)
+    if operation is None:
+        return web.json_response({"code": 5, "message": "operation not found"}, status=404)
+    ready_at, text = operation
+    if time.monotonic() < ready_at:
+        return web.json_response({"id": operation_id, "done": False})
+    return web.json_response({"id": operation_id, "done": True, "response": _result(text)})
+
+
+def create_app(config):
+    app = web.Application()
+    app["config"] = config
+    app["operations"] = {}
+    app.router.add_post("/foundationModels/v1/completion", completion)
+    app.router.add_post("/foundationModels/v1/completionAsync", completion_async)
+    app.router.add_get("/operations/{operation_id}", get_operation)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Заглушка API Яндекс GPT")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--delay", type=float, default=1.0, help="время ответа completion, секунды")
+    parser.add_argument("--async-delay", type=float, default=5.0, help="время выполнения асинхронной операции, секунды")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="доля запросов, завершающихся 429/5xx")
+    args = parser.parse_args()
+    web.run_app(create_app(args), host=args.host, port=args.port)
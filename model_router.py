@@ -0,0 +1,165 @@
+import logging
+import os
+import re
+from typing import Dict, List, Optional
+from metrics import counter, histogram
+from resilience import LatencyTracker
+
+logger = logging.getLogger(__name__)
+
+GPT_SECONDS = histogram("cnc_gpt_request_seconds", "Длительность успешного запроса к Яндекс GPT", ["model"])
+GPT_REQUESTS = counter("cnc_gpt_requests_total", "Запросы к Яндекс GPT по результату", ["model", "result"])
+GPT_TOKENS = counter("cnc_gpt_tokens_total", "Токены Яндекс GPT: prompt — вопрос, completion — ответ", ["model", "kind"])
+
+# Модели Яндекс GPT: быстрая и дешёвая для простых вопросов и полная для сложных
+GPT_MODEL_LITE = os.getenv("GPT_MODEL_LITE", "yandexgpt-lite")
+GPT_MODEL_FULL = os.getenv("GPT_MODEL_FULL", "yandexgpt")
+# Политика выбора: auto — по сложности вопроса, lite или full — всегда одна модель
+GPT_ROUTER_MODE = os.getenv("GPT_ROUTER_MODE", "auto")
+GPT_ROUTER_LONG_CHARS = int(os.getenv("GPT_ROUTER_LONG_CHARS", "600"))  # Вопрос длиннее — полная модель
+# Дополнительные слова, при которых вопрос отправляется полной модели (через запятую, начало слова)
+GPT_ROUTER_KEYWORDS = os.getenv("GPT_ROUTER_KEYWORDS", "")
+# Таймауты запроса для каждой модели, секунды: полная модель отвечает дольше
+GPT_TIMEOUT_LITE = float(os.getenv("GPT_TIMEOUT_LITE", os.getenv("GPT_REQUEST_TIMEOUT", "30")))
+GPT_TIMEOUT_FULL = float(os.getenv("GPT_TIMEOUT_FULL", "60"))
+# Цена за 1000 токенов, руб., для оценки расходов
+GPT_PRICE_LITE = float(os.getenv("GPT_PRICE_LITE", "0.2"))
+GPT_PRICE_FULL = float(os.getenv("GPT_PRICE_FULL", "1.2"))
+
+# Юридические вопросы: начала слов, по которым их узнаём
+_LEGAL_STEMS = (
+    "юрист", "юридич", "закон", "трудов", "тк рф", "увольн", "уволи", "уволя", "больничн", "отпуск",
+    "переработ", "сверхурочн", "зарплат", "заработн", "жалоб", "судеб", "прокуратур", "инспекц",
+    "штраф", "выговор", "компенсац", "профсоюз",
+)
+# Кадр G-кода: номер кадра или G/M-код с координатами, например "N10 G01 X10.5 Y-2 F200"
+_GCODE_LINE_RE = re.compile(r"^\s*(N\d+\s+)?[GM]\d{1,3}(\.\d)?\b.*", re.IGNORECASE | re.MULTILINE)
+_GCODE_MIN_LINES = 3
+
+
+def _keywords() -> tuple:
+    extra = tuple(word.strip().lower() for word in GPT_ROUTER_KEYWORDS.split(",") if word.strip())
+    return _LEGAL_STEMS + extra
+
+
+class ModelChoice:
+    """Выбранная модель, её таймаут и причина выбора (для логов и метрик)."""
+
+    __slots__ = ("model", "timeout", "reason")
+
+    def __init__(self, model: str, timeout: float, reason: str):
+        self.model = model
+        self.timeout = timeout
+        self.reason = reason
+
+    def __repr__(self) -> str:
+        return f"ModelChoice({self.model}, {self.reason})"
+
+
+class ModelStats:
+    """Счётчики запросов, длительностей, токенов и стоимости одной модели."""
+
+    def __init__(self, price_per_1k: float):
+        self.price_per_1k = price_per_1k
+        self.requests = 0
+        self.errors = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.total_seconds = 0.0
+        self.latency = LatencyTracker(window=500, min_samples=1)
+
+    @property
+    def cost(self) -> float:
+        return (self.input_tokens + self.output_tokens) / 1000 * self.price_per_1k
+
+    def as_dict(self) -> Dict:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "avg_seconds": self.total_seconds / (self.requests - self.errors) if self.requests > self.errors else 0.0,
+            "p50_seconds": self.latency.percentile(0.5) or 0.0,
+            "p95_seconds": self.latency.percentile(0.95) or 0.0,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "cost": self.cost,
+        }
+
+
+class ModelRouter:
+    """
+    Выбирает модель Яндекс GPT для запроса и собирает метрики по моделям.
+
+    В режиме auto полная модель получает длинные вопросы, вопросы с G-кодом
+    (несколько кадров программы) и юридические вопросы; остальное отвечает
+    облегчённая модель.
+    """
+
+    def __init__(self, mode: str = GPT_ROUTER_MODE):
+        if mode not in ("auto", "lite", "full"):
+            logger.warning(f"Неизвестный GPT_ROUTER_MODE={mode}, используем auto")
+            mode = "auto"
+        self.mode = mode
+        self.timeouts = {GPT_MODEL_LITE: GPT_TIMEOUT_LITE, GPT_MODEL_FULL: GPT_TIMEOUT_FULL}
+        self._stats = {GPT_MODEL_LITE: ModelStats(GPT_PRICE_LITE), GPT_MODEL_FULL: ModelStats(GPT_PRICE_FULL)}
+
+    def choice_for(self, model: str, reason: str) -> ModelChoice:
+        return ModelChoice(model, self.timeouts.get(model, GPT_TIMEOUT_LITE), reason)
+
+    def choose(self, messages: List[Dict]) -> ModelChoice:
+        """
+        Выбирает модель по последнему вопросу пользователя.
+
+        Args:
+            messages (List[Dict]): Сообщения запроса {"role", "text"}
+        """
+        if self.mode == "lite":
+            return self.choice_for(GPT_MODEL_LITE, "policy")
+        if self.mode == "full":
+            return self.choice_for(GPT_MODEL_FULL, "policy")
+
+        question = next((m["text"] for m in reversed(messages) if m.get("role") == "user"), "")
+        if len(question) > GPT_ROUTER_LONG_CHARS:
+            return self.choice_for(GPT_MODEL_FULL, "long")
+        if len(_GCODE_LINE_RE.findall(question)) >= _GCODE_MIN_LINES:
+            return self.choice_for(GPT_MODEL_FULL, "gcode")
+        lowered = question.lower().replace("ё", "е")
+        if any(re.search(r"\b" + re.escape(stem), lowered) for stem in _keywords()):
+            return self.choice_for(GPT_MODEL_FULL, "legal")
+        return self.choice_for(GPT_MODEL_LITE, "simple")
+
+    def stats_for(self, model: str) -> ModelStats:
+        stats = self._stats.get(model)
+        if stats is None:
+            stats = self._stats[model] = ModelStats(GPT_PRICE_FULL)
+        return stats
+
+    def record(self, model: str, seconds: float, ok: bool, usage: Optional[Dict] = None) -> None:
+        """
+        Учитывает завершённый запрос.
+
+        Args:
+            usage (Optional[Dict]): Поле result.usage ответа API (inputTextTokens, completionTokens)
+        """
+        stats = self.stats_for(model)
+        stats.requests += 1
+        GPT_REQUESTS.inc(model=model, result="ok" if ok else "error")
+        if not ok:
+            stats.errors += 1
+            return
+        stats.total_seconds += seconds
+        stats.latency.record(seconds)
+        GPT_SECONDS.observe(seconds, model=model)
+        if usage:
+            input_tokens = int(usage.get("inputTextTokens", 0))
+            output_tokens = int(usage.get("completionTokens", 0))
+            stats.input_tokens += input_tokens
+            stats.output_tokens += output_tokens
+            GPT_TOKENS.inc(input_tokens, model=model, kind="prompt")
+            GPT_TOKENS.inc(output_tokens, model=model, kind="completion")
+
+    def stats(self) -> Dict[str, Dict]:
+        return {model: stats.as_dict() for model, stats in self._stats.items()}
+
+
+# Общий маршрутизатор запросов к Яндекс GPT
+model_router = ModelRouter()
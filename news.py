@@ -1,25 +1,131 @@
+import hashlib
 import os
 import logging
+import time
+from storage import read_text, run_io, write_text
 
 NEWS_FILE = "news.txt"
 
-# Читаем новости из файла
-def get_news():
+# Как часто проверять, не изменили ли файл новостей вручную, секунды
+NEWS_CHECK_INTERVAL = float(os.getenv("NEWS_CHECK_INTERVAL", "10"))
+# Новостей на одной странице /news
+NEWS_PER_PAGE = int(os.getenv("NEWS_PER_PAGE", "1"))
+# Строка, которой в news.txt отделяются новости друг от друга
+NEWS_SEPARATOR = "---"
+
+NO_NEWS_TEXT = "Новости отсутствуют."
+
+
+def split_news(news_text):
+    """Разбивает текст файла новостей на отдельные новости по строкам "---"."""
+    items = []
+    current = []
+    for line in news_text.splitlines():
+        if line.strip() == NEWS_SEPARATOR:
+            items.append("\n".join(current).strip())
+            current = []
+        else:
+            current.append(line)
+    items.append("\n".join(current).strip())
+    return [item for item in items if item]
+
+
+def _file_mtime():
     try:
-        if not os.path.exists(NEWS_FILE):
-            return "Новости отсутствуют."
-        with open(NEWS_FILE, "r", encoding="utf-8") as f:
-            return f.read()
+        return os.stat(NEWS_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+class NewsCache:
+    """
+    Новости в памяти.
+
+    Файл читается один раз; потом раз в NEWS_CHECK_INTERVAL секунд проверяется
+    только время его изменения, поэтому /news отвечает из памяти. Версия —
+    хэш содержимого, одинаковый во всех процессах бота: по ней кнопки
+    страниц узнают, что новости сменились.
+    """
+
+    def __init__(self):
+        self.text = None
+        self.items = []
+        self.version = ""
+        self._mtime = None
+        self._checked_at = 0.0
+
+    def _set(self, news_text, mtime):
+        self.text = news_text
+        self.items = split_news(news_text or "")
+        self.version = hashlib.sha256((news_text or "").encode("utf-8")).hexdigest()[:8]
+        self._mtime = mtime
+        self._checked_at = time.monotonic()
+
+    async def _refresh(self):
+        if self.text is not None and time.monotonic() - self._checked_at < NEWS_CHECK_INTERVAL:
+            return
+        self._checked_at = time.monotonic()
+        mtime = await run_io(_file_mtime)
+        if self.text is not None and mtime == self._mtime:
+            return
+        news_text = await read_text(NEWS_FILE, default="")
+        self._set(news_text, mtime)
+        logging.info(f"Новости загружены: {len(self.items)} шт., версия {self.version}")
+
+    async def get(self):
+        await self._refresh()
+        return self
+
+    async def replace(self, news_text):
+        await write_text(NEWS_FILE, news_text)
+        self._set(news_text, await run_io(_file_mtime))
+
+    def pages(self):
+        return max(1, -(-len(self.items) // NEWS_PER_PAGE))
+
+    def page(self, number):
+        """
+        Возвращает текст страницы новостей.
+
+        Returns:
+            tuple: (текст, номер страницы, число страниц); номер приводится к допустимому
+        """
+        pages = self.pages()
+        number = min(max(0, number), pages - 1)
+        if not self.items:
+            return NO_NEWS_TEXT, number, pages
+        start = number * NEWS_PER_PAGE
+        return "\n\n".join(self.items[start:start + NEWS_PER_PAGE]), number, pages
+
+
+news_cache = NewsCache()
+
+# Читаем новости (из памяти, файл перечитывается только после изменения)
+async def get_news():
+    try:
+        cache = await news_cache.get()
+        if not cache.items:
+            return NO_NEWS_TEXT
+        return cache.text
     except Exception as e:
         logging.error(f"Ошибка при чтении новостей: {e}")
         return "Ошибка при загрузке новостей."
 
+# Страница новостей для /news с кнопками листания
+async def get_news_page(number=0):
+    """
+    Returns:
+        tuple: (текст, номер страницы, число страниц, версия новостей)
+    """
+    cache = await news_cache.get()
+    text, number, pages = cache.page(number)
+    return text, number, pages, cache.version
+
 # Обновляем новости
-def update_news(news_text):
+async def update_news(news_text):
     try:
-        with open(NEWS_FILE, "w", encoding="utf-8") as f:
-            f.write(news_text)
+        await news_cache.replace(news_text)
         logging.info("Новости успешно обновлены")
     except Exception as e:
         logging.error(f"Ошибка при обновлении новостей: {e}")
-        raise
\ No newline at end of file
+        raise
@@ -0,0 +1,202 @@
+"""
+Профилирование работающего бота по команде, без перезапуска.
+
+Два режима:
+
+- sampler — отдельный поток раз в PROFILE_INTERVAL секунд снимает стеки всех
+  потоков процесса (цикл событий бота, пул хранилища и т.д.). Накладные
+  расходы малы, а результат — файл свёрнутых стеков (collapsed stacks) для
+  flamegraph.pl или speedscope.app и список функций по доле выборок.
+  Поток выборки ждёт GIL, поэтому короткие (короче sys.getswitchinterval())
+  участки работы процессора попадают в выборки реже, чем длятся;
+- cprofile — cProfile в потоке цикла событий бота: точное число вызовов и
+  время каждой функции обработчиков, но заметно замедляет бота на время замера.
+
+Пока профилирование не запущено, оно ничего не стоит: нет ни потока, ни хуков.
+"""
+
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Optional
+from storage import run_io, write_text
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")  # Куда сохранять результаты
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.01"))  # Период выборки стеков, секунды
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "120"))  # Предел длительности одного замера
+PROFILE_TOP = int(os.getenv("PROFILE_TOP", "25"))  # Сколько функций показывать в сводке
+
+PROFILE_MODES = ("sampler", "cprofile")
+
+
+class ProfileBusyError(Exception):
+    """Профилирование уже идёт: одновременно допускается только один замер."""
+
+
+class ProfileResult:
+    """Итог замера: сводка по функциям и пути к сохранённым файлам."""
+
+    def __init__(self, mode: str, seconds: float, summary: str, files: Dict[str, str]):
+        self.mode = mode
+        self.seconds = seconds
+        self.summary = summary
+        self.files = files
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def sample_stacks(seconds: float, interval: float = PROFILE_INTERVAL) -> Counter:
+    """
+    Снимает стеки всех потоков, кроме текущего, в течение seconds секунд.
+    Вызывается в отдельном потоке.
+
+    Returns:
+        Counter: Свёрнутый стек "поток;функция;...;функция" -> число выборок
+    """
+    own = threading.get_ident()
+    stacks = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            labels.append(names.get(thread_id, str(thread_id)))
+            stacks[";".join(reversed(labels))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def summarize_stacks(stacks: Counter, thread: Optional[str] = None, top: int = PROFILE_TOP) -> str:
+    """
+    Доля выборок по потокам и функции потока thread (по умолчанию всех
+    потоков) по доле выборок, в которых они были в стеке (включая вызванные
+    ими), и по доле, где они выполнялись сами.
+    """
+    threads = Counter()
+    for stack, count in stacks.items():
+        threads[stack.split(";", 1)[0]] += count
+    selected = {stack: count for stack, count in stacks.items() if thread is None or stack.split(";", 1)[0] == thread}
+    total = sum(selected.values())
+    if not total:
+        return "Выборок нет."
+    inclusive = Counter()
+    own = Counter()
+    for stack, count in selected.items():
+        frames = stack.split(";")[1:]
+        for label in set(frames):
+            inclusive[label] += count
+        if frames:
+            own[frames[-1]] += count
+    lines = [
+        "Выборок по потокам: " + ", ".join(f"{name} {count}" for name, count in threads.most_common()),
+        f"Поток {thread}:" if thread else "Все потоки:",
+        "всего%  сама%  функция",
+    ]
+    for label, count in inclusive.most_common(top):
+        lines.append(f"{count * 100 / total:5.1f}  {own[label] * 100 / total:5.1f}  {label}")
+    return "\n".join(lines)
+
+
+_active = False
+
+
+async def _run_sampler(seconds: float, stamp: str) -> ProfileResult:
+    # В сводку — поток цикла событий бота, в файл — все потоки
+    loop_thread = threading.current_thread().name
+    stacks = await asyncio.to_thread(sample_stacks, seconds)
+    summary = summarize_stacks(stacks, loop_thread)
+    collapsed = "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+    files = {
+        "collapsed": os.path.join(PROFILE_DIR, f"profile-{stamp}.collapsed"),
+        "summary": os.path.join(PROFILE_DIR, f"profile-{stamp}.txt"),
+    }
+    await write_text(files["collapsed"], collapsed)
+    await write_text(files["summary"], summary + "\n")
+    return ProfileResult("sampler", seconds, summary, files)
+
+
+async def _run_cprofile(seconds: float, stamp: str) -> ProfileResult:
+    # cProfile действует на поток, где включён, то есть на цикл событий бота со всеми обработчиками
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(PROFILE_TOP)
+    summary = output.getvalue().strip()
+    files = {
+        "pstats": os.path.join(PROFILE_DIR, f"profile-{stamp}.prof"),
+        "summary": os.path.join(PROFILE_DIR, f"profile-{stamp}.txt"),
+    }
+    await run_io(profiler.dump_stats, files["pstats"])
+    await write_text(files["summary"], summary + "\n")
+    return ProfileResult("cprofile", seconds, summary, files)
+
+
+async def profile(seconds: float, mode: str = "sampler") -> ProfileResult:
+    """
+    Профилирует бота seconds секунд и сохраняет результат в PROFILE_DIR.
+
+    Вызывать в цикле событий бота (runtime.run), иначе cprofile измерит не тот поток.
+
+    Raises:
+        ValueError: Неизвестный режим или недопустимая длительность
+        ProfileBusyError: Если замер уже идёт
+    """
+    global _active
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"Неизвестный режим профилирования: {mode}, доступны {', '.join(PROFILE_MODES)}")
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise ValueError(f"Длительность замера — от 1 до {PROFILE_MAX_SECONDS} секунд")
+    if _active:
+        raise ProfileBusyError("Профилирование уже идёт, дождитесь окончания")
+    _active = True
+    try:
+        await run_io(os.makedirs, PROFILE_DIR, exist_ok=True)
+        stamp = f"{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}"
+        logger.info(f"Профилирование ({mode}) на {seconds:.0f} с")
+        if mode == "cprofile":
+            result = await _run_cprofile(seconds, stamp)
+        else:
+            result = await _run_sampler(seconds, stamp)
+        logger.info(f"Профилирование завершено, результаты: {', '.join(result.files.values())}")
+        return result
+    finally:
+        _active = False
+
+
+def parse_profile_args(args: List[str], default_seconds: int = 30) -> tuple:
+    """
+    Разбирает аргументы команды: длительность и режим в любом порядке.
+
+    Returns:
+        tuple: (секунды, режим)
+    """
+    seconds: Optional[float] = None
+    mode = "sampler"
+    for arg in args:
+        if arg in PROFILE_MODES:
+            mode = arg
+        else:
+            seconds = float(arg)
+    return (seconds if seconds is not None else default_seconds), mode
@@ -0,0 +1,119 @@
+import logging
+import math
+import os
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Параметры построения промпта
+PROMPT_HISTORY_TOKEN_BUDGET = int(os.getenv("PROMPT_HISTORY_TOKEN_BUDGET", "1500"))  # Токенов на историю диалога
+PROMPT_OLD_TURN_TOKENS = int(os.getenv("PROMPT_OLD_TURN_TOKENS", "200"))  # Старые реплики сокращаются до этого размера
+PROMPT_CHARS_PER_TOKEN = float(os.getenv("PROMPT_CHARS_PER_TOKEN", "3"))  # Примерно символов на токен для русского текста
+
+ROLE_SYSTEM = "system"
+ROLE_USER = "user"
+ROLE_ASSISTANT = "assistant"
+
+# Префиксы, с которыми история хранилась до перехода на структурированные реплики
+_LEGACY_PREFIXES = (("Пользователь: ", ROLE_USER), ("Валера: ", ROLE_ASSISTANT))
+
+# Системный промпт для Валеры
+VALERA_SYSTEM_PROMPT = (
+    "Ты — Валера, суровый, но добрый помощник. Ты опытный наладчик ЧПУ, программист и юрист, который прошёл через всё. "
+    "Отвечаешь строго, с юмором и сарказмом, как настоящий наставник. Если пользователь пишет ерунду — мягко подкалываешь, но всегда помогаешь. "
+    "Отвечай по темам ЧПУ, металлообработки, выбора инструмента, режимов резания (Vc, F, Ap, RPM, СОЖ), G-кода, наладки станков и программирования. "
+    "Также ты — юридический защитник. Отвечай на вопросы о правах работников в РФ, жалобах, увольнении, больничных, трудовых конфликтах. "
+    "Если вопрос юридический — защищай пользователя, поддерживай, дай понять, что он не один. "
+    "Если вопрос технический — объясни чётко, с примерами и смыслом. "
+    "Если вопрос неполный — **обязательно уточняй**. Если непонятный — **переспрашивай**. "
+    "Будь как хороший наставник в цеху: ворчливый, но надёжный. Не пиши воду, а сразу план: что делать, куда идти, как поступить. "
+    "Добавляй примеры, шаги, конкретику. В конце каждого ответа — придумай **одну уникальную мотивирующую фразу в своём стиле**:\n"
+    "Примеры: 'Давай, не подведи!', 'Ты не один, я рядом с клавиатурой!', 'Ну ты и кадр... но с тобой весело!'.\n"
+    "Фраза должна быть каждый раз новой и в твоем стиле."
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Оценивает число токенов в тексте без обращения к API.
+
+    Оценка грубая (по числу символов), но её достаточно, чтобы держать промпт в бюджете.
+    """
+    return math.ceil(len(text) / PROMPT_CHARS_PER_TOKEN) if text else 0
+
+
+def truncate_to_tokens(text: str, tokens: int) -> str:
+    """Обрезает текст до примерно заданного числа токенов, отмечая сокращение многоточием."""
+    max_chars = int(tokens * PROMPT_CHARS_PER_TOKEN)
+    if len(text) <= max_chars:
+        return text
+    return text[:max(0, max_chars - 1)].rstrip() + "…"
+
+
+def make_turn(role: str, text: str) -> Dict:
+    """Реплика диалога в формате сообщений API Яндекс GPT."""
+    return {"role": role, "text": text}
+
+
+def normalize_turn(item) -> Optional[Dict]:
+    """Приводит реплику из истории к виду {"role", "text"}; понимает и старый строковый формат."""
+    if isinstance(item, dict) and "role" in item and "text" in item:
+        return item
+    if isinstance(item, str):
+        for prefix, role in _LEGACY_PREFIXES:
+            if item.startswith(prefix):
+                return make_turn(role, item[len(prefix):])
+        return make_turn(ROLE_USER, item)
+    return None
+
+
+def fit_history(history: List, budget: int = PROMPT_HISTORY_TOKEN_BUDGET,
+                old_turn_tokens: int = PROMPT_OLD_TURN_TOKENS) -> List[Dict]:
+    """
+    Отбирает историю диалога так, чтобы она уложилась в бюджет токенов.
+
+    Последняя пара реплик (вопрос и ответ) берётся целиком, если каждая
+    занимает не больше половины бюджета; более старые сокращаются до
+    old_turn_tokens. Реплики добавляются от новых к старым, пока хватает
+    бюджета; всё, что не поместилось, отбрасывается.
+
+    Returns:
+        List[Dict]: Реплики в хронологическом порядке
+    """
+    turns = [turn for turn in (normalize_turn(item) for item in history) if turn]
+    selected = []
+    used = 0
+    for position, turn in enumerate(reversed(turns)):
+        limit = budget // 2 if position < 2 else old_turn_tokens
+        text = truncate_to_tokens(turn["text"], limit)
+        cost = estimate_tokens(text)
+        if used + cost > budget:
+            remaining = budget - used
+            # Если влезает хотя бы осмысленный кусок, берём его, иначе заканчиваем
+            if remaining >= 20:
+                selected.append(make_turn(turn["role"], truncate_to_tokens(text, remaining)))
+            break
+        selected.append(make_turn(turn["role"], text))
+        used += cost
+    selected.reverse()
+    # Диалог не должен начинаться с ответа ассистента, оставшегося без вопроса
+    while selected and selected[0]["role"] == ROLE_ASSISTANT:
+        selected.pop(0)
+    return selected
+
+
+def build_messages(question: str, history: List, system_prompt: str = VALERA_SYSTEM_PROMPT,
+                   budget: int = PROMPT_HISTORY_TOKEN_BUDGET) -> List[Dict]:
+    """
+    Собирает список сообщений для API: системная роль, история в бюджете и вопрос.
+
+    Returns:
+        List[Dict]: Сообщения в формате API Яндекс GPT
+    """
+    messages = [make_turn(ROLE_SYSTEM, system_prompt)]
+    messages.extend(fit_history(history, budget))
+    messages.append(make_turn(ROLE_USER, question))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Промпт собран: %d сообщений, ~%d токенов",
+                     len(messages), sum(estimate_tokens(m['text']) for m in messages))
+    return messages
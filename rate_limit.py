@@ -0,0 +1,217 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Deque, Dict, Hashable, Optional
+
+
+class TokenBucket:
+    """
+    Ограничитель частоты по алгоритму "ведро с токенами".
+
+    Ведро пополняется со скоростью rate токенов в секунду и вмещает не больше
+    capacity токенов, поэтому допускаются короткие всплески до capacity запросов.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        """Забирает токены, если они есть. Не ждёт."""
+        if time.monotonic() < self._paused_until:
+            return False
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    def wait_time(self, tokens: float = 1) -> float:
+        """Через сколько секунд будет доступно нужное число токенов."""
+        self._refill()
+        pause = max(0.0, self._paused_until - time.monotonic())
+        return max(pause, (tokens - self._tokens) / self.rate if self._tokens < tokens else 0.0)
+
+    async def acquire(self, tokens: float = 1) -> None:
+        """Ждёт, пока в ведре появятся токены, и забирает их."""
+        # Ожидающие выстраиваются в очередь на блокировке, поэтому токены раздаются по порядку
+        async with self._lock:
+            while not self.try_acquire(tokens):
+                await asyncio.sleep(self.wait_time(tokens))
+
+    def pause(self, seconds: float) -> None:
+        """Приостанавливает выдачу токенов, например после RetryAfter от Telegram."""
+        self._refill()
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+
+class KeyedRateLimiter:
+    """
+    Отдельное ведро с токенами для каждого ключа (например, пользователя).
+
+    Вёдра, которые давно не использовались и успели наполниться, удаляются,
+    чтобы память не росла с числом пользователей.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None, cleanup_every: int = 1000):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.cleanup_every = cleanup_every
+        self._buckets: Dict[Hashable, TokenBucket] = {}
+        self._calls = 0
+
+    def _cleanup(self) -> None:
+        full_after = self.capacity / self.rate if self.rate > 0 else float("inf")
+        now = time.monotonic()
+        for key in [key for key, bucket in self._buckets.items() if now - bucket._updated >= full_after]:
+            del self._buckets[key]
+
+    def try_acquire(self, key: Hashable, tokens: float = 1) -> bool:
+        """Забирает токены из ведра ключа, если они есть. Не ждёт."""
+        self._calls += 1
+        if self._calls % self.cleanup_every == 0:
+            self._cleanup()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+        return bucket.try_acquire(tokens)
+
+    def wait_time(self, key: Hashable, tokens: float = 1) -> float:
+        """Через сколько секунд у ключа будет доступно нужное число токенов."""
+        bucket = self._buckets.get(key)
+        return bucket.wait_time(tokens) if bucket is not None else 0.0
+
+
+class QueueFullError(Exception):
+    """Очередь FairQueue заполнена, запрос не принят."""
+
+
+class FairQueue:
+    """
+    Ограничение числа одновременных операций со справедливой очередью.
+
+    Одновременно выполняется не больше max_concurrent операций. Остальные
+    ждут в очередях по ключам (пользователям), а освободившееся место
+    отдаётся ключам по кругу: пользователь с десятью запросами в очереди
+    не задерживает того, у кого запрос один.
+
+    Использование:
+        async with fair_queue.slot(user_id, on_wait=notify):
+            ...
+    где on_wait(position) — необязательная корутина, которую вызывают,
+    когда запрос встаёт в очередь и когда меняется его позиция.
+    """
+
+    def __init__(self, max_concurrent: int, max_waiting: int = 0, update_interval: float = 3.0):
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting  # 0 — без ограничения
+        self.update_interval = update_interval
+        self.active = 0
+        self._waiting = 0
+        # ключ -> очередь ожидающих; порядок ключей — порядок обхода по кругу
+        self._queues: "OrderedDict[Hashable, Deque[asyncio.Future]]" = OrderedDict()
+
+    @property
+    def waiting(self) -> int:
+        return self._waiting
+
+    def position(self, key: Hashable, waiter: asyncio.Future) -> int:
+        """Позиция ожидающего в общей очереди с учётом обхода по кругу (1 — следующий)."""
+        own_queue = self._queues.get(key)
+        if own_queue is None or waiter not in own_queue:
+            return 0
+        rank = own_queue.index(waiter)
+        position = rank + 1
+        before = True
+        for other_key, queue in self._queues.items():
+            if other_key == key:
+                before = False
+                continue
+            # Ключи впереди по кругу успеют пройти на один запрос больше
+            position += min(len(queue), rank + 1 if before else rank)
+        return position
+
+    def _grant_next(self) -> None:
+        while self._queues and self.active < self.max_concurrent:
+            key, queue = next(iter(self._queues.items()))
+            waiter = queue.popleft()
+            self._waiting -= 1
+            # Ключ уходит в конец круга (или из очереди, если у него больше нет запросов)
+            if queue:
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+            if not waiter.done():
+                self.active += 1
+                waiter.set_result(None)
+
+    def _remove(self, key: Hashable, waiter: asyncio.Future) -> None:
+        queue = self._queues.get(key)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            self._waiting -= 1
+            if not queue:
+                del self._queues[key]
+
+    async def acquire(self, key: Hashable, on_wait: Optional[Callable[[int], Awaitable[None]]] = None) -> None:
+        """
+        Занимает место, при необходимости дожидаясь своей очереди.
+
+        Raises:
+            QueueFullError: Если в очереди уже max_waiting запросов
+        """
+        if self.active < self.max_concurrent and not self._queues:
+            self.active += 1
+            return
+        if self.max_waiting and self._waiting >= self.max_waiting:
+            raise QueueFullError("Очередь заполнена")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(key, deque()).append(waiter)
+        self._waiting += 1
+        last_position = None
+        try:
+            while True:
+                position = self.position(key, waiter)
+                if on_wait is not None and position and position != last_position:
+                    last_position = position
+                    await on_wait(position)
+                if waiter.done():
+                    return
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter), timeout=self.update_interval)
+                    return
+                except asyncio.TimeoutError:
+                    continue
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                # Место уже выдано, но ожидающий отменён — возвращаем его следующему
+                self.release()
+            else:
+                waiter.cancel()
+                self._remove(key, waiter)
+            raise
+
+    def release(self) -> None:
+        """Освобождает место и отдаёт его следующему по кругу."""
+        self.active -= 1
+        self._grant_next()
+
+    @asynccontextmanager
+    async def slot(self, key: Hashable, on_wait: Optional[Callable[[int], Awaitable[None]]] = None):
+        await self.acquire(key, on_wait)
+        try:
+            yield
+        finally:
+            self.release()
@@ -1,14 +1,426 @@
+import asyncio
+import bisect
+import glob
+import json
 import logging
-import os  # Добавляем импорт модуля os
+import os
+import re
+import threading
+import time
+import uuid
+from datetime import date, datetime
+from typing import Dict, List, Optional, Set, Tuple
+from storage import run_io
 
-REPORTS_FILE = "reports.txt"
+# Журнал анонимных сообщений: одна JSON-запись на строку
+REPORTS_FILE = os.getenv("REPORTS_FILE", "reports.jsonl")
+# Когда сбрасывать записи на диск через fsync:
+#   always — перед подтверждением каждой пачки записей (надёжнее всего);
+#   batch  — не чаще раза в REPORTS_FSYNC_INTERVAL секунд;
+#   never  — оставить это операционной системе
+REPORTS_FSYNC = os.getenv("REPORTS_FSYNC", "batch")
+REPORTS_FSYNC_INTERVAL = float(os.getenv("REPORTS_FSYNC_INTERVAL", "1"))
+REPORTS_BATCH_DELAY = float(os.getenv("REPORTS_BATCH_DELAY", "0.05"))  # Сколько ждать, собирая пачку, секунды
+REPORTS_MAX_BYTES = int(os.getenv("REPORTS_MAX_BYTES", str(10 * 1024 * 1024)))  # Размер файла до ротации
+# Прежний текстовый журнал (строки "user_id: текст"); переносится в REPORTS_FILE при запуске
+LEGACY_REPORTS_FILE = os.getenv("LEGACY_REPORTS_FILE", "reports.txt")
 
-# Сохраняем анонимное сообщение в файл
-def save_report(user_id, message):
+_FSYNC_POLICIES = ("always", "batch", "never")
+_WORD_RE = re.compile(r"\w+")
+_LEGACY_RECORD_RE = re.compile(r"^(\d+): (.*)$")
+
+
+def parse_legacy_reports(text: str, ts: str) -> List[Dict]:
+    """
+    Разбирает прежний журнал reports.txt. Запись начинается строкой "user_id: текст",
+    остальные строки — продолжение многострочного сообщения предыдущей записи.
+    Времени в старом формате нет, поэтому всем записям ставится ts.
+    """
+    records = []
+    for line in text.splitlines():
+        match = _LEGACY_RECORD_RE.match(line)
+        if match:
+            records.append({
+                "id": uuid.uuid4().hex[:12],
+                "ts": ts,
+                "user_id": int(match.group(1)),
+                "text": match.group(2),
+                "source": LEGACY_REPORTS_FILE,
+            })
+        elif records:
+            records[-1]["text"] += "\n" + line
+        elif line.strip():
+            # Начало файла без user_id — сохраняем, чтобы не потерять текст
+            records.append({"id": uuid.uuid4().hex[:12], "ts": ts, "user_id": None, "text": line,
+                            "source": LEGACY_REPORTS_FILE})
+    return records
+
+
+def migrate_legacy_reports(path: str = REPORTS_FILE) -> None:
+    """
+    Однократно переносит сообщения из LEGACY_REPORTS_FILE в журнал JSON Lines,
+    чтобы они были видны в /reports и /reports_search.
+
+    Старый файл сначала переименовывается в *.imported — так его переносит
+    только один процесс (воркеры кластера запускаются одновременно), а при
+    ошибке текст остаётся в переименованном файле. Записи пишутся в отдельный
+    файл журнала <REPORTS_FILE>-legacy, который индекс читает вместе с остальными.
+    """
+    if not os.path.exists(LEGACY_REPORTS_FILE):
+        return
+    imported_path = f"{LEGACY_REPORTS_FILE}.imported"
+    try:
+        os.replace(LEGACY_REPORTS_FILE, imported_path)
+    except FileNotFoundError:
+        # Файл уже забрал другой процесс
+        return
     try:
-        with open(REPORTS_FILE, "a", encoding="utf-8") as f:
-            f.write(f"{user_id}: {message}\n")
+        ts = datetime.fromtimestamp(os.path.getmtime(imported_path)).isoformat(timespec="seconds")
+        with open(imported_path, "r", encoding="utf-8", errors="replace") as f:
+            records = parse_legacy_reports(f.read(), ts)
+        root, ext = os.path.splitext(path)
+        target = f"{root}-legacy{ext}"
+        tmp_path = f"{target}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+        os.replace(tmp_path, target)
+        logging.info(f"Перенесено {len(records)} сообщений из {LEGACY_REPORTS_FILE} в {target}, старый файл: {imported_path}")
+    except Exception as e:
+        logging.error(f"Ошибка при переносе сообщений из {LEGACY_REPORTS_FILE} (текст сохранён в {imported_path}): {e}")
+
+
+def _journal_files(path: str) -> List[str]:
+    """Все файлы журнала: текущий, файлы других процессов и ротированные."""
+    root, ext = os.path.splitext(path)
+    return sorted(set(glob.glob(f"{glob.escape(root)}*{ext}")))
+
+
+class ReportJournal:
+    """
+    Журнал анонимных сообщений в формате JSON Lines.
+
+    Записи копятся в памяти и пишутся пачками одним вызовом в пуле потоков
+    хранилища (групповой коммит): во время наплыва сообщений на диск уходит
+    одна запись и один fsync на пачку, а не на каждое сообщение.
+    save() возвращается, когда пачка записана с учётом политики fsync.
+    Когда файл превышает max_bytes, он переименовывается в файл с меткой
+    времени, и запись продолжается в новый.
+    """
+
+    def __init__(self, path: str = REPORTS_FILE, fsync: str = REPORTS_FSYNC,
+                 fsync_interval: float = REPORTS_FSYNC_INTERVAL, batch_delay: float = REPORTS_BATCH_DELAY,
+                 max_bytes: int = REPORTS_MAX_BYTES):
+        if fsync not in _FSYNC_POLICIES:
+            logging.warning(f"Неизвестная политика REPORTS_FSYNC={fsync}, используем batch")
+            fsync = "batch"
+        self.path = path
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.batch_delay = batch_delay
+        self.max_bytes = max_bytes
+        self._pending: List[Tuple[bytes, asyncio.Future]] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._writer: Optional[asyncio.Task] = None
+        self._closing = False
+        self._file = None
+        self._last_fsync = 0.0
+
+    # --- Запись (выполняется в пуле потоков) ---
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.path, "ab")
+        return self._file
+
+    def _rotate(self) -> None:
+        self._file.close()
+        self._file = None
+        root, ext = os.path.splitext(self.path)
+        rotated = f"{root}-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}{ext}"
+        os.replace(self.path, rotated)
+        logging.info(f"Журнал сообщений ротирован в {rotated}")
+
+    def _write_batch(self, lines: List[bytes]) -> None:
+        f = self._open()
+        f.write(b"".join(lines))
+        f.flush()
+        now = time.monotonic()
+        if self.fsync == "always" or (self.fsync == "batch" and now - self._last_fsync >= self.fsync_interval):
+            os.fsync(f.fileno())
+            self._last_fsync = now
+        if f.tell() >= self.max_bytes:
+            if self.fsync != "never":
+                os.fsync(f.fileno())
+            self._rotate()
+
+    def _close_file(self) -> None:
+        if self._file is not None:
+            if self.fsync != "never":
+                os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+
+    # --- Групповой коммит ---
+
+    async def _write_loop(self) -> None:
+        while not (self._closing and not self._pending):
+            await self._wakeup.wait()
+            # Даём набежать соседним записям, чтобы записать их одной пачкой
+            if self.batch_delay > 0 and not self._closing:
+                await asyncio.sleep(self.batch_delay)
+            self._wakeup.clear()
+            batch, self._pending = self._pending, []
+            if not batch:
+                continue
+            try:
+                await run_io(self._write_batch, [line for line, _ in batch])
+            except Exception as e:
+                logging.error(f"Ошибка при записи журнала сообщений: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+
+    def _ensure_writer(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._writer is None or self._writer.done() or self._writer.get_loop() is not loop:
+            self._wakeup = asyncio.Event()
+            self._writer = loop.create_task(self._write_loop())
+
+    async def save(self, user_id, message: str) -> Dict:
+        """
+        Добавляет запись в журнал и ждёт, пока её пачка будет записана.
+
+        Returns:
+            Dict: Сохранённая запись
+        """
+        record = {
+            "id": uuid.uuid4().hex[:12],
+            "ts": datetime.now().isoformat(timespec="seconds"),
+            "user_id": user_id,
+            "text": message,
+        }
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        self._ensure_writer()
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((line, future))
+        self._wakeup.set()
+        await future
+        return record
+
+    async def close(self) -> None:
+        """Дописывает накопленные записи и закрывает файл."""
+        if self._writer is not None and not self._writer.done():
+            self._closing = True
+            self._wakeup.set()
+            await self._writer
+        self._writer = None
+        self._closing = False
+        await run_io(self._close_file)
+
+
+def tokenize(text: str) -> List[str]:
+    """Слова текста для поискового индекса: в нижнем регистре, ё заменена на е."""
+    return [word for word in _WORD_RE.findall(text.lower().replace("ё", "е")) if len(word) > 1]
+
+
+class _FileIndex:
+    __slots__ = ("inode", "size", "entries", "postings")
+
+    def __init__(self, inode: int):
+        self.inode = inode
+        self.size = 0
+        # Записи файла по порядку: (ts, смещение)
+        self.entries: List[Tuple[str, int]] = []
+        # слово -> смещения записей, в которых оно встречается
+        self.postings: Dict[str, List[int]] = {}
+
+
+class ReportIndex:
+    """
+    Индекс журнала для просмотра сообщений администратором: по датам и по словам.
+
+    Для каждого файла журнала хранится список (время, смещение) его записей
+    и обратный индекс «слово -> смещения». Файл дочитывается с последнего
+    проиндексированного места, поэтому повторные запросы не перечитывают
+    журнал целиком. Сами записи читаются по смещениям только для
+    запрошенной страницы.
+
+    Поиск ищет записи, содержащие все слова запроса; слово запроса
+    совпадает с началом слова в тексте («увол» найдёт «уволили» и «увольнение»).
+    """
+
+    def __init__(self, path: str = REPORTS_FILE):
+        self.path = path
+        self._files: Dict[str, _FileIndex] = {}
+        # слово -> файлы, где оно встречается; отсортированный словарь для поиска по началу слова
+        self._vocabulary: Dict[str, Set[str]] = {}
+        self._sorted_words: Optional[List[str]] = None
+        # Страницы запрашиваются из нескольких потоков пула
+        self._lock = threading.Lock()
+
+    def _drop_file(self, file_path: str) -> None:
+        index = self._files.pop(file_path, None)
+        if index is None:
+            return
+        for word in index.postings:
+            files = self._vocabulary.get(word)
+            if files is not None:
+                files.discard(file_path)
+                if not files:
+                    del self._vocabulary[word]
+                    self._sorted_words = None
+
+    def _index_file(self, file_path: str) -> None:
+        stat = os.stat(file_path)
+        index = self._files.get(file_path)
+        if index is not None and (index.inode != stat.st_ino or stat.st_size < index.size):
+            # На этом месте уже другой файл (после ротации) — индексируем заново
+            self._drop_file(file_path)
+            index = None
+        if index is None:
+            index = self._files[file_path] = _FileIndex(stat.st_ino)
+        if stat.st_size == index.size:
+            return
+        with open(file_path, "rb") as f:
+            f.seek(index.size)
+            offset = index.size
+            for line in f:
+                # Недописанную последнюю строку оставляем до следующего раза
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                    index.entries.append((record["ts"], offset))
+                    for word in set(tokenize(record.get("text", ""))):
+                        index.postings.setdefault(word, []).append(offset)
+                        files = self._vocabulary.setdefault(word, set())
+                        if file_path not in files:
+                            files.add(file_path)
+                            self._sorted_words = None
+                except (ValueError, KeyError):
+                    logging.warning(f"Повреждённая запись в {file_path} по смещению {offset}")
+                offset += len(line)
+        index.size = offset
+
+    def refresh(self) -> None:
+        files = _journal_files(self.path)
+        for file_path in list(self._files):
+            if file_path not in files:
+                self._drop_file(file_path)
+        for file_path in files:
+            try:
+                self._index_file(file_path)
+            except FileNotFoundError:
+                # Файл ротировали между поиском и чтением
+                self._drop_file(file_path)
+
+    def entries(self, day: Optional[date] = None) -> List[Tuple[str, str, int]]:
+        """Записи (ts, файл, смещение) за день или за всё время, от новых к старым."""
+        prefix = day.isoformat() if day else ""
+        selected = [
+            (ts, file_path, offset)
+            for file_path, index in self._files.items()
+            for ts, offset in index.entries
+            if ts.startswith(prefix)
+        ]
+        selected.sort(reverse=True)
+        return selected
+
+    def _words_with_prefix(self, prefix: str) -> List[str]:
+        if self._sorted_words is None:
+            self._sorted_words = sorted(self._vocabulary)
+        words = []
+        position = bisect.bisect_left(self._sorted_words, prefix)
+        while position < len(self._sorted_words) and self._sorted_words[position].startswith(prefix):
+            words.append(self._sorted_words[position])
+            position += 1
+        return words
+
+    def search(self, query: str) -> List[Tuple[str, str, int]]:
+        """Записи (ts, файл, смещение), содержащие все слова запроса, от новых к старым."""
+        query_words = tokenize(query)
+        if not query_words:
+            return []
+        # Для каждого слова запроса — файлы и смещения записей, где оно встречается
+        matches_per_word = []
+        for query_word in query_words:
+            matches: Dict[str, Set[int]] = {}
+            for word in self._words_with_prefix(query_word):
+                for file_path in self._vocabulary[word]:
+                    matches.setdefault(file_path, set()).update(self._files[file_path].postings[word])
+            if not matches:
+                return []
+            matches_per_word.append(matches)
+
+        selected = []
+        for file_path, offsets in matches_per_word[0].items():
+            for matches in matches_per_word[1:]:
+                offsets = offsets & matches.get(file_path, set())
+            if offsets:
+                selected.extend(
+                    (ts, file_path, offset) for ts, offset in self._files[file_path].entries if offset in offsets
+                )
+        selected.sort(reverse=True)
+        return selected
+
+    @staticmethod
+    def read_records(entries: List[Tuple[str, str, int]]) -> List[Dict]:
+        records = []
+        for _, file_path, offset in entries:
+            try:
+                with open(file_path, "rb") as f:
+                    f.seek(offset)
+                    records.append(json.loads(f.readline()))
+            except (OSError, ValueError) as e:
+                logging.error(f"Не удалось прочитать запись {file_path}:{offset}: {e}")
+        return records
+
+    def _page(self, day: Optional[date], query: Optional[str], offset: int, limit: int) -> Tuple[List[Dict], int]:
+        with self._lock:
+            self.refresh()
+            entries = self.search(query) if query else self.entries(day)
+        return self.read_records(entries[offset:offset + limit]), len(entries)
+
+    async def page(self, day: Optional[date] = None, offset: int = 0, limit: int = 10) -> Tuple[List[Dict], int]:
+        """
+        Возвращает страницу сообщений (от новых к старым) и их общее число.
+
+        Args:
+            day (Optional[date]): Дата сообщений; None — за всё время
+            offset (int): Сколько записей пропустить
+            limit (int): Размер страницы
+        """
+        return await run_io(self._page, day, None, offset, limit)
+
+    async def search_page(self, query: str, offset: int = 0, limit: int = 10) -> Tuple[List[Dict], int]:
+        """Возвращает страницу найденных сообщений (от новых к старым) и их общее число."""
+        return await run_io(self._page, None, query, offset, limit)
+
+
+report_journal = ReportJournal()
+report_index = ReportIndex()
+
+# Сохраняем анонимное сообщение в журнал
+async def save_report(user_id, message):
+    try:
+        await report_journal.save(user_id, message)
         logging.info(f"Сообщение от {user_id} сохранено")
     except Exception as e:
         logging.error(f"Ошибка при сохранении отчёта: {e}")
-        raise
\ No newline at end of file
+        raise
+
+# Страница сообщений для просмотра администратором
+async def list_reports(day=None, offset=0, limit=10):
+    return await report_index.page(day, offset, limit)
+
+# Поиск сообщений по словам для администратора
+async def search_reports(query, offset=0, limit=10):
+    return await report_index.search_page(query, offset, limit)
+
+# Закрываем журнал при остановке бота
+async def close_reports():
+    await report_journal.close()
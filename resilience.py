@@ -0,0 +1,236 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class TransientError(Exception):
+    """
+    Временная ошибка внешнего сервиса (429, 5xx, таймаут, обрыв соединения), запрос стоит повторить.
+
+    retry_after — сколько секунд сервис просит подождать (заголовок Retry-After), если он это сообщил.
+    rejected — сервис точно не принял запрос (ответил 429/5xx или соединение не установилось);
+    при таймауте или обрыве после отправки запрос мог быть выполнен.
+    """
+
+    def __init__(self, message: str, retry_after: Optional[float] = None, rejected: bool = False):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.rejected = rejected
+
+
+class CircuitOpenError(Exception):
+    """Автомат разомкнут: сервис недавно много раз подряд не отвечал, запрос не отправляется."""
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Разбирает заголовок Retry-After в секундах (формат с датой не поддерживается)."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+class RetryPolicy:
+    """
+    Повторы с экспоненциальной задержкой и случайным разбросом (full jitter).
+
+    Задержка перед повтором n — случайное число от 0 до min(max_delay, base_delay * 2^n):
+    разброс не даёт всем клиентам повторить запрос одновременно. Если сервис
+    прислал Retry-After, ждём не меньше; если он просит ждать дольше
+    max_delay, запрос не повторяется.
+
+    Для неидемпотентных запросов (например, создание платной операции)
+    only_rejected=True: повторяются только ошибки, после которых сервис точно
+    не принял запрос, иначе повтор может выполнить его второй раз.
+    """
+
+    def __init__(self, max_retries: int = 2, base_delay: float = 0.5, max_delay: float = 10.0,
+                 only_rejected: bool = False):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.only_rejected = only_rejected
+
+    def delay(self, retry: int, retry_after: Optional[float] = None) -> Optional[float]:
+        """
+        Returns:
+            Optional[float]: Задержка перед повтором retry (с нуля) или None, если повторять не нужно
+        """
+        if retry >= self.max_retries:
+            return None
+        if retry_after is not None and retry_after > self.max_delay:
+            return None
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+        return max(delay, retry_after or 0.0)
+
+
+class CircuitBreaker:
+    """
+    Автоматический выключатель для внешнего сервиса.
+
+    После failure_threshold временных ошибок подряд размыкается, и запросы
+    сразу отклоняются, не дожидаясь таймаутов. Через reset_timeout секунд
+    пропускает один пробный запрос: если он успешен, выключатель замыкается,
+    если нет — снова размыкается.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    def allow(self) -> bool:
+        """Можно ли отправить запрос сейчас."""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+        if self.state == self.HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        if self.state != self.CLOSED:
+            logger.info(f"Выключатель {self.name} замкнут: сервис снова отвечает")
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.error(f"Выключатель {self.name} разомкнут после {self.failures} ошибок подряд")
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+    def release_probe(self) -> None:
+        """Пробный запрос прерван, не дав ответа: следующий запрос снова может стать пробным."""
+        self._probe_in_flight = False
+
+    def retry_in(self) -> float:
+        """Через сколько секунд выключатель пропустит пробный запрос."""
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+
+class LatencyTracker:
+    """Скользящее окно длительностей успешных запросов для оценки перцентилей."""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+
+    def record(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        """Перцентиль длительности или None, пока замеров слишком мало."""
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def hedged(attempt: Callable[[], Awaitable[T]], delay: Optional[float]) -> T:
+    """
+    Выполняет запрос с подстраховкой (hedged request).
+
+    Если первая попытка не ответила за delay секунд, параллельно отправляется
+    вторая; возвращается первый успешный ответ, вторая попытка отменяется.
+    Если первая попытка завершилась ошибкой раньше, ошибка пробрасывается
+    (повторами занимается вызывающий код).
+    """
+    if delay is None:
+        return await attempt()
+    tasks = [asyncio.ensure_future(attempt())]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if done:
+            return tasks[0].result()
+        logger.debug("Запрос не ответил за %.2f с, отправляем подстраховочный", delay)
+        tasks.append(asyncio.ensure_future(attempt()))
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+async def call_with_resilience(attempt: Callable[[], Awaitable[T]], policy: RetryPolicy,
+                               breaker: CircuitBreaker, latency: Optional[LatencyTracker] = None,
+                               hedge_percentile: Optional[float] = None, hedge_min_delay: float = 0.0) -> T:
+    """
+    Выполняет запрос с повторами, автоматическим выключателем и, по желанию, подстраховкой.
+
+    attempt — корутина-фабрика одной попытки; повторяются только TransientError.
+    Подстраховочный запрос отправляется, если попытка дольше hedge_percentile
+    (например, 0.95) от недавних длительностей, но не раньше hedge_min_delay секунд.
+
+    Raises:
+        CircuitOpenError: Если выключатель разомкнут
+        TransientError: Если все попытки завершились временными ошибками
+    """
+    retry = 0
+    while True:
+        if not breaker.allow():
+            raise CircuitOpenError(f"{breaker.name}: сервис недоступен, повтор через {breaker.retry_in():.0f} с")
+        hedge_delay = None
+        if latency is not None and hedge_percentile:
+            estimate = latency.percentile(hedge_percentile)
+            if estimate is not None:
+                hedge_delay = max(hedge_min_delay, estimate)
+        started = time.monotonic()
+        try:
+            result = await hedged(attempt, hedge_delay)
+        except TransientError as e:
+            breaker.record_failure()
+            if policy.only_rejected and not e.rejected:
+                raise
+            delay = policy.delay(retry, e.retry_after)
+            if delay is None:
+                raise
+            retry += 1
+            logger.warning(f"{breaker.name}: {e}; повтор {retry} из {policy.max_retries} через {delay:.2f} с")
+            await asyncio.sleep(delay)
+            continue
+        except Exception:
+            # Остальные ошибки (например, 400 на некорректный запрос) значат, что сервис ответил
+            breaker.record_success()
+            raise
+        except BaseException:
+            breaker.release_probe()
+            raise
+        breaker.record_success()
+        if latency is not None:
+            latency.record(time.monotonic() - started)
+        return result
@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import Future
+from typing import Awaitable, Callable, Dict, Optional
+from telegram import Update
+from metrics import counter, gauge, histogram
+from tracing import start_trace
+
+logger = logging.getLogger(__name__)
+
+UPDATE_SECONDS = histogram("cnc_update_seconds", "Время обработки обновления Telegram, включая ожидание своей очереди в чате")
+UPDATE_ERRORS = counter("cnc_update_errors_total", "Обновления, обработка которых завершилась ошибкой")
+UPDATES_REJECTED = counter("cnc_updates_rejected_total", "Обновления, отклонённые из-за переполненной очереди")
+UPDATE_QUEUE_DEPTH = gauge("cnc_update_queue_depth", "Обновлений в очереди на обработку")
+
+
+class BotRuntime:
+    """
+    Владелец цикла событий, в котором живёт Application бота.
+
+    Один цикл событий держит Application, его HTTP-клиент, очередь обновлений
+    и обработчики на всё время жизни процесса. Есть два режима:
+
+    - внутри чужого цикла (aiohttp-сервер): вызывать startup() и shutdown()
+      из хуков сервера;
+    - в собственном потоке (start_in_thread/stop_thread): для кода, который
+      сам не асинхронный, например процесса-воркера, читающего обновления из IPC.
+
+    Обновления из других потоков передаются через submit_update_threadsafe.
+
+    При ordered=True обновления одного чата обрабатываются строго по очереди
+    (остальные чаты обрабатываются параллельно), поэтому два сообщения
+    пользователя не меняют его сессию одновременно. Чат занимает не больше
+    одного обработчика: пока он занят, новые обновления чата откладываются
+    в его очередь, и их по порядку дорабатывает тот же обработчик, а
+    остальные обработчики свободны для других чатов.
+    """
+
+    def __init__(self, application, init_bot: Callable[[], Awaitable[None]],
+                 shutdown_bot: Callable[[], Awaitable[None]], workers: int = 8,
+                 queue_size: int = 1000, drain_timeout: float = 10.0, ordered: bool = True):
+        self.application = application
+        self.init_bot = init_bot
+        self.shutdown_bot = shutdown_bot
+        self.workers = workers
+        self.queue_size = queue_size
+        self.drain_timeout = drain_timeout
+        self.ordered = ordered
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.queue: Optional[asyncio.Queue] = None
+        self._worker_tasks = []
+        # chat_id -> отложенные обновления чата, который сейчас обрабатывается: (обновление, время получения)
+        self._chat_backlogs: Dict[int, deque] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._ready = threading.Event()
+        self._startup_error: Optional[BaseException] = None
+        UPDATE_QUEUE_DEPTH.set_function(self.queue_size_now)
+
+    @property
+    def running(self) -> bool:
+        return self.queue is not None
+
+    @property
+    def threaded(self) -> bool:
+        """Цикл событий бота работает в собственном потоке."""
+        return self._thread is not None
+
+    def queue_size_now(self) -> int:
+        return self.queue.qsize() if self.queue is not None else 0
+
+    async def _process(self, update: Update) -> None:
+        chat = update.effective_chat
+        with start_trace("update", update_id=update.update_id, chat_id=chat.id if chat else None):
+            await self.application.process_update(update)
+
+    async def _handle(self, update: Update, worker_id: int, received_at: float) -> None:
+        try:
+            await self._process(update)
+        except Exception as e:
+            UPDATE_ERRORS.inc()
+            logger.error(f"Ошибка при обработке обновления {update.update_id} в обработчике {worker_id}: {e}")
+            logger.error(traceback.format_exc())
+        finally:
+            UPDATE_SECONDS.observe(time.perf_counter() - received_at)
+            self.queue.task_done()
+
+    async def _handle_chat(self, chat_id: int, update: Update, worker_id: int) -> None:
+        backlog = self._chat_backlogs[chat_id] = deque()
+        try:
+            await self._handle(update, worker_id, time.perf_counter())
+            # Обновления, пришедшие в чат за это время, — по порядку поступления
+            while backlog:
+                update, received_at = backlog.popleft()
+                await self._handle(update, worker_id, received_at)
+        finally:
+            del self._chat_backlogs[chat_id]
+
+    async def _worker(self, worker_id: int) -> None:
+        while True:
+            update = await self.queue.get()
+            chat = update.effective_chat
+            if not self.ordered or chat is None:
+                await self._handle(update, worker_id, time.perf_counter())
+                continue
+            backlog = self._chat_backlogs.get(chat.id)
+            if backlog is not None:
+                # Чат уже обрабатывается: обновление доработает тот обработчик (и вызовет task_done),
+                # а этот не ждёт его и берёт следующее из общей очереди
+                backlog.append((update, time.perf_counter()))
+                continue
+            await self._handle_chat(chat.id, update, worker_id)
+
+    async def startup(self) -> None:
+        """Инициализирует бота и запускает обработчики очереди в текущем цикле событий."""
+        self.loop = asyncio.get_running_loop()
+        await self.init_bot()
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        for worker_id in range(self.workers):
+            self._worker_tasks.append(asyncio.create_task(self._worker(worker_id)))
+        logger.info(f"Запущено {self.workers} обработчиков обновлений")
+
+    async def shutdown(self) -> None:
+        """Дорабатывает очередь, останавливает обработчики и бота."""
+        if self.queue is not None:
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout=self.drain_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Не дождались обработки очереди, осталось {self.queue.qsize()} обновлений")
+
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks.clear()
+        self.queue = None
+
+        await self.shutdown_bot()
+
+    def enqueue(self, update: Update) -> bool:
+        """
+        Ставит обновление в очередь. Вызывается только из цикла событий бота.
+
+        Returns:
+            bool: False, если очередь переполнена
+        """
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            UPDATES_REJECTED.inc()
+            logger.error(f"Очередь обновлений переполнена, обновление {update.update_id} отклонено")
+            return False
+        logger.debug("Обновление %s поставлено в очередь (в очереди: %d)", update.update_id, self.queue.qsize())
+        return True
+
+    async def _enqueue_data(self, data: dict) -> bool:
+        try:
+            update = Update.de_json(data, self.application.bot)
+        except Exception as e:
+            raise ValueError(f"Некорректное обновление: {e}") from e
+        if update is None:
+            raise ValueError("Пустое обновление")
+        return self.enqueue(update)
+
+    async def accept(self, data: dict) -> bool:
+        """
+        Принимает обновление из веб-сервера в любом режиме работы.
+
+        Returns:
+            bool: False, если очередь переполнена
+
+        Raises:
+            ValueError: Если данные не являются обновлением Telegram
+        """
+        if self.threaded:
+            return await asyncio.wrap_future(self.submit_update_threadsafe(data))
+        return await self._enqueue_data(data)
+
+    async def run(self, coro):
+        """Выполняет корутину в цикле событий бота и возвращает результат."""
+        if self.threaded:
+            return await asyncio.wrap_future(self.run_threadsafe(coro))
+        return await coro
+
+    def submit_update_threadsafe(self, data: dict) -> Future:
+        """
+        Передаёт обновление (JSON от Telegram) в цикл событий бота из любого потока.
+
+        Returns:
+            concurrent.futures.Future: Результат enqueue (True, если принято)
+        """
+        return asyncio.run_coroutine_threadsafe(self._enqueue_data(data), self.loop)
+
+    def run_threadsafe(self, coro) -> Future:
+        """Выполняет корутину в цикле событий бота из любого потока."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def _thread_main(self) -> None:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.startup())
+        except BaseException as e:
+            self._startup_error = e
+            self._ready.set()
+            loop.close()
+            return
+        self._ready.set()
+        try:
+            loop.run_forever()
+        finally:
+            loop.run_until_complete(self.shutdown())
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.close()
+            logger.info("Цикл событий бота остановлен")
+
+    def start_in_thread(self, timeout: Optional[float] = 60) -> None:
+        """Запускает цикл событий бота в отдельном потоке и ждёт окончания инициализации."""
+        self._thread = threading.Thread(target=self._thread_main, name="bot-event-loop", daemon=True)
+        self._thread.start()
+        if not self._ready.wait(timeout):
+            raise RuntimeError("Бот не успел инициализироваться")
+        if self._startup_error is not None:
+            self._thread = None
+            raise RuntimeError(f"Ошибка инициализации бота: {self._startup_error}") from self._startup_error
+
+    def stop_thread(self, timeout: Optional[float] = 30) -> None:
+        """Останавливает цикл событий бота, запущенный start_in_thread."""
+        if self._thread is None:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+        self._thread = None
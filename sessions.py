@@ -0,0 +1,285 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import traceback
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from storage import run_io
+
+logger = logging.getLogger(__name__)
+
+# Параметры хранилища сессий
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")  # memory, sqlite или redis
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", "86400"))  # Сессия без активности удаляется, секунды
+SESSION_MAX_SESSIONS = int(os.getenv("SESSION_MAX_SESSIONS", "10000"))  # Лимит сессий в памяти
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(50 * 1024 * 1024)))  # Лимит памяти под сессии
+SESSION_DB = os.getenv("SESSION_DB", "sessions.db")
+SESSION_REDIS_URL = os.getenv("SESSION_REDIS_URL", "redis://localhost:6379/0")
+
+
+class Session:
+    """Состояние одного чата: текущий режим и история диалога с Валерой."""
+
+    __slots__ = ("role", "history", "last_seen")
+
+    def __init__(self, role: str, history: Optional[List] = None, last_seen: Optional[float] = None):
+        self.role = role
+        self.history = history if history is not None else []
+        self.last_seen = last_seen if last_seen is not None else time.time()
+
+    def to_dict(self) -> Dict:
+        return {"role": self.role, "history": self.history, "last_seen": self.last_seen}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "Session":
+        return cls(data["role"], list(data.get("history") or []), data.get("last_seen"))
+
+    def approx_size(self) -> int:
+        """Примерный объём сессии в памяти, байты."""
+        # Строки с кириллицей в CPython занимают по 2 байта на символ плюс заголовок объекта
+        return 200 + sum(64 + 2 * len(str(item)) for item in self.history)
+
+
+class SessionStore(ABC):
+    """
+    Базовый интерфейс хранилища сессий.
+
+    Все методы асинхронные, чтобы хранилище могло работать с диском или сетью,
+    не блокируя цикл событий. После изменения сессии её нужно сохранить через save.
+    """
+
+    @abstractmethod
+    async def get(self, chat_id: int) -> Optional[Session]:
+        ...
+
+    @abstractmethod
+    async def save(self, chat_id: int, session: Session) -> None:
+        ...
+
+    @abstractmethod
+    async def delete(self, chat_id: int) -> None:
+        ...
+
+    async def close(self) -> None:
+        pass
+
+    def stats(self) -> Dict:
+        return {}
+
+
+class MemorySessionStore(SessionStore):
+    """
+    Сессии в памяти процесса.
+
+    Сессии без активности дольше idle_ttl удаляются; при превышении лимита
+    числа сессий или занятой памяти вытесняются самые давно активные (LRU).
+    """
+
+    def __init__(self, idle_ttl: float = SESSION_IDLE_TTL, max_sessions: int = SESSION_MAX_SESSIONS,
+                 max_bytes: int = SESSION_MAX_BYTES):
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self._sessions: "OrderedDict[int, Session]" = OrderedDict()
+        self._sizes: Dict[int, int] = {}
+        self._total_bytes = 0
+        self.evicted = 0
+        self.expired = 0
+
+    def _remove(self, chat_id: int) -> None:
+        self._sessions.pop(chat_id, None)
+        self._total_bytes -= self._sizes.pop(chat_id, 0)
+
+    def _purge_expired(self) -> None:
+        # Самые давно активные сессии стоят в начале, поэтому проверяем только их
+        deadline = time.time() - self.idle_ttl
+        while self._sessions:
+            chat_id, session = next(iter(self._sessions.items()))
+            if session.last_seen >= deadline:
+                break
+            self._remove(chat_id)
+            self.expired += 1
+
+    async def get(self, chat_id: int) -> Optional[Session]:
+        session = self._sessions.get(chat_id)
+        if session is None:
+            return None
+        if time.time() - session.last_seen > self.idle_ttl:
+            self._remove(chat_id)
+            self.expired += 1
+            return None
+        # Чтение — тоже активность: сессия переходит в конец очереди на вытеснение
+        session.last_seen = time.time()
+        self._sessions.move_to_end(chat_id)
+        return session
+
+    async def save(self, chat_id: int, session: Session) -> None:
+        session.last_seen = time.time()
+        self._remove(chat_id)
+        size = session.approx_size()
+        self._sessions[chat_id] = session
+        self._sizes[chat_id] = size
+        self._total_bytes += size
+        self._purge_expired()
+        while len(self._sessions) > 1 and (
+            len(self._sessions) > self.max_sessions or self._total_bytes > self.max_bytes
+        ):
+            oldest = next(iter(self._sessions))
+            self._remove(oldest)
+            self.evicted += 1
+
+    async def delete(self, chat_id: int) -> None:
+        self._remove(chat_id)
+
+    def stats(self) -> Dict:
+        return {
+            "sessions": len(self._sessions),
+            "bytes": self._total_bytes,
+            "evicted": self.evicted,
+            "expired": self.expired,
+        }
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Сессии в локальной базе SQLite.
+
+    Переживают перезапуск и доступны всем воркерам на одной машине.
+    Запросы выполняются в пуле потоков хранилища, устаревшие сессии удаляются периодически.
+    """
+
+    def __init__(self, path: str = SESSION_DB, idle_ttl: float = SESSION_IDLE_TTL, purge_every: int = 500):
+        self.path = path
+        self.idle_ttl = idle_ttl
+        self.purge_every = purge_every
+        self._saves = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # Несколько процессов пишут в одну базу: WAL позволяет читать во время записи
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("PRAGMA busy_timeout=5000")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "chat_id INTEGER PRIMARY KEY, "
+            "data TEXT NOT NULL, "
+            "last_seen REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS sessions_last_seen ON sessions (last_seen)")
+        self._db.commit()
+
+    def _get(self, chat_id: int) -> Optional[Session]:
+        with self._lock:
+            row = self._db.execute("SELECT data, last_seen FROM sessions WHERE chat_id = ?", (chat_id,)).fetchone()
+        if row is None:
+            return None
+        data, last_seen = row
+        if time.time() - last_seen > self.idle_ttl:
+            self._delete(chat_id)
+            return None
+        return Session.from_dict(json.loads(data))
+
+    def _save(self, chat_id: int, session: Session) -> None:
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO sessions (chat_id, data, last_seen) VALUES (?, ?, ?)",
+                (chat_id, json.dumps(session.to_dict(), ensure_ascii=False), session.last_seen)
+            )
+
+    def _delete(self, chat_id: int) -> None:
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM sessions WHERE chat_id = ?", (chat_id,))
+
+    def _purge_expired(self) -> None:
+        with self._lock, self._db:
+            cursor = self._db.execute("DELETE FROM sessions WHERE last_seen < ?", (time.time() - self.idle_ttl,))
+        if cursor.rowcount:
+            logger.info(f"Удалено {cursor.rowcount} устаревших сессий")
+
+    async def get(self, chat_id: int) -> Optional[Session]:
+        return await run_io(self._get, chat_id)
+
+    async def save(self, chat_id: int, session: Session) -> None:
+        session.last_seen = time.time()
+        await run_io(self._save, chat_id, session)
+        self._saves += 1
+        if self._saves % self.purge_every == 0:
+            await run_io(self._purge_expired)
+
+    async def delete(self, chat_id: int) -> None:
+        await run_io(self._delete, chat_id)
+
+    async def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+class RedisSessionStore(SessionStore):
+    """
+    Сессии в Redis или совместимом сервере (KeyDB, Dragonfly и т.п.).
+
+    Время простоя задаётся TTL ключа, а лимит памяти и LRU-вытеснение —
+    настройками сервера (maxmemory, maxmemory-policy allkeys-lru).
+    Требует пакет redis, который ставится отдельно: pip install redis.
+    """
+
+    def __init__(self, url: str = SESSION_REDIS_URL, idle_ttl: float = SESSION_IDLE_TTL, prefix: str = "cnc_luga:session:"):
+        try:
+            import redis.asyncio as redis_asyncio
+        except ImportError:
+            raise RuntimeError("Для SESSION_BACKEND=redis установите пакет redis: pip install redis")
+        self.idle_ttl = idle_ttl
+        self.prefix = prefix
+        self._redis = redis_asyncio.from_url(url, decode_responses=True)
+
+    def _key(self, chat_id: int) -> str:
+        return f"{self.prefix}{chat_id}"
+
+    async def get(self, chat_id: int) -> Optional[Session]:
+        data = await self._redis.get(self._key(chat_id))
+        return Session.from_dict(json.loads(data)) if data else None
+
+    async def save(self, chat_id: int, session: Session) -> None:
+        session.last_seen = time.time()
+        await self._redis.set(
+            self._key(chat_id),
+            json.dumps(session.to_dict(), ensure_ascii=False),
+            ex=max(1, int(self.idle_ttl))
+        )
+
+    async def delete(self, chat_id: int) -> None:
+        await self._redis.delete(self._key(chat_id))
+
+    async def close(self) -> None:
+        await self._redis.aclose()
+
+
+def create_session_store(backend: str = SESSION_BACKEND) -> SessionStore:
+    """
+    Создаёт хранилище сессий по имени бэкенда.
+
+    Если выбранный бэкенд недоступен, используется хранилище в памяти.
+    """
+    try:
+        if backend == "sqlite":
+            store = SQLiteSessionStore()
+        elif backend == "redis":
+            store = RedisSessionStore()
+        else:
+            if backend != "memory":
+                logger.warning(f"Неизвестный SESSION_BACKEND={backend}, используем память")
+            store = MemorySessionStore()
+    except Exception as e:
+        logger.error(f"Не удалось создать хранилище сессий {backend}: {e}")
+        logger.error(traceback.format_exc())
+        store = MemorySessionStore()
+    logger.info(f"Хранилище сессий: {type(store).__name__}")
+    return store
+
+
+# Общее хранилище сессий бота
+sessions = create_session_store()
@@ -8,6 +8,7 @@
 
 import os
 import sys
+import hashlib
 import logging
 import requests
 from dotenv import load_dotenv
@@ -31,6 +32,9 @@ if not TOKEN:
     logging.error("❌ Ошибка: Не удалось загрузить TBOT_TOKEN из переменных окружения")
     sys.exit(1)
 
+# Секрет для заголовка X-Telegram-Bot-Api-Secret-Token; вычисляется так же, как в cnc_luga_bot.py
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(TOKEN.encode()).hexdigest()[:32]
+
 def setup_webhook(domain):
     """
     Настройка webhook для Telegram-бота.
@@ -51,7 +55,7 @@ def setup_webhook(domain):
         logging.info("Существующий webhook удален")
         
         # Устанавливаем новый webhook
-        response = requests.post(api_url, json={"url": webhook_url})
+        response = requests.post(api_url, json={"url": webhook_url, "secret_token": WEBHOOK_SECRET})
         response_data = response.json()
         
         if response_data.get("ok"):
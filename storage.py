@@ -0,0 +1,135 @@
+import asyncio
+import functools
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+from metrics import histogram
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+STORAGE_SECONDS = histogram(
+    "cnc_storage_seconds", "Время операции с диском, включая ожидание свободного потока", ["operation"]
+)
+
+# Число потоков для работы с диском
+STORAGE_THREADS = int(os.getenv("STORAGE_THREADS", "4"))
+
+# Общий пул потоков для файлов и SQLite. Отдельный от пула asyncio по умолчанию,
+# чтобы медленный диск не занимал потоки, нужные остальному коду
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+# Записи в один и тот же файл выполняются по очереди
+_file_locks: Dict[str, threading.Lock] = {}
+_file_locks_guard = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=STORAGE_THREADS, thread_name_prefix="storage")
+        return _executor
+
+
+def _file_lock(path: str) -> threading.Lock:
+    path = os.path.abspath(path)
+    with _file_locks_guard:
+        lock = _file_locks.get(path)
+        if lock is None:
+            lock = _file_locks[path] = threading.Lock()
+        return lock
+
+
+async def run_io(func: Callable, *args, **kwargs) -> Any:
+    """
+    Выполняет блокирующую операцию ввода-вывода в пуле потоков хранилища.
+
+    Цикл событий в это время продолжает обрабатывать обновления других пользователей.
+    """
+    loop = asyncio.get_running_loop()
+    operation = getattr(func, "__name__", "other").lstrip("_")
+    with STORAGE_SECONDS.time(operation=operation), span(f"storage.{operation}"):
+        return await loop.run_in_executor(_get_executor(), functools.partial(func, *args, **kwargs))
+
+
+def _read_text(path: str, default: Optional[str]) -> Optional[str]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return default
+
+
+def _write_text(path: str, text: str) -> None:
+    # Пишем во временный файл и подменяем: читатели никогда не увидят файл наполовину записанным
+    tmp_path = f"{path}.tmp"
+    with _file_lock(path):
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+
+def _append_text(path: str, text: str) -> None:
+    with _file_lock(path):
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(text)
+
+
+def _write_json(path: str, data: Any) -> None:
+    # Сериализация тоже может быть долгой для больших структур, поэтому она выполняется в потоке
+    _write_text(path, json.dumps(data, ensure_ascii=False))
+
+
+def _remove(path: str) -> None:
+    with _file_lock(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+async def read_text(path: str, default: Optional[str] = None) -> Optional[str]:
+    """Читает текстовый файл; если файла нет, возвращает default."""
+    return await run_io(_read_text, path, default)
+
+
+async def write_text(path: str, text: str) -> None:
+    """Атомарно заменяет содержимое текстового файла."""
+    await run_io(_write_text, path, text)
+
+
+async def append_text(path: str, text: str) -> None:
+    """Дописывает текст в конец файла."""
+    await run_io(_append_text, path, text)
+
+
+async def read_json(path: str, default: Any = None) -> Any:
+    """Читает JSON-файл; если файла нет, возвращает default."""
+    text = await read_text(path)
+    if text is None:
+        return default
+    return json.loads(text)
+
+
+async def write_json(path: str, data: Any) -> None:
+    """Атомарно сохраняет данные в JSON-файл."""
+    await run_io(_write_json, path, data)
+
+
+async def remove(path: str) -> None:
+    """Удаляет файл, если он существует."""
+    await run_io(_remove, path)
+
+
+def shutdown_storage() -> None:
+    """Дожидается завершения операций с диском и останавливает пул потоков."""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
@@ -0,0 +1,305 @@
+"""
+Трассировка обработки обновлений: из чего складывается время ответа.
+
+Каждое обновление Telegram получает trace id, а участки его обработки
+(обработчик, сборка промпта, запрос к Яндекс GPT, вызовы Bot API, диск) —
+отрезки (span) с длительностью. Текущий отрезок хранится в contextvars,
+поэтому вложенные вызовы и задачи, созданные из обработчика, попадают
+в ту же трассу без передачи параметров:
+
+    with span("gpt.request", model=model):
+        ...
+
+Завершённые отрезки складываются в кольцевой буфер в памяти (его
+показывает команда администратора /trace) и, если задан TRACE_FILE,
+дописываются в файл JSON Lines.
+"""
+
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "1") == "1"
+# Доля обновлений, которые трассируются (1 — все)
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1"))
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "200"))  # Сколько последних трасс держать в памяти
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", "200"))  # Предел отрезков в одной трассе
+TRACE_FILE = os.getenv("TRACE_FILE", "")  # Файл JSON Lines для отрезков; пусто — только память
+
+_current: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+
+
+def _new_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+class Span:
+    """Отрезок трассы: имя, время начала, длительность и атрибуты."""
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "attrs", "start", "duration", "error", "_started", "_token")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attrs: Dict):
+        self.trace_id = trace_id
+        self.span_id = _new_id()
+        self.parent_id = parent_id
+        self.name = name
+        self.attrs = attrs
+        self.start = time.time()
+        self.duration: Optional[float] = None
+        self.error: Optional[str] = None
+        self._started = time.perf_counter()
+        self._token = None
+
+    def set(self, **attrs) -> None:
+        self.attrs.update(attrs)
+
+    def __enter__(self) -> "Span":
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        _current.reset(self._token)
+        if exc_type is not None and issubclass(exc_type, asyncio.CancelledError):
+            self.finish("cancelled")
+        elif exc_type is not None:
+            self.finish(f"{exc_type.__name__}: {exc}")
+        else:
+            self.finish()
+        return False
+
+    def finish(self, error: Optional[str] = None) -> None:
+        """Завершает отрезок, который не делали текущим (например, ответ, получаемый потоком)."""
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self._started
+        self.error = error
+        exporter.export(self)
+
+    def as_dict(self) -> Dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration": self.duration,
+            "error": self.error,
+            "attrs": self.attrs,
+        }
+
+
+class _NoopSpan:
+    """Отрезок вне трассировки (трассировка выключена или обновление не попало в выборку)."""
+
+    trace_id = None
+
+    def set(self, **attrs) -> None:
+        pass
+
+    def finish(self, error: Optional[str] = None) -> None:
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        return False
+
+
+_NOOP = _NoopSpan()
+# Обновление не попало в выборку: вложенные отрезки тоже не записываются
+_unsampled: contextvars.ContextVar[bool] = contextvars.ContextVar("trace_unsampled", default=False)
+
+
+class _UnsampledTrace(_NoopSpan):
+    def __enter__(self):
+        self._token = _unsampled.set(True)
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        _unsampled.reset(self._token)
+        return False
+
+
+def start_trace(name: str, **attrs):
+    """Начинает новую трассу (например, на каждое обновление Telegram) с корневым отрезком name."""
+    if not TRACE_ENABLED:
+        return _NOOP
+    if TRACE_SAMPLE_RATE < 1 and random.random() >= TRACE_SAMPLE_RATE:
+        return _UnsampledTrace()
+    return Span(name, _new_id(), None, attrs)
+
+
+def span(name: str, new_trace: bool = False, **attrs):
+    """
+    Отрезок внутри текущей трассы. Вне трассы ничего не записывается
+    (вызовы Bot API во время рассылки, чтение файлов при запуске), а при
+    new_trace=True начинается новая трасса — так обработчики получают её в
+    режиме long polling, где обновления обрабатывает сам Application.
+    """
+    if not TRACE_ENABLED or _unsampled.get():
+        return _NOOP
+    parent = _current.get()
+    if parent is None:
+        return start_trace(name, **attrs) if new_trace else _NOOP
+    return Span(name, parent.trace_id, parent.span_id, attrs)
+
+
+def traced(name: Optional[str] = None, new_trace: bool = False):
+    """Декоратор корутины: её выполнение — отрезок с именем name (по умолчанию имя функции)."""
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(span_name, new_trace=new_trace):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def current_span():
+    """Текущий отрезок, чтобы дописать ему атрибуты; вне трассы — пустышка."""
+    return _current.get() or _NOOP
+
+
+def current_trace_id() -> Optional[str]:
+    current = _current.get()
+    return current.trace_id if current is not None else None
+
+
+class TraceExporter:
+    """
+    Хранит отрезки последних трасс в памяти и пишет их в TRACE_FILE.
+
+    Отрезки трассы собираются по trace_id в порядке завершения; при
+    переполнении вытесняется самая давняя трасса. Запись в файл — пачками
+    в пуле потоков хранилища, когда завершается корневой отрезок.
+    """
+
+    def __init__(self, capacity: int = TRACE_BUFFER_SIZE, path: str = TRACE_FILE):
+        self.capacity = capacity
+        self.path = path
+        self._traces: "OrderedDict[str, List[Dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._pending: List[str] = []
+        self._flush_tasks = set()
+
+    def export(self, span: Span) -> None:
+        record = span.as_dict()
+        with self._lock:
+            spans = self._traces.get(span.trace_id)
+            if spans is None:
+                spans = self._traces[span.trace_id] = []
+                while len(self._traces) > self.capacity:
+                    self._traces.popitem(last=False)
+            if len(spans) < TRACE_MAX_SPANS:
+                spans.append(record)
+            if self.path:
+                self._pending.append(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        if self.path and span.parent_id is None:
+            self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        task = loop.create_task(self.flush())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def flush(self) -> None:
+        # Импорт здесь: storage сам пишет отрезки трассы и импортирует этот модуль
+        from storage import append_text
+
+        with self._lock:
+            lines, self._pending = self._pending, []
+        if not lines:
+            return
+        try:
+            await append_text(self.path, "".join(lines))
+        except Exception as e:
+            logger.error(f"Не удалось записать трассы в {self.path}: {e}")
+
+    def recent(self, limit: int = 10) -> List[List[Dict]]:
+        """Последние трассы (новые первыми), у каждой — список отрезков."""
+        with self._lock:
+            traces = list(self._traces.values())[-limit:]
+        return [list(spans) for spans in reversed(traces)]
+
+    def get(self, trace_id_prefix: str) -> Optional[List[Dict]]:
+        """Отрезки трассы по trace id или его началу."""
+        with self._lock:
+            for trace_id, spans in reversed(self._traces.items()):
+                if trace_id.startswith(trace_id_prefix):
+                    return list(spans)
+        return None
+
+
+exporter = TraceExporter()
+
+
+async def close_tracing() -> None:
+    """Дописывает в файл отрезки, которые ещё не записаны."""
+    if exporter.path:
+        await exporter.flush()
+
+
+def _root(spans: List[Dict]) -> Dict:
+    roots = [s for s in spans if s["parent_id"] is None]
+    return roots[0] if roots else min(spans, key=lambda s: s["start"])
+
+
+def format_trace_summary(spans: List[Dict]) -> str:
+    """Одна строка о трассе: id, корневой отрезок, длительность, самый долгий вложенный отрезок."""
+    root = _root(spans)
+    duration = root["duration"] or 0.0
+    children = [s for s in spans if s is not root]
+    slowest = max(children, key=lambda s: s["duration"] or 0.0) if children else None
+    line = f"{root['trace_id']} {root['name']} {duration:.2f} с"
+    if root["attrs"].get("chat_id") is not None:
+        line += f" (чат {root['attrs']['chat_id']})"
+    if slowest is not None:
+        line += f" — дольше всего {slowest['name']} {slowest['duration'] or 0.0:.2f} с"
+    return line
+
+
+def format_trace(spans: List[Dict]) -> str:
+    """Дерево отрезков трассы со смещением от начала и длительностью каждого."""
+    root = _root(spans)
+    children: Dict[Optional[str], List[Dict]] = {}
+    for s in spans:
+        children.setdefault(s["parent_id"], []).append(s)
+    lines = [f"Трасса {root['trace_id']}"]
+
+    def walk(node: Dict, depth: int) -> None:
+        offset = node["start"] - root["start"]
+        attrs = " ".join(f"{key}={value}" for key, value in node["attrs"].items())
+        line = f"{'  ' * depth}+{offset:.2f} {node['name']} {node['duration'] or 0.0:.3f} с"
+        if attrs:
+            line += f" [{attrs}]"
+        if node["error"]:
+            line += f" ❗{node['error']}"
+        lines.append(line)
+        for child in sorted(children.get(node["span_id"], []), key=lambda s: s["start"]):
+            walk(child, depth + 1)
+
+    walk(root, 0)
+    # Отрезки, родитель которых не попал в буфер (например, превышен TRACE_MAX_SPANS)
+    known = {s["span_id"] for s in spans}
+    for orphan in spans:
+        if orphan is not root and orphan["parent_id"] not in known:
+            walk(orphan, 1)
+    return "\n".join(lines)
@@ -1,85 +1,192 @@
 import logging
 import os
 import json
+import sqlite3
+import threading
 import traceback
 from typing import List, Dict, Optional
 from datetime import datetime
+from storage import run_io
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.DEBUG,  # Изменяем уровень на DEBUG для более подробных логов
-    format='%(asctime)s - %(name)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s',
-    handlers=[
-        logging.FileHandler("users.log", encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
-USERS_FILE = 'users.json'
+USERS_FILE = 'users.json'  # Старый формат хранения, используется только для переноса данных
+USERS_DB = os.getenv("USERS_DB", "users.db")
 
-def load_users() -> Dict:
-    """
-    Загружает список пользователей из файла.
-    
-    Returns:
-        Dict: Словарь с данными пользователей
-    """
+# Индекс пользователей в памяти: загружается из базы один раз и обновляется при каждом изменении
+_users_index: Optional[Dict[str, Dict]] = None
+_db: Optional[sqlite3.Connection] = None
+# Соединение SQLite используется из потоков-исполнителей, поэтому доступ к нему сериализуем
+_db_lock = threading.Lock()
+
+
+def _connect() -> sqlite3.Connection:
+    db = sqlite3.connect(USERS_DB, check_same_thread=False)
+    # WAL и synchronous=NORMAL: запись одной строки не требует переписывать файл и ждать fsync на каждый коммит
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS users ("
+        "user_id INTEGER PRIMARY KEY, "
+        "username TEXT, "
+        "added_at TEXT NOT NULL)"
+    )
+    db.commit()
+    return db
+
+
+def _migrate_from_json(db: sqlite3.Connection) -> None:
+    """Переносит пользователей из users.json в пустую базу."""
     if not os.path.exists(USERS_FILE):
-        logger.debug(f"Файл {USERS_FILE} не существует, возвращаем пустой словарь")
-        return {}
-    
+        return
+    if db.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+        return
     try:
         with open(USERS_FILE, 'r', encoding='utf-8') as f:
             users = json.load(f)
-            logger.debug(f"Загружено {len(users)} пользователей из файла")
-            return users
+        with db:
+            db.executemany(
+                "INSERT OR IGNORE INTO users (user_id, username, added_at) VALUES (?, ?, ?)",
+                [(int(user_id), info.get('username'), info.get('added_at') or str(datetime.now()))
+                 for user_id, info in users.items()]
+            )
+        logger.info(f"Перенесено {len(users)} пользователей из {USERS_FILE} в {USERS_DB}")
     except Exception as e:
-        logger.error(f"Ошибка при загрузке пользователей: {e}")
+        logger.error(f"Ошибка при переносе пользователей из {USERS_FILE}: {e}")
         logger.error(traceback.format_exc())
-        return {}
+
+
+def init_users() -> None:
+    """
+    Открывает базу пользователей и загружает индекс в память.
+    
+    Вызывается один раз при старте бота; при первом обращении к пользователям
+    вызывается автоматически.
+    """
+    global _db, _users_index
+    with _db_lock:
+        if _db is None:
+            _db = _connect()
+            _migrate_from_json(_db)
+        rows = _db.execute("SELECT user_id, username, added_at FROM users").fetchall()
+    _users_index = {
+        str(user_id): {'username': username, 'added_at': added_at}
+        for user_id, username, added_at in rows
+    }
+    logger.info(f"Загружено {len(_users_index)} пользователей из {USERS_DB}")
+
+
+async def reload_users() -> None:
+    """
+    Перечитывает индекс из базы в пуле потоков хранилища.
+    
+    Нужно, когда базу меняют другие процессы (например, воркеры кластера),
+    а индекс в памяти этого процесса о новых пользователях не знает.
+    """
+    await run_io(init_users)
+
+
+def close_users() -> None:
+    """Закрывает соединение с базой пользователей."""
+    global _db, _users_index
+    with _db_lock:
+        if _db is not None:
+            _db.close()
+            _db = None
+    _users_index = None
+
+
+def ping_users() -> None:
+    """Выполняет пустой запрос к базе пользователей (для проверки готовности)."""
+    with _db_lock:
+        if _db is None:
+            raise RuntimeError("база пользователей не открыта")
+        _db.execute("SELECT 1").fetchone()
+
+
+def _index() -> Dict[str, Dict]:
+    if _users_index is None:
+        init_users()
+    return _users_index
+
+
+def _execute(query: str, params=()) -> None:
+    with _db_lock:
+        with _db:
+            _db.execute(query, params)
+
+
+def load_users() -> Dict:
+    """
+    Возвращает пользователей из индекса в памяти.
+    
+    Returns:
+        Dict: Словарь с данными пользователей
+    """
+    return dict(_index())
 
 def save_users(users: Dict) -> None:
     """
-    Сохраняет список пользователей в файл.
+    Полностью заменяет список пользователей (массовая операция, одной транзакцией).
     
     Args:
         users (Dict): Словарь с данными пользователей
     """
+    global _users_index
+    _index()
     try:
-        with open(USERS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(users, f, ensure_ascii=False, indent=4)
-            logger.debug(f"Сохранено {len(users)} пользователей в файл")
+        with _db_lock:
+            with _db:
+                _db.execute("DELETE FROM users")
+                _db.executemany(
+                    "INSERT INTO users (user_id, username, added_at) VALUES (?, ?, ?)",
+                    [(int(user_id), info.get('username'), info.get('added_at') or str(datetime.now()))
+                     for user_id, info in users.items()]
+                )
+        _users_index = {str(user_id): dict(info) for user_id, info in users.items()}
+        logger.debug("Сохранено %d пользователей в базу", len(users))
     except Exception as e:
         logger.error(f"Ошибка при сохранении пользователей: {e}")
         logger.error(traceback.format_exc())
 
-def get_users() -> List[int]:
+def get_users() -> List[str]:
     """
     Возвращает список ID всех пользователей.
     
     Returns:
-        List[int]: Список ID пользователей
+        List[str]: Список ID пользователей
     """
-    users = load_users()
-    return list(users.keys())
+    return list(_index().keys())
 
 async def add_user(user_id: int, username: Optional[str] = None) -> None:
     """
     Добавляет нового пользователя в список.
     
+    Известные пользователи проверяются по индексу в памяти без обращения к диску;
+    новый пользователь записывается одной строкой в пуле потоков хранилища.
+    
     Args:
         user_id (int): ID пользователя
         username (Optional[str]): Имя пользователя
     """
-    users = load_users()
-    if str(user_id) not in users:
-        users[str(user_id)] = {
-            'username': username,
-            'added_at': str(datetime.now())
-        }
-        save_users(users)
+    users = _index()
+    if str(user_id) in users:
+        return
+    info = {
+        'username': username,
+        'added_at': str(datetime.now())
+    }
+    try:
+        await run_io(
+            _execute,
+            "INSERT OR IGNORE INTO users (user_id, username, added_at) VALUES (?, ?, ?)",
+            (int(user_id), username, info['added_at'])
+        )
+        users[str(user_id)] = info
         logger.info(f"Добавлен новый пользователь: {user_id} (username: {username})")
+    except Exception as e:
+        logger.error(f"Ошибка при добавлении пользователя {user_id}: {e}")
+        logger.error(traceback.format_exc())
 
 async def remove_user(user_id: int) -> bool:
     """
@@ -91,13 +198,18 @@ async def remove_user(user_id: int) -> bool:
     Returns:
         bool: True если пользователь был удален, False если не найден
     """
-    users = load_users()
-    if str(user_id) in users:
-        del users[str(user_id)]
-        save_users(users)
-        logger.info(f"Удален пользователь: {user_id}")
-        return True
-    return False
+    users = _index()
+    if str(user_id) not in users:
+        return False
+    try:
+        await run_io(_execute, "DELETE FROM users WHERE user_id = ?", (int(user_id),))
+    except Exception as e:
+        logger.error(f"Ошибка при удалении пользователя {user_id}: {e}")
+        logger.error(traceback.format_exc())
+        return False
+    users.pop(str(user_id), None)
+    logger.info(f"Удален пользователь: {user_id}")
+    return True
 
 async def get_user_info(user_id: int) -> Optional[Dict]:
     """
@@ -109,5 +221,4 @@ async def get_user_info(user_id: int) -> Optional[Dict]:
     Returns:
         Optional[Dict]: Информация о пользователе или None если не найден
     """
-    users = load_users()
-    return users.get(str(user_id))
\ No newline at end of file
+    return _index().get(str(user_id))
\ No newline at end of file